@@ -0,0 +1,103 @@
+"""
+Micro-benchmark of parsing a pi_logger payload with parse_payload against
+the DataFrame construction and merge it replaced
+
+usage, from the repository root:
+    python -m benchmarks.bench_payload_parse [n_rows] [n_sensors]
+"""
+import sys
+import json
+import time
+import numpy as np
+import pandas as pd
+from homesweetpi.payloads import decode_payload
+from homesweetpi.retrieve_data import parse_payload
+
+
+def make_payload(n_rows, n_sensors, seed=0):
+    """
+    Return a json payload of n_rows readings from n_sensors sensors on one
+    pi in the pi_logger api's orient="columns" format, and a dataframe of
+    the sensors
+    """
+    rng = np.random.default_rng(seed)
+    sensors = pd.DataFrame({
+        "sensorid": np.arange(n_sensors),
+        "location": [f"room{i}" for i in range(n_sensors)],
+        "piname": "catflap",
+    })
+    start = pd.Timestamp("2020-01-01").value // 10**6
+    readings = pd.DataFrame({
+        "id": np.arange(n_rows),
+        "datetime": start + np.arange(n_rows) * 1000,
+        "location": sensors["location"].to_numpy()[np.arange(n_rows)
+                                                    % n_sensors],
+        "sensortype": "BME680",
+        "piname": "catflap",
+        "piid": "100000003d12f229",
+        "temp": rng.normal(20, 2, n_rows),
+        "humidity": rng.normal(50, 5, n_rows),
+        "pressure": rng.normal(1000, 5, n_rows),
+        "gasvoc": rng.normal(1e5, 1e3, n_rows),
+        "mcdvalue": None,
+        "mcdvoltage": None,
+    })
+    return readings.to_json(orient="columns"), sensors
+
+
+def merge_parse(payload, sensors):
+    """
+    Parse a payload by building a dataframe from the decoded json and
+    merging it with the sensors, as process_fetched_data used to
+    """
+    recent_data = pd.DataFrame(json.loads(payload))
+    recent_data['datetime'] = pd.to_datetime(recent_data['datetime'],
+                                             unit="ms")
+    recent_data = recent_data.merge(sensors, on=['location', 'piname'])\
+                             .drop(["piname", "location", "sensortype",
+                                    "piid", "id"], axis=1)
+    return recent_data.drop_duplicates(subset=['datetime', 'sensorid'])
+
+
+def columnar_parse(payload, sensors):
+    """
+    Parse a payload with a single decode and one numpy array per column
+    """
+    return parse_payload(decode_payload(payload), sensors)
+
+
+def best_time(function, *args, repeat=3):
+    """
+    Return the result and the fastest of repeat runs of function in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+def main(n_rows=100_000, n_sensors=4):
+    """
+    Time both parsers and check that they agree
+    """
+    payload, sensors = make_payload(n_rows, n_sensors)
+    print(f"{n_rows} rows, {len(payload) / 2**20:.1f} MiB of json")
+    new, new_time = best_time(columnar_parse, payload, sensors)
+    old, old_time = best_time(merge_parse, payload, sensors)
+    _, decode_time = best_time(json.loads, payload)
+    old = old.sort_values(["datetime", "sensorid"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(new[old.columns], old, check_dtype=False)
+    for name, timing in (("json decode", decode_time),
+                         ("merge parse", old_time),
+                         ("columnar parse", new_time)):
+        print(f"{name:15} {timing:.3f} s, "
+              f"{timing / n_rows * 10**6:.2f} us per row")
+    print(f"speed-up        {old_time / new_time:.1f}x")
+
+
+if __name__ == "__main__":
+    ARGS = sys.argv[1:]
+    main(int(ARGS[0]) if ARGS else 100_000,
+         int(ARGS[1]) if len(ARGS) > 1 else 4)
@@ -0,0 +1,67 @@
+"""
+Benchmark of resample_measurements against the pandas groupby resample it
+replaced, on synthetic readings from many sensors
+
+usage, from the repository root:
+    python -m benchmarks.bench_resample [n_rows] [n_sensors] [freq]
+"""
+import sys
+import time
+import numpy as np
+import pandas as pd
+from homesweetpi.sql_tables import (resample_measurements,
+                                    resample_measurements_pandas)
+
+
+def make_logs(n_rows, n_sensors, seed=0):
+    """
+    Return a dataframe of n_rows readings spread over n_sensors sensors
+    taking one reading per minute
+    """
+    rng = np.random.default_rng(seed)
+    per_sensor = n_rows // n_sensors
+    start = pd.Timestamp("2020-01-01")
+    times = start + pd.to_timedelta(np.arange(per_sensor), unit="min")
+    logs = pd.DataFrame({
+        "sensorid": np.repeat(np.arange(n_sensors), per_sensor),
+        "datetime": np.tile(times.to_numpy(), n_sensors),
+    })
+    for col in ("temp", "humidity", "pressure", "gasvoc", "mcdvoltage"):
+        logs[col] = rng.normal(50, 10, len(logs))
+    logs["mcdvalue"] = rng.integers(0, 1024, len(logs))
+    return logs
+
+
+def best_time(function, *args, repeat=3):
+    """
+    Return the result and the fastest of repeat runs of function in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+def main(n_rows=2_000_000, n_sensors=8, resample_freq="30T"):
+    """
+    Time both implementations and check that they agree
+    """
+    logs = make_logs(n_rows, n_sensors)
+    print(f"{len(logs)} readings from {n_sensors} sensors, "
+          f"buckets of {resample_freq}")
+    fast, fast_time = best_time(resample_measurements, logs, resample_freq)
+    slow, slow_time = best_time(resample_measurements_pandas, logs,
+                                resample_freq)
+    pd.testing.assert_frame_equal(fast, slow, check_dtype=False)
+    print(f"pandas groupby resample: {slow_time:.3f} s")
+    print(f"bincount resample:       {fast_time:.3f} s")
+    print(f"speed-up:                {slow_time / fast_time:.1f}x")
+
+
+if __name__ == "__main__":
+    ARGS = sys.argv[1:]
+    main(int(ARGS[0]) if ARGS else 2_000_000,
+         int(ARGS[1]) if len(ARGS) > 1 else 8,
+         ARGS[2] if len(ARGS) > 2 else "30T")
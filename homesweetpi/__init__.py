@@ -48,6 +48,22 @@ def set_up_python_logging(level="DEBUG",
     return log
 
 
+def log_to_console(level="INFO"):
+    """
+    Show log records at level or above on the console
+    The handler is added to the root logger and carries the level itself,
+    as the homesweetpi logger stays at DEBUG for the log file and its
+    records propagate to the root handlers whatever the root level is.
+    """
+    handler = logging.StreamHandler()
+    handler.setLevel(level)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+    return handler
+
+
 LOG = set_up_python_logging(name="homesweetpi", level="DEBUG",
                             log_filename="homesweetpi.log",
                             log_path=LOG_PATH)
@@ -5,14 +5,31 @@ adapted from:
 https://www.codementor.io/@sagaragarwal94/building-a-basic-restful-api-in-python-58k02xsiq
 """
 # pylint: disable=C0103
+import os
+import zlib
+import atexit
+import hmac
+import hashlib
 import logging
-from flask import Flask
-from flask import render_template, request
+import threading
+import sqlalchemy
+from flask import Flask, Response
+from flask import render_template, request, abort, url_for
 from flask_restful import Resource, Api
+from werkzeug.exceptions import RequestEntityTooLarge
 from dotenv import load_dotenv
-from homesweetpi.data_preparation import rewrite_chart,\
+from homesweetpi.data_preparation import get_chart_layout, get_chart_data,\
+                                         chart_data_watermark,\
                                          recent_readings_as_html,\
-                                         get_most_recent_readings
+                                         get_most_recent_readings,\
+                                         CHART_VIEWS, RESAMPLE_FREQ
+from homesweetpi.chart_cache import CHART_CACHE
+from homesweetpi.chart_artifacts import CHART_ARTIFACTS
+from homesweetpi.sql_tables import SENSOR_CACHE
+from homesweetpi.payloads import (COMPACT_MEDIA_TYPE, decode_compact,
+                                  decode_payload)
+from homesweetpi.retrieve_data import ingest_payload, INGEST_BUFFER
+from homesweetpi.ingest_buffer import USE_INGEST_BUFFER
 
 load_dotenv()
 
@@ -22,6 +39,23 @@ app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 
 LOG = logging.getLogger("homesweetpi.api_server")
 
+CHART_DATA_MIMETYPES = {
+    "csv": "text/csv",
+    "json": "application/json",
+}
+INGEST_TOKEN = os.getenv("HSP_INGEST_TOKEN")
+INGEST_MAX_BYTES = int(os.getenv("HSP_INGEST_MAX_BYTES",
+                                 default=str(16 * 2**20)))
+INGEST_MAX_DECOMPRESSED_BYTES = int(os.getenv(
+    "HSP_INGEST_MAX_DECOMPRESSED_BYTES", default=str(128 * 2**20)))
+app.config['MAX_CONTENT_LENGTH'] = INGEST_MAX_BYTES
+INGEST_RETRY_AFTER = 5
+INGEST_SLOTS = threading.BoundedSemaphore(
+    int(os.getenv("HSP_INGEST_CONCURRENCY", default="2")))
+if USE_INGEST_BUFFER:
+    INGEST_BUFFER.start()
+    atexit.register(INGEST_BUFFER.close)
+
 
 class GetLast(Resource):
     """
@@ -36,6 +70,118 @@ class GetLast(Resource):
         return get_most_recent_readings()
 
 
+class CacheStats(Resource):
+    """
+    API route for inspecting the in-memory caches of the web server
+    """
+    # pylint: disable=R0201
+    def get(self):
+        """
+        Return a JSON with hit and miss counts for the chart and sensor caches
+        and the precomputed chart artifacts, and the queue depth and flush
+        latencies of the ingest buffer
+        """
+        LOG.info("CacheStats triggered")
+        return dict(chart_cache=CHART_CACHE.stats(),
+                    chart_artifacts=CHART_ARTIFACTS.stats(),
+                    sensor_cache=SENSOR_CACHE.stats(),
+                    ingest_buffer=INGEST_BUFFER.metrics())
+
+
+def ingest_authorised():
+    """
+    Return True if the request carries the ingestion token as a bearer
+    token. Ingestion is disabled if no token is configured.
+    """
+    if not INGEST_TOKEN:
+        return False
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    return (scheme.lower() == "bearer"
+            and hmac.compare_digest(token.encode(), INGEST_TOKEN.encode()))
+
+
+def gunzip_limited(body, max_bytes):
+    """
+    Decompress a gzip-compressed request body, refusing bodies that
+    decompress to more than max_bytes
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    body = decompressor.decompress(body, max_bytes + 1)
+    if len(body) > max_bytes:
+        raise RequestEntityTooLarge()
+    if not decompressor.eof:
+        raise ValueError("Truncated gzip body")
+    return body
+
+
+def read_ingest_payload():
+    """
+    Decode the body of an ingestion request, in the compact payload format
+    or as json, optionally gzip-compressed
+    Raises RequestEntityTooLarge if the body, which may be sent without a
+    Content-Length, or its decompressed content is over the size limits
+    """
+    body = request.stream.read(INGEST_MAX_BYTES + 1)
+    if len(body) > INGEST_MAX_BYTES:
+        raise RequestEntityTooLarge()
+    if request.content_encoding == "gzip" or body[:2] == b"\x1f\x8b":
+        body = gunzip_limited(body, INGEST_MAX_DECOMPRESSED_BYTES)
+    if request.mimetype == COMPACT_MEDIA_TYPE:
+        return decode_compact(body)
+    return decode_payload(body)
+
+
+class Ingest(Resource):
+    """
+    API route for pis to push batches of readings to the DB
+    """
+    # pylint: disable=R0201
+    def post(self):
+        """
+        Save the readings in the request body, which has the same format as
+        the pi_logger api's responses
+        Returns 401 without a valid token, 413 for bodies over the size
+        limit and 503 if too many batches are already being saved, so that
+        pis back off and retry
+        With HSP_INGEST_BUFFER set to 1, readings are queued in the ingest
+        buffer and saved with those of other pis, returning 202, or 503 while
+        the buffer is full
+        """
+        LOG.info("Ingest triggered")
+        if not ingest_authorised():
+            return (dict(message="Invalid or missing ingestion token"), 401,
+                    {"WWW-Authenticate": "Bearer"})
+        if (request.content_length or 0) > INGEST_MAX_BYTES:
+            return dict(message="Batch too large"), 413
+        if not INGEST_SLOTS.acquire(blocking=False):
+            LOG.warning("Ingestion busy, asking pi to retry")
+            return (dict(message="Busy, retry later"), 503,
+                    {"Retry-After": str(INGEST_RETRY_AFTER)})
+        try:
+            rows, counts = ingest_payload(
+                read_ingest_payload(),
+                buffer=INGEST_BUFFER if USE_INGEST_BUFFER else None)
+        except RequestEntityTooLarge:
+            return dict(message="Batch too large"), 413
+        except BufferError:
+            LOG.warning("Ingest buffer full, asking pi to retry")
+            return (dict(message="Busy, retry later"), 503,
+                    {"Retry-After": str(INGEST_RETRY_AFTER)})
+        except (ValueError, KeyError, TypeError, AssertionError,
+                OSError, zlib.error) as error:
+            LOG.warning("Rejected ingestion batch: %s", error)
+            return dict(message="Invalid batch"), 400
+        except sqlalchemy.exc.IntegrityError as error:
+            LOG.warning("Could not save ingestion batch: %s", error)
+            return dict(message="Could not save batch"), 409
+        finally:
+            INGEST_SLOTS.release()
+        if counts is None:
+            return dict(rows=rows, queued=True), 202
+        return dict(rows=rows, inserted=counts.inserted,
+                    skipped=counts.skipped)
+
+
 def get_n_days_to_display():
     """
     Get the number of days that will be displayed on the chart
@@ -63,81 +209,125 @@ def main_page():
     return render_template('main_page.html', **context)
 
 
-@app.route('/charts')
-def charts():
+def chart_title(n_days):
     """
-    Update Altair chart of sensor readings and pass as context to chart page
+    Title of the chart for the last n days
+    """
+    return f"Readings from the last {n_days} days:"
+
+
+@app.route('/chart_spec/<view>')
+def chart_spec(view):
+    """
+    Return the Vega-Lite spec of the chart for a view as JSON
+    The spec only describes the layout and loads its data from the
+    chart_data route
+    """
+    LOG.info("Chart spec for %s triggered", view)
+    if view not in CHART_VIEWS:
+        abort(404)
+    n_days = get_n_days_to_display()
+    data_url = url_for("chart_data", view=view, n_days=n_days)
+    spec = get_chart_layout(CHART_VIEWS[view], data_url, chart_title(n_days))
+    response = Response(spec, mimetype="application/json")
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def chart_data_etag(view, n_days, data_format, compress, watermark):
+    """
+    Return an entity tag identifying the chart data for a view, range,
+    format and data watermark
+    """
+    key = repr((view, n_days, RESAMPLE_FREQ, data_format, compress,
+                watermark))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+@app.route('/chart_data/<view>')
+def chart_data(view):
+    """
+    Return the resampled readings for a view as csv (the default) or, with
+    format=json, as json with one list per column
+    Responses are gzip-compressed for clients that accept it and can be
+    revalidated with the ETag, which only changes when the data served does
+    The standard views are usually served from the artifacts precomputed
+    by the retrieval service, and the ETag and Last-Modified then describe
+    the data the artifact was built from
+    """
+    LOG.info("Chart data for %s triggered", view)
+    if view not in CHART_VIEWS:
+        abort(404)
+    data_format = request.args.get('format', default="csv")
+    if data_format not in CHART_DATA_MIMETYPES:
+        abort(400)
+    n_days = get_n_days_to_display()
+    compress = "gzip" in request.accept_encodings
+    watermark = chart_data_watermark(view, n_days, RESAMPLE_FREQ, data_format,
+                                     compress, store=CHART_ARTIFACTS)
+    etag = chart_data_etag(view, n_days, data_format, compress, watermark)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        payload = get_chart_data(CHART_VIEWS[view], n_days, RESAMPLE_FREQ,
+                                 data_format, compress, watermark=watermark,
+                                 store=CHART_ARTIFACTS, view=view)
+        response = Response(payload,
+                            mimetype=CHART_DATA_MIMETYPES[data_format])
+        if compress:
+            response.content_encoding = "gzip"
+    response.set_etag(etag)
+    if watermark is not None:
+        response.last_modified = watermark
+    response.cache_control.no_cache = True
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def render_chart_page(view):
+    """
+    Render the chart page for a view, which loads its chart spec from the
+    chart_spec route
     """
-    LOG.info("Chart page triggered")
     n_days = get_n_days_to_display()
-    resample_freq = '30T'
-    rows = [
-        "Temperature (°C)", 'Relative Humidity (%)',
-        'Pressure (hPa)', 'Gas Resistance (Ω)',
-        "Soil Moisture Value", "Soil Moisture (V)"
-    ]
-    chart_filename = "altair_chart_recent_data.json"
-    rewrite_chart(
-        rows, n_days, resample_freq,
-        filename=f"homesweetpi/static/{chart_filename}"
-    )
     context = dict(
         sub_title=f"Readings for the last {n_days} days",
-        chart_filename=f"\"static/{chart_filename}\""
+        chart_url=url_for("chart_spec", view=view, n_days=n_days)
     )
     return render_template('charts.html', **context)
 
 
+@app.route('/charts')
+def charts():
+    """
+    Chart page for all sensor readings
+    """
+    LOG.info("Chart page triggered")
+    return render_chart_page("all")
+
+
 @app.route('/air_charts')
 def air_charts():
     """
-    Update Altair chart of air quality readings and pass as context to chart
-    page
+    Chart page for air quality readings
     """
     LOG.info("Air chart page triggered")
-    n_days = get_n_days_to_display()
-    resample_freq = '30T'
-    rows = [
-        "Temperature (°C)", 'Relative Humidity (%)',
-        'Pressure (hPa)', 'Gas Resistance (Ω)',
-    ]
-    chart_filename = "altair_chart_atmopheric_data.json"
-    rewrite_chart(
-        rows, n_days, resample_freq,
-        filename=f"homesweetpi/static/{chart_filename}"
-    )
-    context = dict(
-        sub_title=f"Readings for the last {n_days} days",
-        chart_filename=f"\"static/{chart_filename}\""
-    )
-    return render_template('charts.html', **context)
+    return render_chart_page("air")
 
 
 @app.route('/plant_charts')
 def plant_charts():
     """
-    Update Altair chart of soil moisture readings and pass as context to chart
-    page
+    Chart page for soil moisture readings
     """
     LOG.info("Plant chart page triggered")
-    n_days = get_n_days_to_display()
-    resample_freq = '30T'
-    rows = [
-        "Soil Moisture Value", "Soil Moisture (V)"
-    ]
-    chart_filename = "altair_chart_soil_moisture_data.json"
-    rewrite_chart(
-        rows, n_days, resample_freq,
-        filename=f"homesweetpi/static/{chart_filename}"
-    )
-    context = dict(
-        sub_title=f"Readings for the last {n_days} days",
-        chart_filename=f"\"static/{chart_filename}\""
-    )
-    return render_template('charts.html', **context)
+    return render_chart_page("plant")
 
 
 api.add_resource(GetLast, '/get_last')
+api.add_resource(CacheStats, '/debug/cache_stats')
+api.add_resource(Ingest, '/ingest')
 
 if __name__ == '__main__':
     LOG.debug("Running api_server as __main__")
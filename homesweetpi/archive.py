@@ -0,0 +1,155 @@
+"""
+Columnar on-disk archive of historical measurements.
+
+Closed months are exported from the measurements table into one compressed
+numpy (npz) file per sensor and month, holding one array per column. Each
+month is written to a temporary directory that is renamed into place once
+complete, so a month is either fully archived or not at all. Queries for
+long time ranges read archived months from these files and only the
+remainder from the db.
+"""
+import os
+import shutil
+import logging
+import numpy as np
+import pandas as pd
+
+LOG = logging.getLogger("homesweetpi.archive")
+
+ARCHIVE_DIR = os.getenv("HSP_ARCHIVE_DIR")
+
+
+def month_start(datetime_):
+    """
+    Return the start of the month containing datetime_ as a Timestamp
+    """
+    return pd.Timestamp(datetime_).to_period("M").to_timestamp()
+
+
+class MeasurementArchive():
+    """
+    Directory of archived measurements with a subdirectory per month
+    An archive without a directory is disabled and holds no months
+    """
+    def __init__(self, directory=ARCHIVE_DIR, datetime_col="datetime",
+                 logger_col="sensorid"):
+        self.directory = directory
+        self.datetime_col = datetime_col
+        self.logger_col = logger_col
+
+    def month_path(self, month):
+        """
+        Return the directory holding an archived month
+        """
+        return os.path.join(self.directory, f"{month:%Y-%m}")
+
+    def months(self):
+        """
+        Return the start of every archived month in order
+        """
+        if not self.directory or not os.path.isdir(self.directory):
+            return []
+        months = []
+        for name in os.listdir(self.directory):
+            try:
+                months.append(pd.Timestamp(pd.Period(name, freq="M")
+                                           .to_timestamp()))
+            except ValueError:
+                continue
+        return sorted(months)
+
+    def is_archived(self, month):
+        """
+        Return True if the month containing month has been archived
+        """
+        return os.path.isdir(self.month_path(month_start(month)))
+
+    def archived_until(self):
+        """
+        Return the end of the last archived month, or None if the archive is
+        empty. Readings before this time are read from the archive.
+        """
+        months = self.months()
+        if not months:
+            return None
+        return months[-1] + pd.offsets.MonthBegin()
+
+    def write_month(self, month, logs):
+        """
+        Archive the readings of one month, one npz file per sensor,
+        replacing the month if it has already been archived
+        Returns the number of readings archived
+        """
+        month = month_start(month)
+        path = self.month_path(month)
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for sensorid, readings in logs.groupby(self.logger_col):
+            readings = readings.sort_values(self.datetime_col)
+            columns = {col: readings[col].to_numpy() for col in
+                       readings.columns if col != self.logger_col}
+            columns[self.datetime_col] = readings[self.datetime_col]\
+                .to_numpy().astype("datetime64[ns]").view("int64")
+            filename = os.path.join(tmp_path, f"sensor_{sensorid}.npz")
+            with open(filename, "wb") as archive_file:
+                np.savez_compressed(archive_file, **columns)
+        old_path = f"{path}.old"
+        if os.path.isdir(path):
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        LOG.info("Archived %s readings from %s", len(logs), f"{month:%Y-%m}")
+        return len(logs)
+
+    def read_month(self, month, since_datetime=None, until_datetime=None,
+                   columns=None):
+        """
+        Return the archived readings of one month from since_datetime
+        onwards and before until_datetime as a dataframe sorted by time
+        """
+        path = self.month_path(month_start(month))
+        frames = []
+        for name in sorted(os.listdir(path)):
+            if not name.endswith(".npz"):
+                continue
+            sensorid = int(name[len("sensor_"):-len(".npz")])
+            with np.load(os.path.join(path, name)) as archive_file:
+                readings = {col: archive_file[col]
+                            for col in archive_file.files}
+            times = readings[self.datetime_col].view("datetime64[ns]")
+            readings[self.datetime_col] = times
+            readings[self.logger_col] = np.full(len(times), sensorid)
+            frames.append(pd.DataFrame(readings))
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        logs = pd.concat(frames, ignore_index=True)
+        if since_datetime is not None:
+            logs = logs[logs[self.datetime_col] >= since_datetime]
+        if until_datetime is not None:
+            logs = logs[logs[self.datetime_col] < until_datetime]
+        logs = logs.sort_values(self.datetime_col, kind="mergesort")\
+                   .reset_index(drop=True)
+        if columns is not None:
+            logs = logs.reindex(columns=columns)
+        return logs
+
+    def iter_since(self, since_datetime, until_datetime=None, columns=None):
+        """
+        Yield dataframes of the archived readings from since_datetime
+        onwards and before until_datetime, one per month in order of time
+        """
+        first = month_start(since_datetime)
+        for month in self.months():
+            if month < first:
+                continue
+            if until_datetime is not None and month >= until_datetime:
+                break
+            logs = self.read_month(month, since_datetime, until_datetime,
+                                   columns)
+            if not logs.empty:
+                yield logs
+
+
+ARCHIVE = MeasurementArchive()
@@ -0,0 +1,154 @@
+"""
+On-disk store for precomputed chart data.
+
+The retrieval service writes the data of the standard chart views to this
+store once per retrieval period when new readings have been saved, and the
+web server reads it instead of querying and resampling on page load.
+Artifact names include the data watermark they were built from. Pis are
+polled at different times, so the watermark usually moves on before the
+next precompute; the web server then serves the newest artifact of the
+view as long as it lags the data by no more than HSP_CHART_ARTIFACT_MAX_LAG
+seconds. Files are written atomically so a reader never sees a partial one.
+"""
+import os
+import logging
+import threading
+from datetime import datetime
+import pandas as pd
+
+LOG = logging.getLogger("homesweetpi.chart_artifacts")
+
+ARTIFACT_DIR = os.getenv("HSP_CHART_ARTIFACT_DIR",
+                         default="homesweetpi/static/charts")
+ARTIFACT_MAX_LAG = float(os.getenv("HSP_CHART_ARTIFACT_MAX_LAG",
+                                   default="600"))
+WATERMARK_FORMAT = "%Y%m%dT%H%M%S%f"
+
+
+def watermark_tag(watermark):
+    """
+    Return a string identifying a data watermark in file names
+    """
+    if watermark is None:
+        return "empty"
+    return pd.Timestamp(watermark).strftime(WATERMARK_FORMAT)
+
+
+def artifact_affixes(view, n_days, resample_freq, data_format, compress):
+    """
+    Return the parts of the file name of the chart data for a view, range
+    and format that come before and after the data watermark
+    """
+    suffix = f".{data_format}"
+    if compress:
+        suffix += ".gz"
+    return f"{view}_{n_days}d_{resample_freq}_", suffix
+
+
+def artifact_name(view, n_days, resample_freq, data_format, compress,
+                  watermark):
+    """
+    Return the file name of the chart data for a view, range, format and
+    data watermark
+    """
+    prefix, suffix = artifact_affixes(view, n_days, resample_freq,
+                                      data_format, compress)
+    return f"{prefix}{watermark_tag(watermark)}{suffix}"
+
+
+class ChartArtifactStore():
+    """
+    Directory of precomputed chart data files
+    A store without a directory is disabled: nothing is written and every
+    read misses
+    """
+    def __init__(self, directory=ARTIFACT_DIR):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.lock = threading.Lock()
+
+    def path(self, name):
+        """
+        Return the path of an artifact in the store
+        """
+        return os.path.join(self.directory, name)
+
+    def read(self, name):
+        """
+        Return the contents of an artifact, or None if it does not exist
+        """
+        if not self.directory:
+            return None
+        try:
+            with open(self.path(name), "rb") as artifact:
+                payload = artifact.read()
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return payload
+
+    def latest(self, view, n_days, resample_freq, data_format, compress):
+        """
+        Return the name and data watermark of the newest artifact for a
+        view, range and format, or (None, None) if there is none
+        """
+        if not self.directory or not os.path.isdir(self.directory):
+            return None, None
+        prefix, suffix = artifact_affixes(view, n_days, resample_freq,
+                                          data_format, compress)
+        newest, newest_watermark = None, None
+        for name in os.listdir(self.directory):
+            if not (name.startswith(prefix) and name.endswith(suffix)):
+                continue
+            try:
+                watermark = datetime.strptime(
+                    name[len(prefix):-len(suffix)], WATERMARK_FORMAT)
+            except ValueError:
+                continue
+            if newest_watermark is None or watermark > newest_watermark:
+                newest, newest_watermark = name, watermark
+        return newest, newest_watermark
+
+    def write(self, name, payload):
+        """
+        Atomically write an artifact to the store
+        """
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self.path(name)}.tmp"
+        with open(tmp_path, "wb") as artifact:
+            artifact.write(payload)
+        os.replace(tmp_path, self.path(name))
+        with self.lock:
+            self.writes += 1
+        LOG.debug("Wrote chart artifact %s", name)
+
+    def prune(self, keep):
+        """
+        Remove all artifacts whose names are not in keep
+        """
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name not in keep and not name.endswith(".tmp"):
+                LOG.debug("Removing stale chart artifact %s", name)
+                try:
+                    os.remove(self.path(name))
+                except OSError:
+                    LOG.warning("Could not remove chart artifact %s", name)
+
+    def stats(self):
+        """
+        Return a dictionary of artifact hits, misses and writes
+        """
+        return dict(hits=self.hits, misses=self.misses, writes=self.writes,
+                    directory=self.directory)
+
+
+CHART_ARTIFACTS = ChartArtifactStore()
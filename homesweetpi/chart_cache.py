@@ -0,0 +1,85 @@
+"""
+In-memory cache for serialised charts.
+
+Entries are keyed by the chart parameters together with the time of the
+latest ingested reading, so a cached chart is reused until new data
+arrives. The least recently used entries are evicted once either the
+number of entries or their total size exceeds its limit.
+"""
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+LOG = logging.getLogger("homesweetpi.chart_cache")
+
+MAX_ENTRIES = int(os.getenv("HSP_CHART_CACHE_ENTRIES", default="32"))
+MAX_BYTES = int(os.getenv("HSP_CHART_CACHE_BYTES", default=str(64 * 2**20)))
+
+
+class ChartCache():
+    """
+    LRU cache of serialised charts bounded by entry count and total size
+    """
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached value for key, or None if it is not cached
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        """
+        Cache value under key, evicting least recently used entries to keep
+        within the limits. Values larger than the size limit are not cached.
+        """
+        value_size = len(value)
+        if value_size > self.max_bytes:
+            LOG.debug("Not caching %s bytes for %s", value_size, key)
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += value_size
+            while (len(self.entries) > self.max_entries
+                   or self.size > self.max_bytes):
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+                LOG.debug("Evicted chart %s from cache", evicted_key)
+
+    def clear(self):
+        """
+        Remove all entries
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Return a dictionary of cache hits, misses, evictions and size
+        """
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, entries=len(self.entries),
+                    bytes=self.size, max_entries=self.max_entries,
+                    max_bytes=self.max_bytes)
+
+
+CHART_CACHE = ChartCache()
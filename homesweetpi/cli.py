@@ -2,20 +2,59 @@
 import argparse
 import sys
 import logging
+from homesweetpi import log_to_console
 
 LOG = logging.getLogger("homesweetpi.cli")
 
 
-def main():
+def parse_args(args=None):
+    """Parse the command line arguments of the console script."""
+    parser = argparse.ArgumentParser(prog="homesweetpi")
+    parser.add_argument('--log-level', default="INFO",
+                        help="logging level, e.g. DEBUG or INFO")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser('retrieve',
+                        help="retrieve new data from every pi once")
+    commands.add_parser('migrate',
+                        help="create missing tables and bring existing "
+                             "ones up to date")
+    daemon = commands.add_parser(
+        'daemon', help="keep retrieving data from the pis until stopped")
+    daemon.add_argument('--freq', type=float, default=None,
+                        help="seconds between polls of each pi")
+    daemon.add_argument('--jitter', type=float, default=None,
+                        help="maximum delay in seconds added to each poll")
+    daemon.add_argument('--refresh', type=float, default=None,
+                        help="seconds between reloads of the list of pis")
+    daemon.add_argument('--workers', type=int, default=None,
+                        help="maximum number of pis polled at the same time")
+    return parser, parser.parse_args(args)
+
+
+def main(args=None):
     """Console script for homesweetpi."""
     LOG.debug("Running CLI main script")
-    parser = argparse.ArgumentParser()
-    parser.add_argument('_', nargs='*')
-    args = parser.parse_args()
-
-    print("Arguments: " + str(args._))
-    print("Replace this message by putting your code into "
-          "homesweetpi.cli.main")
+    parser, args = parse_args(args)
+    log_to_console(args.log_level.upper())
+    # the data retrieval modules connect to the db on import, so they are
+    # only imported once a command needs them
+    if args.command == "retrieve":
+        from homesweetpi.retrieve_data import retrieve_data, get_pi_ids
+        retrieve_data(pi_ids=get_pi_ids())
+    elif args.command == "migrate":
+        from homesweetpi.sql_tables import create_tables,\
+                                           migrate_measurements
+        create_tables()
+        migrate_measurements()
+    elif args.command == "daemon":
+        from homesweetpi.daemon import run_daemon
+        options = dict(freq=args.freq, jitter=args.jitter,
+                       refresh_seconds=args.refresh,
+                       max_workers=args.workers)
+        run_daemon(**{name: value for name, value in options.items()
+                      if value is not None})
+    else:
+        parser.print_help()
     return 0
 
 
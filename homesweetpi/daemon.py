@@ -0,0 +1,253 @@
+"""
+Long-running data retrieval service.
+
+Every pi is polled on its own fixed-rate schedule: the next poll of a pi is
+due one period after the previous one was due, not after it finished, so
+the schedule does not drift however long polls take. Pis start at a random
+phase within the period and each poll fires up to jitter seconds late, so
+polls are spread out instead of hitting the db all at once. The list of
+pis is reloaded periodically, and SIGTERM stops the daemon after the polls
+in progress have finished and buffered readings have been saved.
+
+    homesweetpi daemon
+"""
+import os
+import time
+import heapq
+import random
+import signal
+import logging
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import sqlalchemy
+from homesweetpi import log_to_console
+from homesweetpi.sql_tables import SESSION, ENGINE, get_pi_ids,\
+                                   ensure_partitions
+from homesweetpi.http_client import HTTP_CLIENT, DEFAULT_TIMEOUT
+from homesweetpi.watermarks import WATERMARKS
+from homesweetpi.ingest_buffer import USE_INGEST_BUFFER
+from homesweetpi.retrieve_data import MAX_WORKERS, INGEST_BUFFER,\
+                                      timed_poll_pi, refresh_charts
+
+LOG = logging.getLogger("homesweetpi.daemon")
+
+RETRIEVAL_FREQ = float(os.getenv("HSP_RETRIEVAL_FREQ", default="300"))
+RETRIEVAL_JITTER = float(os.getenv("HSP_RETRIEVAL_JITTER", default="10"))
+PI_REFRESH_SECONDS = float(os.getenv("HSP_PI_REFRESH_SECONDS",
+                                     default="3600"))
+PI_RETRY_SECONDS = 30
+
+
+def next_due(due, period, now):
+    """
+    Return the first time after now on the fixed-rate schedule that
+    includes due, skipping any periods that were missed entirely
+    """
+    missed = max(0, int((now - due) // period))
+    return due + (missed + 1) * period
+
+
+class RetrievalDaemon():
+    """
+    Scheduler polling each pi every freq seconds in a pool of up to
+    max_workers threads, reloading the list of pis every refresh_seconds
+    and precomputing the charts at most once per period when new readings
+    have been saved
+    """
+    # pylint: disable=R0902,R0913
+    def __init__(self, freq=RETRIEVAL_FREQ, jitter=RETRIEVAL_JITTER,
+                 refresh_seconds=PI_REFRESH_SECONDS, max_workers=MAX_WORKERS,
+                 session_factory=SESSION, engine=ENGINE, port=5003,
+                 timeout=DEFAULT_TIMEOUT, client=HTTP_CLIENT,
+                 watermarks=WATERMARKS, buffer=None, poll=timed_poll_pi,
+                 list_pis=get_pi_ids, clock=time.monotonic, seed=None):
+        self.freq = freq
+        self.jitter = jitter
+        self.refresh_seconds = refresh_seconds
+        self.max_workers = max_workers
+        self.session_factory = session_factory
+        self.engine = engine
+        self.client = client
+        self.buffer = buffer
+        self.poll = partial(poll, session_factory=session_factory,
+                            engine=engine, port=port, timeout=timeout,
+                            client=client, watermarks=watermarks,
+                            buffer=buffer)
+        self.list_pis = list_pis
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.schedule = []
+        self.next_poll = {}
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.executor = None
+        self.next_refresh = None
+        self.next_charts = None
+        self.charts_stale = False
+        self.buffered_inserted = 0
+
+    def schedule_pi(self, piid, due):
+        """
+        Schedule the next poll of a pi, due at due and fired up to jitter
+        seconds later
+        """
+        self.next_poll[piid] = due
+        fire = due + self.random.uniform(0, self.jitter)
+        heapq.heappush(self.schedule, (fire, due, piid))
+
+    def refresh_pis(self, now):
+        """
+        Reload the list of pis, scheduling new pis at a random phase within
+        the period and dropping pis that have been removed
+        Also makes sure the measurements table has partitions for new months
+        Returns False if the list of pis could not be loaded
+        """
+        try:
+            ensure_partitions(self.engine)
+        except sqlalchemy.exc.SQLAlchemyError:
+            LOG.exception("Creating measurement partitions failed")
+        session = self.session_factory()
+        try:
+            pi_ids = set(self.list_pis(session=session))
+        except sqlalchemy.exc.SQLAlchemyError:
+            LOG.exception("Reloading the list of pis failed")
+            return False
+        finally:
+            session.close()
+        added = pi_ids - set(self.next_poll)
+        removed = set(self.next_poll) - pi_ids
+        for piid in removed:
+            del self.next_poll[piid]
+        for piid in sorted(added):
+            self.schedule_pi(piid, now + self.random.uniform(0, self.freq))
+        if added or removed:
+            LOG.info("Polling %s pis, added %s, removed %s",
+                     len(self.next_poll), sorted(added), sorted(removed))
+        return True
+
+    def poll_due(self, now):
+        """
+        Start a poll of every pi that is due, unless the previous poll of
+        the pi is still running, and schedule its next poll
+        """
+        while self.schedule and self.schedule[0][0] <= now:
+            _, due, piid = heapq.heappop(self.schedule)
+            if self.next_poll.get(piid) != due:
+                continue
+            self.schedule_pi(piid, next_due(due, self.freq, now))
+            with self.lock:
+                if piid in self.in_flight:
+                    LOG.warning("Previous poll of pi %s still running, "
+                                "skipping", piid)
+                    continue
+                self.in_flight.add(piid)
+            future = self.executor.submit(self.poll, piid)
+            future.add_done_callback(partial(self.poll_done, piid))
+
+    def poll_done(self, piid, future):
+        """
+        Record the result of a finished poll
+        """
+        result = future.result()
+        with self.lock:
+            self.in_flight.discard(piid)
+            if result.inserted:
+                self.charts_stale = True
+        LOG.info("pi %s: %s, %s rows fetched, %s inserted in %.2f s",
+                 result.piid, result.outcome, result.rows, result.inserted,
+                 result.latency)
+
+    def refresh_charts_if_due(self, now):
+        """
+        Precompute the charts once per period if new readings have been
+        saved since they were last computed
+        """
+        if now < self.next_charts:
+            return
+        self.next_charts = next_due(self.next_charts, self.freq, now)
+        with self.lock:
+            stale, self.charts_stale = self.charts_stale, False
+        if self.buffer is not None:
+            inserted = self.buffer.counts.inserted
+            stale = stale or inserted > self.buffered_inserted
+            self.buffered_inserted = inserted
+            LOG.info("ingest buffer: %s", self.buffer.metrics())
+        self.client.log_connection_stats()
+        if stale:
+            refresh_charts(self.session_factory)
+
+    def step(self):
+        """
+        Run everything that is due and return the number of seconds until
+        something is next due
+        """
+        now = self.clock()
+        if now >= self.next_refresh:
+            if self.refresh_pis(now) or self.next_poll:
+                self.next_refresh = next_due(self.next_refresh,
+                                             self.refresh_seconds, now)
+            else:
+                LOG.warning("No pis to poll, retrying in %s s",
+                            PI_RETRY_SECONDS)
+                self.next_refresh = now + min(PI_RETRY_SECONDS,
+                                              self.refresh_seconds)
+        self.poll_due(now)
+        self.refresh_charts_if_due(now)
+        upcoming = [self.next_refresh, self.next_charts]
+        if self.schedule:
+            upcoming.append(self.schedule[0][0])
+        return max(0, min(upcoming) - self.clock())
+
+    def stop(self, signum=None, frame=None):
+        """
+        Ask the daemon to shut down, e.g. from a signal handler
+        """
+        # pylint: disable=W0613
+        LOG.info("Stopping data retrieval daemon (signal %s)", signum)
+        self.stopping.set()
+
+    def run(self):
+        """
+        Poll the pis until stopped, then wait for the polls in progress,
+        save any buffered readings and close the connections to the pis
+        SIGTERM and SIGINT stop the daemon when run in the main thread
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        LOG.info("Starting data retrieval daemon, polling every %s s",
+                 self.freq)
+        if self.buffer is not None:
+            self.buffer.start()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                           thread_name_prefix="poll")
+        now = self.clock()
+        self.next_refresh = now
+        self.next_charts = now + self.freq
+        try:
+            while not self.stopping.is_set():
+                self.stopping.wait(self.step())
+        finally:
+            self.executor.shutdown(wait=True)
+            if self.buffer is not None:
+                self.buffer.close()
+            self.client.close()
+            LOG.info("Data retrieval daemon stopped")
+
+
+def run_daemon(freq=RETRIEVAL_FREQ, jitter=RETRIEVAL_JITTER,
+               refresh_seconds=PI_REFRESH_SECONDS, max_workers=MAX_WORKERS):
+    """
+    Run the data retrieval daemon until it is stopped, buffering readings
+    if HSP_INGEST_BUFFER is set to 1
+    """
+    buffer = INGEST_BUFFER if USE_INGEST_BUFFER else None
+    RetrievalDaemon(freq, jitter, refresh_seconds, max_workers,
+                    buffer=buffer).run()
+
+
+if __name__ == "__main__":
+    log_to_console(logging.INFO)
+    run_daemon()
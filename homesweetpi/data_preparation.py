@@ -1,17 +1,46 @@
 """
 Module to retrieve data from the PostGresDB at a specified frequency
 """
+import os
 import json
+import gzip
 import logging
+from functools import lru_cache
 import pandas as pd
 import altair as alt
-from homesweetpi.sql_tables import (get_last_n_days, resample_measurements,
-                                    get_last_measurement_for_sensor,
-                                    get_all_sensors, get_sensors_and_pis,
+from homesweetpi.rollups import get_chart_measurements, get_chart_extremes
+from homesweetpi.chart_cache import CHART_CACHE
+from homesweetpi.downsampling import minmax_downsample, points_for_width,\
+                                     expand_extremes
+from homesweetpi.chart_artifacts import CHART_ARTIFACTS, ARTIFACT_MAX_LAG,\
+                                        artifact_name
+from homesweetpi.sql_tables import (get_latest_readings, get_data_watermark,
+                                    SENSOR_CACHE, SESSION,
                                     Measurement)
 
 LOG = logging.getLogger("homesweetpi.data_preparation")
 
+RESAMPLE_FREQ = '30T'
+CHART_WIDTH = 600
+CHART_HEIGHT = 200
+CHART_POINTS = points_for_width(CHART_WIDTH)
+AIR_ROWS = [
+    "Temperature (°C)", 'Relative Humidity (%)',
+    'Pressure (hPa)', 'Gas Resistance (Ω)',
+]
+PLANT_ROWS = [
+    "Soil Moisture Value", "Soil Moisture (V)"
+]
+CHART_VIEWS = {
+    "all": tuple(AIR_ROWS + PLANT_ROWS),
+    "air": tuple(AIR_ROWS),
+    "plant": tuple(PLANT_ROWS),
+}
+PRECOMPUTE_DAYS = tuple(
+    int(n_days) for n_days in
+    os.getenv("HSP_PRECOMPUTE_DAYS", default="7").split(",")
+)
+
 
 def create_selection(datetime_col="Time"):
     """
@@ -141,35 +170,175 @@ def create_altair_plot(source, rows, datetime_col='Time',
         text=create_text(lines, nearest),
         rules=create_rules(source, nearest, datetime_col),
     )
-    chart = create_chart(chart_components, rows, 600, 200
+    chart = create_chart(chart_components, rows, CHART_WIDTH, CHART_HEIGHT
                          ).properties(title=title)
     chart = format_chart(chart)
     return chart
 
 
-def prepare_chart_data(logs, resample_freq='30T'):
+def label_chart_data(source, session=SESSION()):
     """
-    Prepare the data for creation of the Altair plot
+    Round resampled readings and label them with sensor locations and
+    presentation column names for the Altair plot
     """
-    LOG.debug("Preparing data for Altair Chart")
-    source = resample_measurements(logs, resample_freq).round(1)
-    lookup = get_sensors_and_pis().set_index("sensorid")['location']
-    source['sensorid'] = source['sensorid'].apply(lookup.get)
+    LOG.debug("Labelling data for Altair Chart")
+    source = source.round(1)
+    sensors = SENSOR_CACHE.sensors_and_pis(session=session)
+    lookup = sensors.set_index("sensorid")['location']
+    source['sensorid'] = source['sensorid'].map(lookup)
     source = source.rename(columns=Measurement().get_fancy_names_dict())
     return source
 
 
-def rewrite_chart(rows, n_days=5, resample_freq='30T',
-                  filename="homesweetpi/static/altair_chart_recent_data.json"):
+def get_chart_layout(rows, data_url, title="HomeSweetPi Data"):
+    """
+    Return the json spec of an altair chart that loads its data as csv from
+    data_url. The spec does not depend on the data, so it is built once per
+    set of arguments.
+    rows must be a tuple of presentation column names
+    """
+    return create_chart_layout(tuple(rows), data_url, title)
+
+
+@lru_cache(maxsize=32)
+def create_chart_layout(rows, data_url, title):
+    """
+    Create the json spec for get_chart_layout
+    """
+    LOG.debug("Creating Altair Chart layout for %s", data_url)
+    parse = {"Time": "date"}
+    parse.update({row: "number" for row in rows})
+    source = alt.UrlData(url=data_url, format={"type": "csv", "parse": parse})
+    chart = create_altair_plot(source, list(rows), title=title)
+    return chart.to_json()
+
+
+def chart_data_payload(source, data_format="csv"):
+    """
+    Serialise labelled chart data as csv or as json with one list per
+    column
+    Returns bytes
+    """
+    source = source.copy()
+    source["Time"] = pd.to_datetime(source["Time"])\
+                       .dt.strftime("%Y-%m-%dT%H:%M:%S")
+    if data_format == "csv":
+        return source.to_csv(index=False).encode()
+    columns = source.astype(object).where(source.notnull(), None)\
+                    .to_dict(orient="list")
+    return json.dumps(columns).encode()
+
+
+def get_chart_source(n_days=5, resample_freq='30T', session=SESSION(),
+                     max_points=CHART_POINTS):
+    """
+    Return the labelled chart data for the last n days, resampled into
+    buckets of length resample_freq
+    Each bucket is drawn as the minimum and maximum of its raw readings
+    where they are still available, and series longer than max_points are
+    reduced to their min/max envelope
+    """
+    source = get_chart_measurements(n_days, resample_freq, session)
+    if source is None:
+        source = pd.DataFrame(columns=["sensorid", "datetime"])
+    else:
+        extremes = get_chart_extremes(n_days, resample_freq, session)
+        source = expand_extremes(source, extremes, resample_freq)
+    source = minmax_downsample(source, max_points)
+    return label_chart_data(source, session)
+
+
+def view_payload(source, rows, data_format="csv", compress=False):
+    """
+    Serialise the columns of labelled chart data needed for the chart rows
+    Returns bytes, gzip-compressed if compress is True
+    """
+    columns = ["Time", "Location"] + [row for row in rows
+                                      if row in source.columns]
+    payload = chart_data_payload(source[columns], data_format)
+    if compress:
+        payload = gzip.compress(payload)
+    return payload
+
+
+def chart_data_watermark(view, n_days, resample_freq='30T',
+                         data_format="csv", compress=False, watermark=None,
+                         session=SESSION(), store=CHART_ARTIFACTS):
+    """
+    Return the data watermark of the chart data to serve for a view: the
+    watermark of the data, queried if not given, unless the newest artifact
+    precomputed for the view is older but lags it by no more than
+    ARTIFACT_MAX_LAG seconds, in which case the artifact's watermark
+    Passing the result to get_chart_data serves that artifact.
+    """
+    if watermark is None:
+        watermark = get_data_watermark(session)
+    if watermark is None:
+        return None
+    _, latest = store.latest(view, n_days, resample_freq, data_format,
+                             compress)
+    if latest is None or latest >= watermark:
+        return watermark
+    lag = pd.Timestamp(watermark) - pd.Timestamp(latest)
+    if lag > pd.Timedelta(seconds=ARTIFACT_MAX_LAG):
+        return watermark
+    return latest
+
+
+def get_chart_data(rows, n_days=5, resample_freq='30T', data_format="csv",
+                   compress=False, session=SESSION(), cache=CHART_CACHE,
+                   watermark=None, store=None, view=None):
+    """
+    Return the resampled data from the last n days for the chart rows as
+    csv or columnar json bytes, gzip-compressed if compress is True
+    The data is served from cache, or for a named view from the artifact
+    store, unless new data has arrived since it was created. watermark is
+    queried if not given.
+    """
+    if watermark is None:
+        watermark = get_data_watermark(session)
+    key = ("data", tuple(rows), n_days, resample_freq, data_format, compress,
+           watermark)
+    payload = cache.get(key)
+    if payload is not None:
+        return payload
+    if store is not None and view is not None:
+        payload = store.read(artifact_name(view, n_days, resample_freq,
+                                           data_format, compress, watermark))
+    if payload is None:
+        LOG.debug("Creating chart data for %s", key)
+        source = get_chart_source(n_days, resample_freq, session)
+        payload = view_payload(source, rows, data_format, compress)
+    cache.put(key, payload)
+    return payload
+
+
+def precompute_charts(ranges=PRECOMPUTE_DAYS, resample_freq=RESAMPLE_FREQ,
+                      session=SESSION(), store=CHART_ARTIFACTS,
+                      watermark=None):
     """
-    create an altair chart with data from the last n days and save as json
+    Write the data of every chart view for each number of days in ranges to
+    the artifact store, as plain and gzip-compressed csv, and remove the
+    artifacts of older data
+    The readings for each range are queried once and shared by the views.
+    Returns the names of the artifacts written
     """
-    LOG.debug("Rewriting Altair Chart object")
-    title = f"Readings from the last {n_days} days:"
-    logs = get_last_n_days(n_days)
-    source = prepare_chart_data(logs, resample_freq)
-    chart = create_altair_plot(source, rows, title=title)
-    chart.save(filename)
+    if watermark is None:
+        watermark = get_data_watermark(session)
+    names = set()
+    for n_days in ranges:
+        source = get_chart_source(n_days, resample_freq, session)
+        for view, rows in CHART_VIEWS.items():
+            for compress in (False, True):
+                name = artifact_name(view, n_days, resample_freq, "csv",
+                                     compress, watermark)
+                store.write(name, view_payload(source, rows, "csv",
+                                               compress))
+                names.add(name)
+    store.prune(names)
+    LOG.info("Precomputed %s chart artifacts for data up to %s",
+             len(names), watermark)
+    return names
 
 
 def get_most_recent_readings(current_only=False):
@@ -178,10 +347,10 @@ def get_most_recent_readings(current_only=False):
     """
     LOG.debug("Requesting most recent readings")
     recent_readings = {}
-    for sensor in get_all_sensors(current_only=current_only):
-        measurement = get_last_measurement_for_sensor(sensor)
+    for measurement in get_latest_readings(current_only=current_only):
         measurement.pop("datetime")
-        recent_readings[sensor] = measurement
+        recent_readings[str(measurement["sensorid"])] = measurement
+    recent_readings = dict(sorted(recent_readings.items()))
     return json.dumps(recent_readings)
 
 
@@ -0,0 +1,118 @@
+"""
+Module for reducing chart data to a bounded number of points per series.
+
+Long time ranges hold far more readings per sensor than a chart has pixels,
+so each series is split into buckets of consecutive readings and every
+bucket is replaced by its minimum and maximum. Unlike averaging, this
+min/max envelope keeps short spikes visible however long the range is.
+Chart data averaged into time buckets is first expanded into the minimum
+and maximum of the raw readings in each bucket, so spikes shorter than a
+bucket are not smeared out before the envelope is taken.
+"""
+import logging
+import numpy as np
+import pandas as pd
+
+LOG = logging.getLogger("homesweetpi.downsampling")
+
+
+def points_for_width(width, points_per_pixel=2):
+    """
+    Return the number of points per series needed to draw a chart of the
+    given width in pixels
+    """
+    return int(width * points_per_pixel)
+
+
+def expand_extremes(source, extremes, resample_freq, datetime_col="datetime",
+                    logger_col="sensorid"):
+    """
+    Replace each bucket of averaged readings in source by two rows holding
+    the minimum and the maximum of each column over the bucket, taken from
+    the columns with suffixes _min and _max in extremes
+    The minimum is placed at the start of the bucket and the maximum half
+    way through it. Buckets missing from extremes keep their averages.
+    return a new dataframe sorted by logger_col and datetime_col
+    """
+    if extremes is None or extremes.empty:
+        return source
+    keys = [logger_col, datetime_col]
+    value_cols = [col for col in source.columns if col not in keys]
+    half = pd.tseries.frequencies.to_offset(resample_freq).delta / 2
+    frames = []
+    for suffix, shift in (("_min", pd.Timedelta(0)), ("_max", half)):
+        frame = extremes[keys + [col + suffix for col in value_cols]]
+        frame.columns = keys + value_cols
+        frame = frame.assign(**{datetime_col: frame[datetime_col] + shift})
+        frames.append(frame)
+    covered = pd.MultiIndex.from_frame(extremes[keys])
+    averaged = source[~pd.MultiIndex.from_frame(source[keys])
+                      .isin(covered)]
+    expanded = pd.concat([averaged] + frames, ignore_index=True)
+    expanded = expanded.sort_values(keys, kind="mergesort")
+    return expanded[source.columns].reset_index(drop=True)
+
+
+def minmax_downsample(source, max_points, datetime_col="datetime",
+                      logger_col="sensorid"):
+    """
+    Reduce every series in source with more than max_points readings to a
+    min/max envelope of at most max_points readings
+    Each bucket of consecutive readings becomes two rows at its first and
+    last time, holding the minimum and maximum of each column in the order
+    in which they occurred. Series with fewer readings are returned as they
+    are.
+    return a new dataframe sorted by logger_col and datetime_col
+    """
+    if source is None or source.empty:
+        return source
+    source = source.sort_values([logger_col, datetime_col], kind="mergesort")\
+                   .reset_index(drop=True)
+    n_rows = len(source)
+    loggers = source[logger_col].to_numpy()
+    _, starts, counts = np.unique(loggers, return_index=True,
+                                  return_counts=True)
+    if counts.max() <= max_points:
+        return source
+    LOG.debug("Downsampling %s readings to %s points per series", n_rows,
+              max_points)
+    n_buckets = np.where(counts > max_points, max(max_points // 2, 1), counts)
+    position = np.arange(n_rows) - np.repeat(starts, counts)
+    bucket = position * np.repeat(n_buckets, counts) // np.repeat(counts,
+                                                                  counts)
+    new_bucket = np.ones(n_rows, dtype=bool)
+    new_bucket[1:] = (loggers[1:] != loggers[:-1]) | (bucket[1:]
+                                                      != bucket[:-1])
+    bucket_starts = np.flatnonzero(new_bucket)
+    bucket_ends = np.append(bucket_starts[1:], n_rows) - 1
+    bucket_sizes = bucket_ends - bucket_starts + 1
+
+    value_cols = [col for col in source.columns
+                  if col not in (logger_col, datetime_col)]
+    values = source[value_cols].to_numpy(dtype=float)
+    mins = np.fmin.reduceat(values, bucket_starts, axis=0)
+    maxs = np.fmax.reduceat(values, bucket_starts, axis=0)
+    index = np.broadcast_to(np.arange(n_rows)[:, None], values.shape)
+    first_min = np.minimum.reduceat(
+        np.where(values == np.repeat(mins, bucket_sizes, axis=0), index,
+                 n_rows),
+        bucket_starts, axis=0)
+    first_max = np.minimum.reduceat(
+        np.where(values == np.repeat(maxs, bucket_sizes, axis=0), index,
+                 n_rows),
+        bucket_starts, axis=0)
+    min_first = first_min <= first_max
+
+    times = source[datetime_col].to_numpy()
+    pairs = bucket_sizes > 1
+    first = pd.DataFrame(np.where(min_first, mins, maxs), columns=value_cols)
+    first[datetime_col] = times[bucket_starts]
+    first[logger_col] = loggers[bucket_starts]
+    second = pd.DataFrame(np.where(min_first, maxs, mins)[pairs],
+                          columns=value_cols)
+    second[datetime_col] = times[bucket_ends[pairs]]
+    second[logger_col] = loggers[bucket_ends[pairs]]
+    order = np.concatenate([bucket_starts, bucket_ends[pairs]])
+    envelope = pd.concat([first, second], ignore_index=True)
+    envelope = envelope.iloc[np.argsort(order, kind="mergesort")]
+    return envelope[source.columns].reset_index(drop=True)
@@ -0,0 +1,90 @@
+"""
+Pooled HTTP client for requests to the pi_logger apis.
+
+A single requests Session is kept for the lifetime of the process so that
+keep-alive connections to each pi are reused between retrieval rounds
+instead of paying for a new TCP connection on every request.
+"""
+import os
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+LOG = logging.getLogger("homesweetpi.http_client")
+
+# (connect, read) timeouts in seconds for requests to the pi_logger api
+DEFAULT_TIMEOUT = (3.05, 30)
+POOL_SIZE = int(os.getenv("HSP_HTTP_POOL_SIZE", default="4"))
+RETRIES = int(os.getenv("HSP_HTTP_RETRIES", default="2"))
+BACKOFF_FACTOR = float(os.getenv("HSP_HTTP_BACKOFF", default="0.5"))
+
+
+class PiHttpClient():
+    """
+    Keep-alive HTTP client with a connection pool per pi, retries with
+    exponential backoff and a default timeout for every request
+    Failed connections and error responses are retried, but read timeouts
+    are not, so a pi that hangs costs at most one read timeout per request
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT, pool_size=POOL_SIZE,
+                 retries=RETRIES, backoff_factor=BACKOFF_FACTOR):
+        self.timeout = timeout
+        retry = Retry(total=retries, connect=retries, read=0,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=(500, 502, 503, 504),
+                      raise_on_status=False)
+        # pool_connections is the number of hosts (pis) to keep pools for,
+        # pool_maxsize the number of sockets kept open to each of them
+        self.adapter = HTTPAdapter(pool_connections=64,
+                                   pool_maxsize=pool_size,
+                                   max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+    def get(self, url, timeout=None, **kwargs):
+        """
+        Send a GET request over a pooled connection
+        """
+        timeout = self.timeout if timeout is None else timeout
+        return self.session.get(url, timeout=timeout, **kwargs)
+
+    def connection_stats(self):
+        """
+        Return a dictionary counting the requests sent, the new connections
+        opened and the requests that reused an already open connection
+        """
+        pools = self.adapter.poolmanager.pools
+        requests_sent = 0
+        new_connections = 0
+        for key in pools.keys():
+            pool = pools[key]
+            requests_sent += pool.num_requests
+            new_connections += pool.num_connections
+        return dict(
+            requests=requests_sent,
+            new_connections=new_connections,
+            reused_connections=max(requests_sent - new_connections, 0),
+            hosts=len(pools),
+        )
+
+    def log_connection_stats(self):
+        """
+        Log the connection reuse counters
+        """
+        stats = self.connection_stats()
+        LOG.info("http connections: %s requests to %s hosts, %s new, "
+                 "%s reused", stats["requests"], stats["hosts"],
+                 stats["new_connections"], stats["reused_connections"])
+        return stats
+
+    def close(self):
+        """
+        Close all pooled connections
+        """
+        LOG.debug("Closing pooled http connections")
+        self.session.close()
+
+
+HTTP_CLIENT = PiHttpClient()
@@ -0,0 +1,206 @@
+"""
+Write-behind buffer for readings on their way to the db.
+
+Readings from many pis, whether polled or pushed, are queued in memory and
+saved together in one transaction once enough rows have built up or the
+oldest queued readings have waited long enough. The buffer holds a bounded
+number of rows: producers wait, or are turned away, while it is full and
+the db catches up. Each batch can register a callback that is told whether
+its readings were committed, so e.g. a pi's watermark only advances once
+its readings are safely in the db.
+"""
+import os
+import time
+import logging
+import threading
+import pandas as pd
+from homesweetpi.sql_tables import InsertCounts
+
+LOG = logging.getLogger("homesweetpi.ingest_buffer")
+
+USE_INGEST_BUFFER = os.getenv("HSP_INGEST_BUFFER", default="0") == "1"
+BUFFER_ROWS = int(os.getenv("HSP_INGEST_BUFFER_ROWS", default="5000"))
+BUFFER_SECONDS = float(os.getenv("HSP_INGEST_BUFFER_SECONDS", default="2"))
+BUFFER_CAPACITY = int(os.getenv("HSP_INGEST_BUFFER_CAPACITY",
+                                default="50000"))
+
+
+class IngestBuffer():
+    """
+    Bounded queue of dataframes of readings that are saved with save, a
+    function taking one dataframe and returning InsertCounts, in batches of
+    at least max_rows rows or after at most max_delay seconds
+    Without a running flush thread, batches are flushed by put once they
+    reach max_rows and otherwise only when flush is called
+    """
+    # pylint: disable=R0902
+    def __init__(self, save, max_rows=BUFFER_ROWS, max_delay=BUFFER_SECONDS,
+                 capacity=BUFFER_CAPACITY, datetime_col="datetime",
+                 logger_col="sensorid"):
+        self.save = save
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.capacity = max(capacity, max_rows)
+        self.key = [datetime_col, logger_col]
+        self.batches = []
+        self.rows = 0
+        self.in_flight = 0
+        self.oldest = None
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.flushes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.counts = InsertCounts(0, 0)
+        self.flush_seconds = []
+
+    def put(self, readings, on_flushed=None, timeout=None):
+        """
+        Queue a dataframe of processed readings to be saved
+        on_flushed is called with None once they have been committed, or
+        with the exception raised if saving them failed
+        Waits while the buffer is full for at most timeout seconds, forever
+        if timeout is None
+        Returns False if the readings could not be queued in time
+        """
+        n_rows = len(readings)
+        if not n_rows:
+            if on_flushed is not None:
+                on_flushed(None)
+            return True
+        if not self.running and not self.has_room(n_rows):
+            self.flush()
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.has_room(n_rows),
+                                           timeout):
+                self.rejected += 1
+                LOG.warning("Ingest buffer full, turned away %s rows",
+                            n_rows)
+                return False
+            self.batches.append((readings, on_flushed))
+            self.rows += n_rows
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            full = self.rows >= self.max_rows
+            self.condition.notify_all()
+        if full and not self.running:
+            self.flush()
+        return True
+
+    def has_room(self, n_rows):
+        """
+        Return True if n_rows more rows fit in the buffer. A batch larger
+        than the capacity is let in once the buffer is empty.
+        """
+        queued = self.rows + self.in_flight
+        return queued == 0 or queued + n_rows <= self.capacity
+
+    def due(self):
+        """
+        Return True if the queued readings should be flushed now
+        """
+        return (self.rows >= self.max_rows
+                or (self.oldest is not None
+                    and time.monotonic() - self.oldest >= self.max_delay))
+
+    def flush(self):
+        """
+        Save all queued readings in one transaction and tell their
+        producers whether they were committed
+        Returns the InsertCounts of the flush
+        """
+        with self.flush_lock:
+            with self.condition:
+                batches, self.batches = self.batches, []
+                self.in_flight, self.rows = self.rows, 0
+                self.oldest = None
+            if not batches:
+                return InsertCounts(0, 0)
+            readings = pd.concat([batch for batch, _ in batches],
+                                 ignore_index=True)
+            readings = readings.drop_duplicates(subset=self.key)
+            start = time.monotonic()
+            error = None
+            try:
+                counts = self.save(readings)
+            except Exception as exception:  # pylint: disable=W0703
+                LOG.exception("Saving %s buffered rows failed", len(readings))
+                error, counts = exception, InsertCounts(0, 0)
+            elapsed = time.monotonic() - start
+            with self.condition:
+                self.in_flight = 0
+                self.flushes += 1
+                self.failures += error is not None
+                self.counts = InsertCounts(
+                    self.counts.inserted + counts.inserted,
+                    self.counts.skipped + counts.skipped)
+                self.flush_seconds = (self.flush_seconds + [elapsed])[-100:]
+                self.condition.notify_all()
+            LOG.debug("Flushed %s rows from %s batches in %.3f s: %s",
+                      len(readings), len(batches), elapsed, counts)
+            for _, on_flushed in batches:
+                if on_flushed is not None:
+                    on_flushed(error)
+            return counts
+
+    def run(self):
+        """
+        Flush the buffer whenever enough rows are queued or the oldest
+        queued readings are due, until the buffer is closed
+        """
+        while True:
+            with self.condition:
+                while self.running and not self.due():
+                    wait = None
+                    if self.oldest is not None:
+                        wait = self.max_delay - (time.monotonic()
+                                                 - self.oldest)
+                    self.condition.wait(wait)
+                if not self.running:
+                    return
+            self.flush()
+
+    def start(self):
+        """
+        Start flushing the buffer in a background thread
+        """
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.run, name="ingest-buffer",
+                                       daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """
+        Stop the flush thread and save everything still queued
+        Returns the InsertCounts of the final flush
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self.flush()
+
+    def metrics(self):
+        """
+        Return a dictionary of the queue depth, flush counts and flush
+        latencies in seconds over the last 100 flushes
+        """
+        with self.condition:
+            latencies = list(self.flush_seconds)
+            return dict(
+                queued_rows=self.rows, queued_batches=len(self.batches),
+                in_flight_rows=self.in_flight, capacity=self.capacity,
+                flushes=self.flushes, failures=self.failures,
+                rejected=self.rejected, inserted=self.counts.inserted,
+                skipped=self.counts.skipped,
+                last_flush_seconds=latencies[-1] if latencies else None,
+                mean_flush_seconds=(sum(latencies) / len(latencies)
+                                    if latencies else None),
+                max_flush_seconds=max(latencies) if latencies else None)
@@ -0,0 +1,237 @@
+"""
+Maintenance jobs for the measurements table, intended to be run
+periodically, e.g. daily from cron:
+
+    python -m homesweetpi.maintenance
+
+Closed months are exported to the columnar archive and removed from the db,
+so the live table only holds recent readings. If a retention period is
+configured, raw readings older than it are then deleted, or thinned to one
+reading per sensor per interval, once the rollups or the archive hold them.
+"""
+import os
+import time
+import logging
+from datetime import datetime, timedelta
+import pandas as pd
+from sqlalchemy import func, select, tuple_, text
+from homesweetpi import log_to_console
+from homesweetpi.archive import ARCHIVE, month_start
+from homesweetpi.rollups import rollup_covers, retention_cutoff,\
+                                RETENTION_DAYS
+from homesweetpi.sql_tables import (Measurement, SESSION, ENGINE, ROLLUPS,
+                                    iter_measurements_since, is_partitioned,
+                                    freq_to_seconds)
+
+LOG = logging.getLogger("homesweetpi.maintenance")
+
+KEEP_MONTHS = int(os.getenv("HSP_ARCHIVE_KEEP_MONTHS", default="1"))
+RETENTION_MODE = os.getenv("HSP_RETENTION_MODE", default="delete")
+THIN_FREQ = os.getenv("HSP_THIN_FREQ", default="5T")
+BATCH_WINDOW = timedelta(
+    hours=float(os.getenv("HSP_RETENTION_BATCH_HOURS", default="6")))
+DELETE_CHUNK_SIZE = 400
+BATCH_PAUSE = float(os.getenv("HSP_RETENTION_BATCH_PAUSE", default="0.1"))
+
+
+def closed_months(session=SESSION(), keep_months=KEEP_MONTHS, now=None):
+    """
+    Return the start of every month with readings in the db that ended
+    more than keep_months months before the current month
+    """
+    first = session.query(func.min(Measurement.datetime)).scalar()
+    if first is None:
+        return []
+    now = datetime.now() if now is None else now
+    cutoff = month_start(now) - pd.DateOffset(months=keep_months)
+    return [month for month in
+            pd.date_range(month_start(first), cutoff, freq="MS")
+            if month < cutoff]
+
+
+def archive_month(month, session=SESSION(), engine=ENGINE, archive=ARCHIVE,
+                  delete=True):
+    """
+    Export the readings of one month from the db to the archive and, if
+    delete is True, remove them from the db
+    If the month has already been archived, readings that arrived late are
+    merged into it
+    Returns the number of readings archived
+    """
+    start = month_start(month).to_pydatetime()
+    end = (month_start(month) + pd.offsets.MonthBegin()).to_pydatetime()
+    chunks = list(iter_measurements_since(start, session, until_datetime=end,
+                                          archive=None))
+    if not chunks:
+        return 0
+    logs = pd.concat(chunks, ignore_index=True)
+    archived = len(logs)
+    if archive.is_archived(start):
+        LOG.info("Merging %s late readings into archived %s", archived,
+                 f"{start:%Y-%m}")
+        logs = pd.concat([archive.read_month(start, columns=logs.columns),
+                          logs], ignore_index=True)\
+                 .drop_duplicates(subset=["sensorid", "datetime"])
+    archive.write_month(start, logs)
+    if delete:
+        table = Measurement.__table__
+        with engine.begin() as connection:
+            connection.execute(table.delete()
+                               .where(table.c.datetime >= start)
+                               .where(table.c.datetime < end))
+    return archived
+
+
+def archive_closed_months(session=SESSION(), engine=ENGINE, archive=ARCHIVE,
+                          keep_months=KEEP_MONTHS, delete=True, now=None):
+    """
+    Archive every closed month of readings still in the db, including
+    readings that arrived after their month was archived
+    Returns a dictionary of the number of readings archived per month
+    """
+    if not archive.directory:
+        LOG.info("No archive directory configured, nothing archived")
+        return {}
+    archived = {}
+    for month in closed_months(session, keep_months, now):
+        readings = archive_month(month, session, engine, archive, delete)
+        if readings:
+            archived[f"{month:%Y-%m}"] = readings
+    return archived
+
+
+def measurements_size(engine=ENGINE):
+    """
+    Return a dictionary with the number of rows in the measurements table
+    and its size in bytes: table and indexes on PostGres (summed over the
+    partitions of a partitioned table), the whole db file on SQLite
+    """
+    with engine.connect() as connection:
+        rows = connection.execute(
+            select([func.count()]).select_from(Measurement.__table__)
+        ).scalar()
+        if engine.dialect.name == "postgresql":
+            if is_partitioned(engine):
+                relations = ("SELECT inhrelid AS relid FROM pg_inherits "
+                             "WHERE inhparent = 'measurements'::regclass")
+            else:
+                relations = "SELECT 'measurements'::regclass AS relid"
+            table_bytes, index_bytes = connection.execute(text(
+                "SELECT coalesce(sum(pg_table_size(relid)), 0), "
+                "coalesce(sum(pg_indexes_size(relid)), 0) "
+                f"FROM ({relations}) AS relations"
+            )).first()
+        else:
+            page_count = connection.execute(text("PRAGMA page_count")).scalar()
+            page_size = connection.execute(text("PRAGMA page_size")).scalar()
+            table_bytes, index_bytes = page_count * page_size, None
+    return dict(rows=rows, table_bytes=table_bytes, index_bytes=index_bytes)
+
+
+def removable_until(cutoff, session=SESSION(), archive=ARCHIVE):
+    """
+    Return the time before which raw readings older than cutoff can be
+    removed because every rollup covers them or the archive holds them, or
+    None if there are none that can be removed
+    """
+    oldest = session.query(func.min(Measurement.datetime)).scalar()
+    if oldest is None or oldest >= cutoff:
+        return None
+    if all(rollup_covers(table, oldest, session)
+           for table in ROLLUPS.values()):
+        return cutoff
+    archived_until = archive.archived_until()
+    if archived_until is not None and archived_until > oldest:
+        return min(cutoff, archived_until.to_pydatetime())
+    LOG.warning("Readings before %s are not in the rollups or the archive, "
+                "not removing them", cutoff)
+    return None
+
+
+def thinned_keys(keys, thin_freq=THIN_FREQ):
+    """
+    Return the (sensorid, datetime) keys to delete so that only the first
+    reading per sensor in each interval of length thin_freq is kept
+    """
+    times = pd.to_datetime(keys["datetime"])
+    bucket = times.dt.floor(f"{freq_to_seconds(thin_freq)}S")
+    duplicate = pd.DataFrame({"sensorid": keys["sensorid"], "bucket": bucket})\
+        .duplicated()
+    return keys[duplicate.to_numpy()]
+
+
+def remove_window(start, end, connection, mode="delete", thin_freq=THIN_FREQ):
+    """
+    Delete the raw readings from start to end, or with mode "thin" all but
+    the first reading per sensor in each interval of length thin_freq
+    Returns the number of rows removed
+    """
+    table = Measurement.__table__
+    in_window = (table.c.datetime >= start) & (table.c.datetime < end)
+    if mode == "delete":
+        return connection.execute(table.delete().where(in_window)).rowcount
+    keys = pd.DataFrame(connection.execute(
+        select([table.c.sensorid, table.c.datetime]).where(in_window)
+        .order_by(table.c.sensorid, table.c.datetime)
+    ).fetchall(), columns=["sensorid", "datetime"])
+    doomed = thinned_keys(keys, thin_freq)
+    if doomed.empty:
+        return 0
+    doomed = [(int(sensorid), datetime_.to_pydatetime())
+              for sensorid, datetime_ in
+              zip(doomed["sensorid"], pd.to_datetime(doomed["datetime"]))]
+    removed = 0
+    for i in range(0, len(doomed), DELETE_CHUNK_SIZE):
+        removed += connection.execute(table.delete().where(
+            tuple_(table.c.sensorid, table.c.datetime)
+            .in_(doomed[i:i + DELETE_CHUNK_SIZE])
+        )).rowcount
+    return removed
+
+
+def apply_retention(retention_days=RETENTION_DAYS, mode=RETENTION_MODE,
+                    thin_freq=THIN_FREQ, session=SESSION(), engine=ENGINE,
+                    archive=ARCHIVE, window=BATCH_WINDOW, pause=BATCH_PAUSE,
+                    vacuum=True, now=None):
+    """
+    Delete or thin (mode "delete" or "thin") raw readings older than
+    retention_days days, once they are held by the rollups or the archive
+    Rows are removed one time window at a time, each in its own short
+    transaction with a pause in between, so data retrieval is not blocked
+    Returns a dictionary of the rows removed and the size of the table
+    before and after
+    """
+    if retention_days is None:
+        LOG.info("No retention period configured, nothing removed")
+        return {}
+    if mode not in ("delete", "thin"):
+        raise ValueError(f"Unknown retention mode {mode}")
+    cutoff = retention_cutoff(retention_days, now)
+    report = dict(mode=mode, cutoff=cutoff, removed=0, batches=0,
+                  before=measurements_size(engine))
+    until = removable_until(cutoff, session, archive)
+    if until is not None:
+        start = session.query(func.min(Measurement.datetime)).scalar()
+        while start < until:
+            end = min(start + window, until)
+            with engine.begin() as connection:
+                report["removed"] += remove_window(start, end, connection,
+                                                   mode, thin_freq)
+            report["batches"] += 1
+            start = end
+            time.sleep(pause)
+        if vacuum and engine.dialect.name == "postgresql":
+            with engine.connect() as connection:
+                connection.execution_options(isolation_level="AUTOCOMMIT")\
+                          .execute(text("VACUUM ANALYZE measurements"))
+    report["after"] = measurements_size(engine)
+    LOG.info("Retention removed %s rows in %s batches, table size %s -> %s",
+             report["removed"], report["batches"], report["before"],
+             report["after"])
+    return report
+
+
+if __name__ == "__main__":
+    log_to_console(logging.INFO)
+    archive_closed_months()
+    apply_retention()
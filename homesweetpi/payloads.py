@@ -0,0 +1,127 @@
+"""
+Wire formats for readings sent from the pi_logger api to the collector.
+
+Pis have always sent a pandas orient="columns" json payload: a dictionary of
+columns, each a dictionary of values keyed by row number. Pis that support
+it can instead send a compact columnar payload, negotiated with the Accept
+header. Every column is a plain list, strings that repeat are sent once in
+a dictionary with a list of integer codes, strings that are the same on
+every row are sent once, and columns that are null on every row are only
+named. The payload is gzip-compressed json.
+"""
+import gzip
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+LOG = logging.getLogger("homesweetpi.payloads")
+
+JSON_MEDIA_TYPE = "application/json"
+COMPACT_MEDIA_TYPE = "application/vnd.homesweetpi.columnar+json"
+ACCEPT = f"{COMPACT_MEDIA_TYPE}, {JSON_MEDIA_TYPE};q=0.5"
+COMPACT_VERSION = 1
+
+
+def decode_payload(recent_data):
+    """
+    Decode a json payload from the pi_logger api
+    Accepts the raw response body, a json string or already decoded json.
+    Pis that encode the json twice are decoded again.
+    """
+    if isinstance(recent_data, bytes):
+        recent_data = recent_data.decode()
+    if isinstance(recent_data, str):
+        recent_data = json.loads(recent_data)
+    if isinstance(recent_data, str):
+        recent_data = json.loads(recent_data)
+    return recent_data
+
+
+def column_values(column, keys):
+    """
+    Return the values of a column in an orient="columns" payload in the
+    order of keys
+    """
+    values = list(column.values())
+    if list(column) != keys:
+        values = [column[key] for key in keys]
+    return values
+
+
+def payload_columns(payload):
+    """
+    Return a dictionary of equal length lists of values per column from a
+    decoded payload in either format
+    """
+    if not isinstance(payload.get('datetime'), dict):
+        return payload
+    keys = list(payload['datetime'])
+    return {col: column_values(column, keys)
+            for col, column in payload.items()}
+
+
+def encode_compact(readings, compress=True):
+    """
+    Encode a dataframe of readings in the compact columnar format
+    Datetimes are sent as milliseconds since the epoch
+    Returns bytes, gzip-compressed if compress is True
+    """
+    payload = dict(version=COMPACT_VERSION, rows=len(readings), columns={},
+                   constants={}, dictionaries={}, nulls=[])
+    for col in readings.columns:
+        values = readings[col]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            values = values.astype("int64") // 10**6
+        if values.isnull().all():
+            payload["nulls"].append(col)
+        elif values.dtype == object and values.nunique(dropna=False) == 1:
+            payload["constants"][col] = values.iloc[0]
+        elif values.dtype == object:
+            codes, uniques = pd.factorize(values)
+            payload["dictionaries"][col] = list(uniques)
+            payload["columns"][col] = codes.tolist()
+        else:
+            payload["columns"][col] = values.astype(object)\
+                .where(values.notnull(), None).tolist()
+    encoded = json.dumps(payload, separators=(",", ":")).encode()
+    if compress:
+        encoded = gzip.compress(encoded)
+    return encoded
+
+
+def decode_compact(content):
+    """
+    Decode a payload in the compact columnar format, gzip-compressed or not
+    Returns a dictionary of equal length lists of values per column
+    """
+    if content[:2] == b"\x1f\x8b":
+        content = gzip.decompress(content)
+    payload = json.loads(content)
+    version = payload.get("version")
+    if version != COMPACT_VERSION:
+        raise ValueError(f"Unsupported payload version {version}")
+    n_rows = payload["rows"]
+    columns = dict(payload["columns"])
+    for col, uniques in payload["dictionaries"].items():
+        uniques = np.array(uniques + [None], dtype=object)
+        columns[col] = uniques[columns[col]].tolist()
+    for col, value in payload["constants"].items():
+        columns[col] = [value] * n_rows
+    for col in payload["nulls"]:
+        columns[col] = [None] * n_rows
+    return columns
+
+
+def decode_response(response):
+    """
+    Decode the payload of a response from the pi_logger api according to
+    its content type, falling back to json
+    """
+    headers = getattr(response, "headers", None) or {}
+    content_type = headers.get("Content-Type", "")
+    if content_type.split(";")[0].strip() == COMPACT_MEDIA_TYPE:
+        LOG.debug("decoding compact payload of %s bytes",
+                  len(response.content))
+        return decode_compact(response.content)
+    return decode_payload(response.json())
@@ -2,61 +2,191 @@
 Module for retrieving data from raspberry pi apis
 """
 
+import os
 import logging
-import json
 import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from datetime import datetime, timedelta
 import requests
+import numpy as np
 import pandas as pd
-from homesweetpi.sql_tables import get_ip_addr, get_sensors_on_pi,\
-                                   get_last_time, SESSION
-from homesweetpi.sql_tables import get_pi_ids, save_recent_data
+import sqlalchemy
+from sqlalchemy.orm import Session
+from homesweetpi.sql_tables import get_ip_addr, SENSOR_CACHE,\
+                                   SESSION, ENGINE
+from homesweetpi.sql_tables import get_pi_ids, upsert_measurements,\
+                                   InsertCounts
+from homesweetpi.http_client import HTTP_CLIENT, DEFAULT_TIMEOUT
+from homesweetpi.payloads import (ACCEPT, decode_payload, decode_response,
+                                  payload_columns)
+from homesweetpi.watermarks import WATERMARKS
+from homesweetpi.rollups import update_rollups, rollup_starts,\
+                                retention_cutoff
+from homesweetpi.chart_artifacts import CHART_ARTIFACTS
+from homesweetpi.data_preparation import precompute_charts
+from homesweetpi.ingest_buffer import IngestBuffer
 
 LOG = logging.getLogger("homesweetpi.data_retrieval")
 
+MAX_WORKERS = int(os.getenv("HSP_RETRIEVAL_WORKERS", default="8"))
+PAGE_SIZE = int(os.getenv("HSP_FETCH_PAGE_SIZE", default="5000"))
+
+PAYLOAD_DROP_COLUMNS = ("sensortype", "piid", "id")
+
+PollResult = namedtuple("PollResult",
+                        ["piid", "outcome", "rows", "inserted", "latency"])
+
+
+def column_array(values):
+    """
+    Return a numpy array of payload values, as floats with NaN for nulls if
+    any are missing
+    """
+    array = np.array(values)
+    if array.dtype == object:
+        array = np.array(values, dtype=float)
+    return array
+
+
+def sensor_ids(locations, pinames, sensors):
+    """
+    Return an array of the sensor id of each (location, piname) pair, with
+    -1 where there is no such sensor
+    Each distinct pair is looked up once in a dictionary
+    """
+    lookup = {(location, piname): sensorid for sensorid, location, piname
+              in sensors[["sensorid", "location", "piname"]].itertuples(
+                  index=False)}
+    location_codes, location_uniques = pd.factorize(np.array(locations,
+                                                             dtype=object))
+    piname_codes, piname_uniques = pd.factorize(np.array(pinames,
+                                                         dtype=object))
+    ids = np.array([[lookup.get((location, piname), -1)
+                     for piname in piname_uniques]
+                    for location in location_uniques], dtype="int64")
+    ids = np.append(ids.reshape(-1), -1)
+    codes = location_codes * len(piname_uniques) + piname_codes
+    codes[(location_codes < 0) | (piname_codes < 0)] = -1
+    return ids[codes]
+
+
+def parse_payload(payload, sensors):
+    """
+    Build a dataframe of readings from a decoded payload in either format,
+    creating one numpy array per column and mapping location and pi name to
+    sensor id. Readings from unknown sensors and duplicates are dropped.
+    """
+    payload = payload_columns(payload)
+    readings = {}
+    times = column_array(payload['datetime'])
+    readings['datetime'] = times.astype("int64").astype("datetime64[ms]")\
+                                .astype("datetime64[ns]")
+    for col, values in payload.items():
+        if col in ("datetime", "location", "piname") + PAYLOAD_DROP_COLUMNS:
+            continue
+        readings[col] = column_array(values)
+    readings['sensorid'] = sensor_ids(payload['location'], payload['piname'],
+                                      sensors)
+    recent_data = pd.DataFrame(readings)
+    recent_data = recent_data[recent_data['sensorid'] >= 0]
+    recent_data = recent_data.drop_duplicates(subset=['datetime',
+                                                      'sensorid'])
+    return recent_data.reset_index(drop=True)
+
 
 def process_fetched_data(recent_data, session=SESSION()):
     """
-    Parse the json-like string fetched from the pi_logger api
-    merge with the sensor information
+    Parse the json-like string (or already decoded payload in either
+    format) fetched from the pi_logger api
+    label the readings with the ids of their sensors
     return as a pandas dataframe
     """
-    recent_data = json.loads(recent_data)
-    recent_data = pd.DataFrame(recent_data)
-    LOG.debug("shape of fetched data is %s", recent_data.shape)
-    recent_data['datetime'] = pd.to_datetime(recent_data['datetime'],
-                                             unit="ms")
-    assert recent_data['piid'].unique().size == 1
-    pi_id = recent_data['piid'].unique()[0]
-    sensors = get_sensors_on_pi(pi_id, session=session)
+    recent_data = payload_columns(decode_payload(recent_data))
+    LOG.debug("fetched data has %s columns and %s rows", len(recent_data),
+              len(recent_data['datetime']))
+    pi_ids = set(recent_data['piid'])
+    assert len(pi_ids) == 1
+    pi_id = pi_ids.pop()
+    pairs = set(zip(recent_data['location'], recent_data['piname']))
+    sensors = SENSOR_CACHE.sensors_on_pi(pi_id, session=session, pairs=pairs)
     LOG.debug("sensors on pi %s are %s", pi_id, sensors)
-    recent_data = recent_data.merge(sensors, on=['location', 'piname'])\
-                             .drop(["piname", "location", "sensortype",
-                                    "piid", "id"], axis=1)
-    LOG.debug("shape of fetched data after merge is %s", recent_data.shape)
-    recent_data = recent_data.drop_duplicates(subset=['datetime',
-                                                      'sensorid'])
-    LOG.debug("shape of data after drop duplicates %s", recent_data.shape)
+    unknown = pairs - set(zip(sensors['location'], sensors['piname']))
+    if unknown:
+        LOG.warning("Dropping readings from unknown sensors %s on pi %s",
+                    sorted(unknown), pi_id)
+    recent_data = parse_payload(recent_data, sensors)
+    LOG.debug("shape of data after parsing %s", recent_data.shape)
+    return recent_data
+
+
+def request_recent_data(ipaddr, query_time, port=5003,
+                        timeout=DEFAULT_TIMEOUT, client=HTTP_CLIENT,
+                        limit=None):
+    """
+    Request all data since query_time from the pi_logger api at ipaddr,
+    reusing a pooled connection from client where possible
+    If limit is given, ask the pi for at most that many rows
+    Pis that support it send the compact payload format, others json
+    Returns the decoded payload. Raises requests.exceptions.RequestException
+    or ValueError if the pi cannot be reached or does not return a valid
+    payload
+    """
+    strftime = query_time.strftime('%Y%m%d%H%M%S')
+    url = f"http://{ipaddr}:{port}/get_recent/{strftime}"
+    params = None if limit is None else {"limit": limit}
+    LOG.debug("fetching data from %s with params %s", url, params)
+    response = client.get(url, timeout=timeout, params=params,
+                          headers={"Accept": ACCEPT})
+    recent_data = decode_response(response)
+    LOG.debug("recieved json with length %s", len(recent_data))
     return recent_data
 
 
-def fetch_recent_data(pi_id, query_time, session=SESSION(), port=5003):
+def iter_recent_pages(ipaddr, query_time, port=5003, timeout=DEFAULT_TIMEOUT,
+                      client=HTTP_CLIENT, page_size=PAGE_SIZE):
+    """
+    Request data since query_time from the pi_logger api one page of at most
+    page_size rows at a time, so that a large backlog never has to be held
+    in memory at once
+    Each page starts from the second of the last reading in the previous
+    page. Pis that ignore the limit return everything in the first page.
+    Yields the decoded json for each page
+    """
+    while True:
+        page = request_recent_data(ipaddr, query_time, port, timeout, client,
+                                   limit=page_size)
+        if len(page) <= 1:
+            LOG.debug("contents of json: %s. No more pages", page)
+            return
+        times = payload_columns(page)['datetime']
+        if not times:
+            return
+        yield page
+        if len(times) < page_size:
+            return
+        last_time = pd.to_datetime(max(times), unit="ms")
+        next_time = last_time.floor("S").to_pydatetime()
+        if next_time <= query_time:
+            next_time = query_time + timedelta(seconds=1)
+        LOG.debug("requesting next page from %s since %s", ipaddr, next_time)
+        query_time = next_time
+
+
+def fetch_recent_data(pi_id, query_time, session=SESSION(), port=5003,
+                      timeout=DEFAULT_TIMEOUT, client=HTTP_CLIENT):
     """
     Get all data since query_time from a raspberry pi identified by pi_id
     Returns a pandas dataframe
     """
     ipaddr = get_ip_addr(pi_id, session=session)
-    strftime = query_time.strftime('%Y%m%d%H%M%S')
-    url = f"http://{ipaddr}:{port}/get_recent/{strftime}"
-    LOG.debug("fetching data from %s", url)
     try:
-        response = requests.get(url)
-        recent_data = response.json()
-        LOG.debug("recieved json with length %s", len(recent_data))
-    except requests.exceptions.ConnectionError as error:
-        LOG.debug("ConnectionError from %s: %s", ipaddr, type(error))
-        msg = f'{{"message": "Could not connect to {ipaddr}"}}'
-        recent_data = json.loads(msg)
+        recent_data = request_recent_data(ipaddr, query_time, port,
+                                          timeout, client)
+    except (requests.exceptions.RequestException, ValueError) as error:
+        LOG.debug("Could not fetch data from %s: %s", ipaddr, type(error))
+        return None
     if len(recent_data) > 1:
         recent_data = process_fetched_data(recent_data, session)
         return recent_data
@@ -75,43 +205,193 @@ def round_up_seconds(datetime_):
     return datetime(*rounded) + timedelta(seconds=1)
 
 
-def retrieve_data(pi_ids):
+def ingest_measurements(recent_data, engine=ENGINE):
+    """
+    Save a dataframe of processed readings to the db and update the rollups
+    if any of them are new, all in one transaction, so that readings are
+    never saved without their rollup buckets. The rollups are recomputed
+    from the oldest reading that was not in the db yet.
+    Shared by polling, the ingest buffer and the ingestion endpoint of the
+    api server
+    Returns InsertCounts of the readings inserted and skipped
+    """
+    if recent_data.empty:
+        return InsertCounts(0, 0)
+    with engine.begin() as connection:
+        starts = rollup_starts(recent_data, connection)
+        counts = upsert_measurements(recent_data, engine=connection)
+        if counts.inserted:
+            session = Session(bind=connection)
+            try:
+                update_rollups(recent_data, session, connection, starts,
+                               floor=retention_cutoff())
+            finally:
+                session.close()
+    return counts
+
+
+INGEST_BUFFER = IngestBuffer(ingest_measurements)
+
+
+def ingest_payload(payload, session_factory=SESSION, engine=ENGINE,
+                   buffer=None):
+    """
+    Parse a payload pushed by a pi and save its readings, with a db session
+    of its own
+    If an ingest buffer is given the readings are queued in it instead, and
+    BufferError is raised if it is full
+    Returns a tuple of (number of readings received, InsertCounts), with
+    None for the counts of queued readings
+    """
+    session = session_factory()
+    try:
+        recent_data = process_fetched_data(payload, session)
+        if buffer is None:
+            return len(recent_data), ingest_measurements(recent_data,
+                                                         engine)
+    finally:
+        session.close()
+    if not buffer.put(recent_data, timeout=0):
+        raise BufferError("ingest buffer is full")
+    return len(recent_data), None
+
+
+def advance_watermark(watermarks, piid, last_time, error=None):
+    """
+    Callback for readings queued in an ingest buffer: advance the watermark
+    of a pi once its readings have been saved
+    """
+    if error is None:
+        watermarks.update(piid, last_time)
+
+
+def poll_pi(piid, session, engine=ENGINE, port=5003,
+            timeout=DEFAULT_TIMEOUT, client=HTTP_CLIENT,
+            watermarks=WATERMARKS, page_size=PAGE_SIZE, buffer=None):
+    """
+    Retrieve new data from a single pi and save it to the db page by page,
+    advancing the pi's watermark after each page is saved
+    If an ingest buffer is given, pages are queued in it and the watermark
+    advances when they are flushed. Their inserted count is then not known
+    here and reported as 0.
+    Returns a tuple of (outcome, number of rows fetched, number inserted)
+    """
+    qtime = watermarks.get(piid, session=session)
+    LOG.debug("last reading pulled from pi %s at %s", piid, qtime)
+    qtime = round_up_seconds(qtime)
+    LOG.debug("fetching data for pi %s since time %s", piid, qtime)
+    ipaddr = get_ip_addr(piid, session=session)
+    rows, inserted = 0, 0
+    pages = iter_recent_pages(ipaddr, qtime, port, timeout, client,
+                              page_size)
+    try:
+        for page in pages:
+            recentdata = process_fetched_data(page, session)
+            if recentdata.empty:
+                continue
+            rows += len(recentdata)
+            last_time = recentdata['datetime'].max()
+            if buffer is not None:
+                LOG.debug("queueing %s rows from pi %s", len(recentdata), piid)
+                buffer.put(recentdata, on_flushed=partial(
+                    advance_watermark, watermarks, piid, last_time))
+                continue
+            LOG.debug("saving fetched data to db: %s", recentdata)
+            counts = ingest_measurements(recentdata, engine)
+            watermarks.update(piid, last_time)
+            inserted += counts.inserted
+    except (requests.exceptions.RequestException, ValueError) as error:
+        LOG.warning("Could not fetch data from pi %s at %s: %s",
+                    piid, ipaddr, error)
+        return ("partial" if rows else "unreachable"), rows, inserted
+    except sqlalchemy.exc.IntegrityError as exception:
+        LOG.warning("Error saving  pi %s from %s: %s", piid, qtime, exception)
+        return "save failed", rows, inserted
+    if not rows:
+        LOG.debug("No data to pass to sql for pi %s", piid)
+        return "no data", 0, 0
+    return "saved", rows, inserted
+
+
+def timed_poll_pi(piid, session_factory=SESSION, engine=ENGINE, port=5003,
+                  timeout=DEFAULT_TIMEOUT, client=HTTP_CLIENT,
+                  watermarks=WATERMARKS, buffer=None):
+    """
+    Run poll_pi with a db session of its own, so that it can be run in a
+    worker thread alongside polls of other pis
+    Returns a PollResult with the outcome and latency of the poll
+    """
+    start = time.monotonic()
+    session = session_factory()
+    try:
+        outcome, rows, inserted = poll_pi(piid, session, engine, port,
+                                          timeout, client, watermarks,
+                                          buffer=buffer)
+    except Exception:  # pylint: disable=W0703
+        LOG.exception("Unexpected error retrieving data from pi %s", piid)
+        outcome, rows, inserted = "error", 0, 0
+    finally:
+        session.close()
+    return PollResult(piid, outcome, rows, inserted, time.monotonic() - start)
+
+
+def report_round(results, duration):
+    """
+    Log the outcome and latency of each poll in a data retrieval round
+    """
+    for result in sorted(results, key=lambda r: r.latency, reverse=True):
+        LOG.info("pi %s: %s, %s rows fetched, %s inserted in %.2f s",
+                 result.piid, result.outcome, result.rows, result.inserted,
+                 result.latency)
+    LOG.info("data retrieval round for %s pis finished in %.2f s",
+             len(results), duration)
+
+
+def retrieve_data(pi_ids, max_workers=MAX_WORKERS, session_factory=SESSION,
+                  engine=ENGINE, port=5003, timeout=DEFAULT_TIMEOUT,
+                  client=HTTP_CLIENT, watermarks=WATERMARKS, buffer=None):
     """
     Data retrieval main function.
-    Attempts to retrieve data from each pi included in database
+    Attempts to retrieve data from each pi included in database, polling up
+    to max_workers pis in parallel
     Parameters:
         pi_ids (list-like): list or array of pi id numbers
+        max_workers (int): maximum number of pis to poll at the same time
+        timeout (float or tuple): (connect, read) timeouts for each request
+        client (PiHttpClient): pooled http client used for the requests
+        watermarks (WatermarkCache): time of the last saved reading per pi
+        buffer (IngestBuffer): if given, readings from all pis are saved
+            together in batches and flushed at the end of the round
+    Returns a list of PollResults
     """
     LOG.debug("starting data retrieval round")
-    for piid in pi_ids:
-        qtime = get_last_time(piid)
-        LOG.debug("most recent record in db for pi %s at %s", piid, qtime)
-        qtime = round_up_seconds(qtime)
-        LOG.debug("fetching data for pi %s since time %s", piid, qtime)
-        recentdata = fetch_recent_data(piid, qtime)
-        if recentdata is None:
-            LOG.debug("No data to pass to sql: %s", recentdata)
-        else:
-            LOG.debug("saving fetched data to db: %s", recentdata)
-            if not save_recent_data(recentdata):
-                LOG.warning("Error saving  pi %s from %s",
-                            piid, qtime)
+    start = time.monotonic()
+    poll = partial(timed_poll_pi, session_factory=session_factory,
+                   engine=engine, port=port, timeout=timeout,
+                   client=client, watermarks=watermarks, buffer=buffer)
+    n_workers = max(1, min(max_workers, len(pi_ids)))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(poll, pi_ids))
+    if buffer is not None:
+        buffer.flush()
+        LOG.info("ingest buffer: %s", buffer.metrics())
+    report_round(results, time.monotonic() - start)
+    return results
 
 
-def run_data_retrieval_loop(freq=300):
+def refresh_charts(session_factory=SESSION, store=CHART_ARTIFACTS):
     """
-    Attempts to retrieve data from each pi included in database at the
-    specified frequency
-    Parameters:
-        freq (int): the data retrieval frequency in seconds
+    Precompute the chart data of the standard views after new readings have
+    been saved, so the web server does not build them on page load
+    Failures are logged and do not interrupt data retrieval
     """
-    LOG.debug("fetching pi ids")
-    ids = get_pi_ids()
-    LOG.debug("pi ids %s", ids)
-    LOG.debug("fetch frequency set to %s seconds", freq)
-    while True:
-        retrieve_data(ids)
-        time.sleep(freq)
+    session = session_factory()
+    try:
+        precompute_charts(session=session, store=store)
+    except (sqlalchemy.exc.SQLAlchemyError, OSError, ValueError):
+        LOG.exception("precomputing charts failed")
+    finally:
+        session.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,294 @@
+"""
+Module for maintaining and querying the rollup tables, which hold averages
+of the measurements over 5 minute, hourly and daily buckets.
+
+The retrieval service recomputes only the buckets touched by each batch of
+new readings, never reaching back past the raw readings that retention or
+the archive have removed, as those buckets could not be rebuilt. Chart
+queries are routed to the coarsest rollup that can
+still produce the requested resampling frequency, so long time ranges read
+thousands of rows instead of millions. Months that have been moved to the
+archive are resampled from the archive instead.
+"""
+import os
+import logging
+from datetime import datetime, timedelta
+import pandas as pd
+from sqlalchemy import func, select
+from sqlalchemy.orm import sessionmaker
+from homesweetpi.sql_tables import (ROLLUPS, Measurement, SESSION, ENGINE,
+                                    freq_to_seconds, executemany_insert,
+                                    get_bucketed_measurements,
+                                    resample_measurements)
+from homesweetpi.archive import ARCHIVE
+
+LOG = logging.getLogger("homesweetpi.rollups")
+
+RETENTION_DAYS = os.getenv("HSP_RETENTION_DAYS")
+
+
+def retention_cutoff(retention_days=RETENTION_DAYS, now=None):
+    """
+    Return the time before which raw readings are removed by retention, or
+    None if no retention period is configured
+    """
+    if retention_days is None:
+        return None
+    now = datetime.now() if now is None else now
+    return now - timedelta(days=float(retention_days))
+
+
+def bucket_start(datetime_, resample_freq):
+    """
+    Return the start of the bucket of length resample_freq containing
+    datetime_
+    """
+    return pd.Timestamp(datetime_).floor(resample_freq).to_pydatetime()
+
+
+def update_rollup(table, resample_freq, sensorids, since_datetime,
+                  session=SESSION(), engine=ENGINE, floor=None):
+    """
+    Recompute the buckets of length resample_freq in a rollup table from
+    since_datetime onwards for the given sensors, leaving the buckets that
+    start before floor as they are
+    Returns the number of buckets written
+    """
+    start = bucket_start(since_datetime, resample_freq)
+    if floor is not None and start < floor:
+        start = pd.Timestamp(floor).ceil(resample_freq).to_pydatetime()
+    sensorids = [int(sensorid) for sensorid in sensorids]
+    LOG.debug("Updating %s for sensors %s from %s",
+              table.__tablename__, sensorids, start)
+    buckets = get_bucketed_measurements(start, resample_freq, session,
+                                        sensorids=sensorids)
+    rollup_table = table.__table__
+    with engine.connect() as connection, connection.begin():
+        connection.execute(
+            rollup_table.delete()
+            .where(rollup_table.c.sensorid.in_(sensorids))
+            .where(rollup_table.c.datetime >= start)
+        )
+        if buckets is None:
+            return 0
+        executemany_insert(buckets, rollup_table, connection)
+    return len(buckets)
+
+
+def rollup_starts(recent_data, connection):
+    """
+    Return the time from which the rollups of each sensor need recomputing
+    once a dataframe of readings has been saved, as a dictionary of sensor
+    ids to datetimes, leaving out sensors whose readings are all in the db
+    already. Must be called before the readings are saved.
+    A sensor's recompute starts at its oldest reading not yet in the db,
+    but never before its oldest reading still in the db, as the buckets of
+    readings that have been archived or removed cannot be rebuilt.
+    """
+    if recent_data is None or recent_data.empty:
+        return {}
+    sensorids = [int(sensorid) for sensorid
+                 in recent_data['sensorid'].unique()]
+    keys = ["sensorid", "datetime"]
+    saved = pd.DataFrame(connection.execute(
+        select([Measurement.sensorid, Measurement.datetime])
+        .where(Measurement.sensorid.in_(sensorids))
+        .where(Measurement.datetime >= recent_data['datetime'].min())
+        .where(Measurement.datetime <= recent_data['datetime'].max())
+    ).fetchall(), columns=keys)
+    new = recent_data[keys]
+    if not saved.empty:
+        saved["datetime"] = pd.to_datetime(saved["datetime"])
+        new = new[~pd.MultiIndex.from_frame(new)
+                  .isin(pd.MultiIndex.from_frame(saved))]
+    oldest = dict(connection.execute(
+        select([Measurement.sensorid, func.min(Measurement.datetime)])
+        .where(Measurement.sensorid.in_(sensorids))
+        .group_by(Measurement.sensorid)
+    ).fetchall())
+    starts = {}
+    for sensorid, first_new in new.groupby("sensorid")["datetime"].min()\
+                                  .items():
+        first_new = pd.Timestamp(first_new)
+        if sensorid in oldest:
+            first_new = max(first_new, pd.Timestamp(oldest[sensorid]))
+        starts[sensorid] = first_new.to_pydatetime()
+    return starts
+
+
+def update_rollups(recent_data, session=SESSION(), engine=ENGINE,
+                   starts=None, floor=None):
+    """
+    Recompute the rollup buckets touched by a dataframe of newly saved
+    readings, for each sensor from its time in starts if given (see
+    rollup_starts) and otherwise from its oldest reading in recent_data
+    Buckets starting before floor, e.g. the retention cutoff, are kept.
+    engine may also be a connection, to update within its transaction
+    """
+    if recent_data is None or recent_data.empty:
+        return
+    if starts is None:
+        starts = recent_data.groupby("sensorid")["datetime"].min()\
+                            .to_dict()
+    sensors_from = {}
+    for sensorid, since in starts.items():
+        sensors_from.setdefault(since, []).append(sensorid)
+    for since, sensorids in sorted(sensors_from.items()):
+        for resample_freq, table in ROLLUPS.items():
+            update_rollup(table, resample_freq, sensorids, since, session,
+                          engine, floor)
+
+
+def rebuild_rollups(since_datetime=datetime(1970, 1, 1), session=SESSION(),
+                    engine=ENGINE):
+    """
+    Recompute every rollup table from since_datetime onwards, e.g. after
+    creating the rollup tables in an existing database
+    """
+    LOG.info("Rebuilding rollup tables from %s", since_datetime)
+    sensorids = [sensorid for (sensorid,) in
+                 session.query(Measurement.sensorid).distinct().all()]
+    if not sensorids:
+        return
+    for resample_freq, table in ROLLUPS.items():
+        update_rollup(table, resample_freq, sensorids, since_datetime,
+                      session, engine)
+
+
+def ensure_rollups(engine=ENGINE):
+    """
+    Rebuild the rollup tables if any of them is empty while the
+    measurements table is not, as after adding them to an existing db.
+    Otherwise chart queries would read the raw measurements until the
+    rollups had filled up from new readings.
+    """
+    session = sessionmaker(bind=engine)()
+    try:
+        if session.query(Measurement.sensorid).first() is None:
+            return
+        if all(session.query(table.sensorid).first() is not None
+               for table in ROLLUPS.values()):
+            return
+        rebuild_rollups(session=session, engine=engine)
+    finally:
+        session.close()
+
+
+def rollup_covers(table, since_datetime, session=SESSION()):
+    """
+    Return True if a rollup table holds buckets for every raw measurement
+    from since_datetime onwards
+    """
+    first = session.query(func.min(table.datetime)).scalar()
+    if first is None:
+        return False
+    if first <= since_datetime:
+        return True
+    missing = session.query(Measurement.sensorid)\
+                     .filter(Measurement.datetime >= since_datetime)\
+                     .filter(Measurement.datetime < first).first()
+    return missing is None
+
+
+def choose_table(since_datetime, resample_freq='30T', session=SESSION()):
+    """
+    Return the coarsest rollup table whose buckets divide evenly into
+    resample_freq and which covers the time since since_datetime, or the
+    raw measurements table if there is none
+    """
+    target = freq_to_seconds(resample_freq)
+    candidates = sorted(ROLLUPS.items(),
+                        key=lambda item: freq_to_seconds(item[0]),
+                        reverse=True)
+    for freq, table in candidates:
+        seconds = freq_to_seconds(freq)
+        if seconds > target or target % seconds:
+            continue
+        if rollup_covers(table, since_datetime, session):
+            LOG.debug("Using %s for buckets of %s", table.__tablename__,
+                      resample_freq)
+            return table
+    LOG.debug("No rollup table for buckets of %s, using measurements",
+              resample_freq)
+    return Measurement
+
+
+def get_archived_buckets(since_datetime, until_datetime, resample_freq='30T',
+                         archive=ARCHIVE):
+    """
+    Read the archived measurements from since_datetime to until_datetime
+    and average them into time buckets of length resample_freq, leaving out
+    empty buckets as the database does
+    returns a dataframe, or None if there are no archived measurements
+    """
+    columns = [col.name for col in Measurement.__table__.columns]
+    chunks = list(archive.iter_since(since_datetime, until_datetime, columns))
+    if not chunks:
+        return None
+    buckets = resample_measurements(pd.concat(chunks, ignore_index=True),
+                                    resample_freq)
+    value_cols = [col for col in buckets.columns
+                  if col not in ("sensorid", "datetime")]
+    return buckets.dropna(subset=value_cols, how="all")
+
+
+def get_chart_measurements(ndays_to_display, resample_freq='30T',
+                           session=SESSION(), archive=ARCHIVE):
+    """
+    Query the most suitable table for measurements from the last n days,
+    averaged into time buckets of length resample_freq
+    Archived months are read from the archive and the rest from the db
+    returns a dataframe
+    """
+    earliest = datetime.now() - timedelta(days=ndays_to_display)
+    archived = None
+    archived_until = archive.archived_until()
+    if archived_until is not None and archived_until > earliest:
+        archived = get_archived_buckets(earliest, archived_until,
+                                        resample_freq, archive)
+        earliest = archived_until.to_pydatetime()
+    table = choose_table(earliest, resample_freq, session)
+    logs = get_bucketed_measurements(earliest, resample_freq, session,
+                                     table=table)
+    if archived is None:
+        return logs
+    if logs is None:
+        return archived.reset_index(drop=True)
+    logs = pd.concat([archived[logs.columns], logs], ignore_index=True)
+    return logs.sort_values(["sensorid", "datetime"], kind="mergesort")\
+               .reset_index(drop=True)
+
+
+def get_chart_extremes(ndays_to_display, resample_freq='30T',
+                       session=SESSION(), archive=ARCHIVE):
+    """
+    Query the minimum and maximum of each reading in every time bucket of
+    length resample_freq over the last n days from the raw measurements,
+    in the archive and the db, for drawing min/max envelopes
+    Buckets whose raw readings have been removed are left out
+    returns a dataframe with columns suffixed _min and _max, or None
+    """
+    earliest = datetime.now() - timedelta(days=ndays_to_display)
+    value_cols = [col.name for col in Measurement.__table__.columns
+                  if col.name not in ("sensorid", "datetime")]
+    frames = []
+    archived_until = archive.archived_until()
+    if archived_until is not None and archived_until > earliest:
+        columns = ["sensorid", "datetime"] + value_cols
+        chunks = list(archive.iter_since(earliest, archived_until, columns))
+        if chunks:
+            logs = pd.concat(chunks, ignore_index=True)
+            buckets = pd.to_datetime(logs["datetime"]).dt.floor(resample_freq)
+            archived = logs.groupby([logs["sensorid"], buckets])[value_cols]\
+                           .agg(["min", "max"])
+            archived.columns = [f"{col}_{agg}" for col, agg
+                                in archived.columns]
+            frames.append(archived.reset_index())
+        earliest = archived_until.to_pydatetime()
+    logs = get_bucketed_measurements(earliest, resample_freq, session,
+                                     aggregates=("min", "max"))
+    if logs is not None:
+        frames.append(logs.drop(columns=value_cols))
+    if not frames:
+        return None
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,102 @@
+"""
+Cache for the sensor and raspberry pi metadata tables.
+
+The sensors and raspberrypis tables change rarely, so their joined contents
+are kept in memory for a limited time and shared by data retrieval and the
+web server instead of being queried for every payload and page view.
+"""
+import os
+import time
+import logging
+import threading
+
+LOG = logging.getLogger("homesweetpi.sensor_cache")
+
+CACHE_TTL = float(os.getenv("HSP_SENSOR_CACHE_TTL", default="3600"))
+
+
+class SensorMetadataCache():
+    """
+    Time-limited cache of a dataframe with one row per sensor and the
+    columns sensorid, location, piname and piid
+    loader is called with a session keyword argument to (re)load the frame
+    """
+    def __init__(self, loader, ttl=CACHE_TTL):
+        self.loader = loader
+        self.ttl = ttl
+        self.frame = None
+        self.loaded_at = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def is_fresh(self):
+        """
+        Return True if the cached frame exists and has not expired
+        """
+        if self.frame is None:
+            return False
+        return time.monotonic() - self.loaded_at < self.ttl
+
+    def get(self, session):
+        """
+        Return the cached sensor metadata, reloading it if it has expired
+        """
+        with self.lock:
+            if self.is_fresh():
+                self.hits += 1
+            else:
+                self.misses += 1
+                LOG.debug("Loading sensor metadata into cache")
+                self.frame = self.loader(session=session)
+                self.loaded_at = time.monotonic()
+            return self.frame
+
+    def invalidate(self):
+        """
+        Drop the cached metadata so that the next lookup reloads it
+        """
+        LOG.debug("Invalidating sensor metadata cache")
+        with self.lock:
+            self.frame = None
+            self.loaded_at = None
+
+    def sensors_and_pis(self, session):
+        """
+        Return dataframe of sensors with their host pis
+        """
+        return self.get(session)[["sensorid", "location", "piname"]]
+
+    def sensors_on_pi(self, piid, session, pairs=()):
+        """
+        Return a dataframe relating location names and pi name to sensor id
+        for a given pi. An unknown pi, or any (location, piname) pair in
+        pairs that is not among its cached sensors, triggers one reload in
+        case the sensors were added since the metadata was cached.
+        """
+        on_pi = self.cached_on_pi(piid, session)
+        missing = set(pairs) - set(zip(on_pi["location"], on_pi["piname"]))
+        if on_pi.empty or missing:
+            LOG.debug("Sensors %s not cached for pi %s, reloading",
+                      sorted(missing), piid)
+            self.invalidate()
+            on_pi = self.cached_on_pi(piid, session)
+        return on_pi[["sensorid", "location", "piname"]]\
+            .reset_index(drop=True)
+
+    def cached_on_pi(self, piid, session):
+        """
+        Return the rows of the cached metadata for the sensors on a pi
+        """
+        sensors = self.get(session)
+        return sensors[sensors["piid"] == piid]
+
+    def stats(self):
+        """
+        Return a dictionary of cache hits, misses and the age of the cache
+        """
+        age = None
+        if self.loaded_at is not None:
+            age = time.monotonic() - self.loaded_at
+        return dict(hits=self.hits, misses=self.misses, age=age,
+                    ttl=self.ttl)
@@ -5,19 +5,24 @@ SQLalchemy ORM.
 """
 # pylint: disable=R0903
 import os
+import io
 import logging
+from collections import namedtuple
 from datetime import datetime, timedelta
 import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 import sqlalchemy
-from sqlalchemy import create_engine, distinct
-from sqlalchemy import (Column, ForeignKey,
+from sqlalchemy import (create_engine, distinct, func, text, bindparam,
+                        and_, cast, select)
+from sqlalchemy import (Column, ForeignKey, Index,
                         Integer, String, DateTime, Float, Boolean)
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
+from sqlalchemy.ext.declarative import declarative_base, declared_attr
+from sqlalchemy.orm import relationship, sessionmaker, aliased
+from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.inspection import inspect
+from homesweetpi.sensor_cache import SensorMetadataCache
+from homesweetpi.archive import ARCHIVE
 
 load_dotenv()
 
@@ -32,6 +37,11 @@ BASE = declarative_base()
 CONN_STRING = f'postgresql://{USERNAME}:{PASSWORD}@{HOST}:{PORT}/{DB}'
 ENGINE = create_engine(CONN_STRING, echo=False)
 SESSION = sessionmaker(bind=ENGINE)
+FETCH_CHUNK_SIZE = int(os.getenv("HSP_FETCH_CHUNK_SIZE", default="50000"))
+PARTITION_MEASUREMENTS = os.getenv("HSP_PARTITION_MEASUREMENTS",
+                                   default="0") == "1"
+
+InsertCounts = namedtuple("InsertCounts", ["inserted", "skipped"])
 
 
 class RaspberryPi(BASE):
@@ -83,6 +93,19 @@ class Sensor(BASE):
         return "<Sensor(id={}, location={}, type={}, active={})>".format(*info)
 
 
+def measurement_table_args(partitioned=PARTITION_MEASUREMENTS):
+    """
+    Return the table arguments of the measurements table: a BRIN index on
+    datetime (a plain index on other databases) and, if partitioned is True,
+    range partitioning by datetime on PostGres
+    """
+    args = (Index("ix_measurements_datetime", "datetime",
+                  postgresql_using="brin"),)
+    if partitioned:
+        args += ({"postgresql_partition_by": "RANGE (datetime)"},)
+    return args
+
+
 class Measurement(BASE):
     """
     Class for measurement data table in PostGres DB
@@ -98,6 +121,7 @@ class Measurement(BASE):
         mcdvoltage (Float)
     """
     __tablename__ = 'measurements'
+    __table_args__ = measurement_table_args()
 
     sensorid = Column(Integer, ForeignKey('sensors.id'), primary_key=True)
     datetime = Column(DateTime, primary_key=True)
@@ -125,17 +149,23 @@ class Measurement(BASE):
         info = (self.sensorid, self.datetime)
         return "<Measurement(sensor={}, datetime={})>".format(*info)
 
-    def get_row(self):
+    def get_row(self, sensorlocation=None, piname=None):
         """
         Return a dictionary containing the readings for a paricular time and
         sensor, complete with the full sensor information.
+        The sensor location and pi name are loaded from the related tables
+        unless they are passed in.
         """
+        if sensorlocation is None:
+            sensorlocation = self.sensor.location
+        if piname is None:
+            piname = self.sensor.raspberrypi.name
         data = dict(
             datetime=self.datetime,
             strftime=self.datetime.strftime("%d.%m.%Y %H:%M:%S"),
             sensorid=self.sensorid,
-            sensorlocation=self.sensor.location,
-            piname=self.sensor.raspberrypi.name,
+            sensorlocation=sensorlocation,
+            piname=piname,
             temp=self.temp,
             humidity=self.humidity,
             pressure=self.pressure,
@@ -153,12 +183,258 @@ class Measurement(BASE):
         return self.fancy_names_dict
 
 
+class LatestMeasurement(BASE):
+    """
+    Class for the table holding the most recent measurement from each sensor
+    in PostGres DB. Kept up to date by upsert_measurements.
+    _______
+    columns:
+        sensorid (Integer)
+        datetime (DateTime)
+        temp (Float)
+        humidity (Float)
+        pressure (Float)
+        gasvoc (Float)
+        mcdvalue (Integer)
+        mcdvoltage (Float)
+    """
+    __tablename__ = 'latest_measurements'
+
+    sensorid = Column(Integer, ForeignKey('sensors.id'), primary_key=True)
+    datetime = Column(DateTime, nullable=False)
+    temp = Column(Float)
+    humidity = Column(Float)
+    pressure = Column(Float)
+    gasvoc = Column(Float)
+    mcdvalue = Column(Integer)
+    mcdvoltage = Column(Float)
+
+    sensor = relationship('Sensor')
+
+    def __repr__(self):
+        info = (self.sensorid, self.datetime)
+        return "<LatestMeasurement(sensor={}, datetime={})>".format(*info)
+
+    # rows are laid out exactly as for the measurements table
+    get_row = Measurement.get_row
+
+
+class RollupMixin():
+    """
+    Columns shared by the rollup tables, which hold the average of each
+    reading for each sensor over fixed time buckets
+    _______
+    columns:
+        sensorid (Integer)
+        datetime (DateTime): start of the time bucket
+        temp (Float)
+        humidity (Float)
+        pressure (Float)
+        gasvoc (Float)
+        mcdvalue (Float)
+        mcdvoltage (Float)
+    """
+    @declared_attr
+    def sensorid(cls):  # pylint: disable=E0213
+        """Sensor id column, declared per table for the foreign key"""
+        return Column(Integer, ForeignKey('sensors.id'), primary_key=True)
+
+    datetime = Column(DateTime, primary_key=True)
+    temp = Column(Float)
+    humidity = Column(Float)
+    pressure = Column(Float)
+    gasvoc = Column(Float)
+    mcdvalue = Column(Float)
+    mcdvoltage = Column(Float)
+
+    def __repr__(self):
+        info = (self.__tablename__, self.sensorid, self.datetime)
+        return "<Rollup(table={}, sensor={}, datetime={})>".format(*info)
+
+
+class Rollup5Min(RollupMixin, BASE):
+    """
+    Class for 5 minute averages of measurements in PostGres DB
+    """
+    __tablename__ = 'measurements_5min'
+
+
+class RollupHourly(RollupMixin, BASE):
+    """
+    Class for hourly averages of measurements in PostGres DB
+    """
+    __tablename__ = 'measurements_1h'
+
+
+class RollupDaily(RollupMixin, BASE):
+    """
+    Class for daily averages of measurements in PostGres DB
+    """
+    __tablename__ = 'measurements_1d'
+
+
+# rollup tables keyed by the pandas frequency string of their buckets
+ROLLUPS = {
+    "5T": Rollup5Min,
+    "1H": RollupHourly,
+    "1D": RollupDaily,
+}
+
+
 def create_tables(engine=ENGINE):
     """
     Create all tables in the sql database
     """
     LOG.debug('Creating tables in sql')
     BASE.metadata.create_all(engine)
+    ensure_partitions(engine)
+    ensure_latest_measurements(engine)
+
+
+def month_partition_name(month, table_name="measurements"):
+    """
+    Return the name of the partition of a table holding a given month
+    """
+    return f"{table_name}_{month:%Y_%m}"
+
+
+def create_month_partitions(start, end, connectable=ENGINE,
+                            table_name="measurements"):
+    """
+    Create a partition of a table partitioned by month for every month from
+    start to end, and a default partition for readings outside them
+    Only applies to PostGres; returns the names of the partitions
+    """
+    if connectable.dialect.name != "postgresql":
+        return []
+    months = pd.date_range(pd.Timestamp(start).to_period("M").to_timestamp(),
+                           end, freq="MS")
+    names = []
+    for month in months:
+        name = month_partition_name(month, table_name)
+        with connectable.connect() as connection, connection.begin():
+            create_month_partition(month, connection, table_name)
+        names.append(name)
+    connectable.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {table_name}_default "
+        f"PARTITION OF {table_name} DEFAULT"
+    ))
+    LOG.debug("Partitions of %s: %s", table_name, names)
+    return names
+
+
+def create_month_partition(month, connection, table_name="measurements"):
+    """
+    Create the partition of a table partitioned by month holding a given
+    month, if it does not exist yet
+    PostGres refuses to create a partition for readings that are already in
+    the default partition, e.g. from pis with a wrong clock, so they are
+    moved into the new partition, which is then attached. Should be run in
+    a transaction.
+    """
+    name = month_partition_name(month, table_name)
+    if connection.execute(text("SELECT to_regclass(:name)"),
+                          name=name).scalar() is not None:
+        return
+    upper = month + pd.offsets.MonthBegin()
+    bounds = f"FROM ('{month:%Y-%m-%d}') TO ('{upper:%Y-%m-%d}')"
+    default = f"{table_name}_default"
+    if connection.execute(text("SELECT to_regclass(:name)"),
+                          name=default).scalar() is None:
+        connection.execute(text(
+            f"CREATE TABLE {name} PARTITION OF {table_name} "
+            f"FOR VALUES {bounds}"))
+        return
+    in_month = (f"datetime >= '{month:%Y-%m-%d}' "
+                f"AND datetime < '{upper:%Y-%m-%d}'")
+    connection.execute(text(
+        f"CREATE TABLE {name} (LIKE {table_name} INCLUDING DEFAULTS)"))
+    moved = connection.execute(text(
+        f"INSERT INTO {name} SELECT * FROM {default} WHERE {in_month}"
+    )).rowcount
+    if moved:
+        LOG.warning("Moving %s readings from %s into new partition %s",
+                    moved, default, name)
+        connection.execute(text(f"DELETE FROM {default} WHERE {in_month}"))
+    connection.execute(text(
+        f"ALTER TABLE {table_name} ATTACH PARTITION {name} "
+        f"FOR VALUES {bounds}"))
+
+
+def ensure_partitions(engine=ENGINE, months_ahead=1, now=None):
+    """
+    Make sure the partitioned measurements table has partitions for the
+    current month and the next months_ahead months
+    Does nothing unless partitioning is enabled
+    """
+    if not PARTITION_MEASUREMENTS:
+        return []
+    now = datetime.now() if now is None else now
+    end = pd.Timestamp(now) + pd.DateOffset(months=months_ahead)
+    return create_month_partitions(now, end, engine)
+
+
+def is_partitioned(engine=ENGINE, table_name="measurements"):
+    """
+    Return True if a table is partitioned in a PostGres db
+    """
+    if engine.dialect.name != "postgresql":
+        return False
+    query = text("SELECT count(*) FROM pg_partitioned_table "
+                 "WHERE partrelid = to_regclass(:table_name)")
+    return bool(engine.execute(query, table_name=table_name).scalar())
+
+
+def partition_measurements(engine=ENGINE):
+    """
+    Move the readings of an unpartitioned measurements table into a new
+    table partitioned by month, in a single transaction
+    """
+    LOG.info("Partitioning measurements table by month")
+    columns = ", ".join(col.name for col in Measurement.__table__.columns)
+    with engine.begin() as connection:
+        connection.execute(text(
+            "ALTER TABLE measurements RENAME TO measurements_unpartitioned"))
+        connection.execute(text(
+            "ALTER INDEX measurements_pkey "
+            "RENAME TO measurements_unpartitioned_pkey"))
+        connection.execute(text(
+            "DROP INDEX IF EXISTS ix_measurements_datetime"))
+        Measurement.__table__.create(connection)
+        first, last = connection.execute(text(
+            "SELECT min(datetime), max(datetime) "
+            "FROM measurements_unpartitioned")).first()
+        if first is not None:
+            create_month_partitions(first, last, connection)
+        create_month_partitions(datetime.now(),
+                                datetime.now() + timedelta(days=31),
+                                connection)
+        connection.execute(text(
+            f"INSERT INTO measurements ({columns}) "
+            f"SELECT {columns} FROM measurements_unpartitioned"))
+        connection.execute(text("DROP TABLE measurements_unpartitioned"))
+
+
+def migrate_measurements(engine=ENGINE):
+    """
+    Bring the measurements table of an existing db up to date: partition it
+    by month if partitioning is enabled, create the datetime index and fill
+    the latest_measurements and rollup tables
+    """
+    # imported here as the rollups module depends on this one
+    from homesweetpi.rollups import ensure_rollups
+    if (PARTITION_MEASUREMENTS and engine.dialect.name == "postgresql"
+            and not is_partitioned(engine)):
+        partition_measurements(engine)
+    existing = {index["name"] for index in
+                inspect(engine).get_indexes(Measurement.__tablename__)}
+    for index in Measurement.__table__.indexes:
+        if index.name not in existing:
+            LOG.info("Creating index %s", index.name)
+            index.create(engine)
+    ensure_partitions(engine)
+    ensure_latest_measurements(engine)
+    ensure_rollups(engine)
 
 
 def get_pi_names(session=SESSION()):
@@ -221,6 +497,7 @@ def load_sensor_and_pi_info(pi_file, sensor_file, engine=ENGINE):
     sensors = pd.read_csv(sensor_file)
     sensors.drop(['name'], axis=1, inplace=True)
     sensors.to_sql("sensors", engine, index=False, if_exists="append")
+    SENSOR_CACHE.invalidate()
 
 
 def get_sensor_locations(session=SESSION()):
@@ -279,25 +556,67 @@ def get_sensors_and_pis(session=SESSION()):
                                                  "sensors.id": "sensorid"})
 
 
+def get_sensor_metadata(session=SESSION()):
+    """
+    Return dataframe of all sensors with their location, host pi name and
+    host pi id
+    """
+    LOG.debug("Querying metadata for sensors on all pis")
+    query = session.query(Sensor.id, Sensor.location, RaspberryPi.name,
+                          Sensor.piid).join(RaspberryPi)
+    sensors = pd.DataFrame(query.all(),
+                           columns=["sensorid", "location", "piname", "piid"])
+    LOG.debug("Result of query for sensor metadata: %s", sensors)
+    return sensors
+
+
+SENSOR_CACHE = SensorMetadataCache(get_sensor_metadata)
+
+
 def get_last_time(piid, session=SESSION()):
     """
-    Get the time of the most recent reading for a given raspberry pi
+    Get the time of the most recent reading for a given raspberry pi, from
+    the latest_measurements table where possible, as the measurements table
+    may no longer hold readings that have been archived
+    If there are no readings, returns 1970-01-01 so that a new pi's whole
+    backlog is fetched
     Returns a datetime
     """
     LOG.debug("Querying time of most recent reading for pi %s", piid)
-    query = session.query(Measurement).join(Sensor).join(RaspberryPi)
-    query = query.filter(Sensor.piid == piid)\
-                 .order_by(Measurement.datetime.desc())
-    result = query.first()
-    if result is not None:
-        last_time = result.datetime
+    last_time = session.query(func.max(LatestMeasurement.datetime))\
+                       .select_from(LatestMeasurement).join(Sensor)\
+                       .filter(Sensor.piid == piid).scalar()
+    if last_time is None:
+        last_time = session.query(func.max(Measurement.datetime))\
+                           .select_from(Measurement).join(Sensor)\
+                           .filter(Sensor.piid == piid).scalar()
+    if last_time is not None:
         LOG.debug("Last reading for %s at %s", piid, last_time)
-    else:
-        last_time = datetime(1970, 1, 1)
-        LOG.debug("No readings found for %s, returning %s", piid, last_time)
+        return last_time
+    last_time = datetime(1970, 1, 1)
+    LOG.debug("No readings found for %s, returning %s", piid, last_time)
     return last_time
 
 
+def get_last_times(session=SESSION()):
+    """
+    Get the time of the most recent reading for every raspberry pi with
+    readings in the db, using a single grouped query on the
+    latest_measurements table, or the measurements table if it is empty
+    Returns a dictionary mapping pi ids to datetimes
+    """
+    LOG.debug("Querying time of most recent reading for all pis")
+    for table in (LatestMeasurement, Measurement):
+        query = session.query(Sensor.piid, func.max(table.datetime))\
+                       .join(table, table.sensorid == Sensor.id)\
+                       .group_by(Sensor.piid)
+        last_times = dict(query.all())
+        if last_times:
+            break
+    LOG.debug("Last readings for each pi: %s", last_times)
+    return last_times
+
+
 def get_ip_addr(piid, session=SESSION()):
     """
     Query the SQL database to find the ipaddress for a given pi_id
@@ -313,37 +632,92 @@ def get_ip_addr(piid, session=SESSION()):
 def one_or_more_results(query):
     """
     Return True if query contains one or more results, otherwise False
+    Only the first result is fetched
     """
     LOG.debug("Checking query returns one or more results")
-    try:
-        query.one()
-    except NoResultFound:
+    if query.first() is None:
         LOG.debug("Query returns no results")
         return False
-    except MultipleResultsFound:
-        LOG.debug("Query returns more than one result")
-    LOG.debug("Query returns one result")
+    LOG.debug("Query returns one or more results")
     return True
 
 
+def column_dtype(column):
+    """
+    Return the numpy dtype used for the values of a table column
+    Nullable integer columns are read as floats so that NULL becomes NaN
+    """
+    if isinstance(column.type, DateTime):
+        return "datetime64[ns]"
+    if isinstance(column.type, Float):
+        return "float64"
+    if isinstance(column.type, Integer):
+        return "float64" if column.nullable else "int64"
+    return object
+
+
+def iter_measurements_since(since_datetime, session=SESSION(),
+                            table=Measurement, datetime_col="datetime",
+                            chunk_size=FETCH_CHUNK_SIZE, until_datetime=None,
+                            archive=ARCHIVE):
+    """
+    Retrieve all measurements since since_datetime (and before
+    until_datetime, if given) in order of time
+    Months held in the archive are read from it, the rest from the db. The
+    rows are streamed with a server-side cursor on PostGres and fetched
+    chunk_size at a time
+    Yields dataframes of up to chunk_size rows with typed numpy columns
+    """
+    LOG.debug("Streaming readings since %s", since_datetime)
+    columns = list(table.__table__.columns)
+    time_col = table.__table__.c[datetime_col]
+    if archive is not None and table is Measurement:
+        archived_until = archive.archived_until()
+        if archived_until is not None and archived_until > since_datetime:
+            LOG.debug("Reading archived readings before %s", archived_until)
+            yield from archive.iter_since(
+                since_datetime, until_datetime,
+                columns=[column.name for column in columns])
+            since_datetime = archived_until.to_pydatetime()
+    statement = select(columns).where(time_col >= since_datetime)
+    if until_datetime is not None:
+        statement = statement.where(time_col < until_datetime)
+    statement = statement.order_by(time_col)\
+                         .execution_options(stream_results=True)
+    result = session.execute(statement)
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            values = zip(*rows)
+            yield pd.DataFrame({
+                column.name: np.array(column_values,
+                                      dtype=column_dtype(column))
+                for column, column_values in zip(columns, values)
+            })
+    finally:
+        result.close()
+
+
 def get_measurements_since(since_datetime, session=SESSION(),
                            table=Measurement,
-                           datetime_col="datetime"):
+                           datetime_col="datetime",
+                           chunk_size=FETCH_CHUNK_SIZE, archive=ARCHIVE):
     """
-    Retrieve all measurements since since_datetime
-    Return as a dataframe
+    Retrieve all measurements since since_datetime in a single query,
+    together with any archived readings
+    Return as a dataframe sorted by time, or None if there are none
     """
     LOG.debug("Querying for all readings since %s", since_datetime)
-    query = session.query(table)\
-                   .filter(getattr(table, datetime_col) >= since_datetime)
-    if one_or_more_results(query):
-        output_cols = [c.name for c in inspect(table).columns]
-        i = query.values(*output_cols)
-        logs = pd.DataFrame(i)
-        logs = logs.sort_values(by=datetime_col)
-    else:
-        logs = None
-    return logs
+    chunks = list(iter_measurements_since(since_datetime, session, table,
+                                          datetime_col, chunk_size,
+                                          archive=archive))
+    if not chunks:
+        return None
+    if len(chunks) == 1:
+        return chunks[0]
+    return pd.concat(chunks, ignore_index=True)
 
 
 def get_last_n_days(ndays_to_display, session=SESSION(),
@@ -359,10 +733,12 @@ def get_last_n_days(ndays_to_display, session=SESSION(),
     return logs
 
 
-def resample_measurements(logs, resample_freq='30T', datetime_col="datetime",
-                          logger_col='sensorid'):
+def resample_measurements_pandas(logs, resample_freq='30T',
+                                 datetime_col="datetime",
+                                 logger_col='sensorid'):
     """
-    Resample logs at the given frequency
+    Resample logs at the given frequency with a pandas groupby
+    Reference implementation for resample_measurements
     return a new dataframe
     """
     LOG.debug("Resampling readings at frequency %s", resample_freq)
@@ -373,6 +749,135 @@ def resample_measurements(logs, resample_freq='30T', datetime_col="datetime",
     return source
 
 
+def resample_measurements(logs, resample_freq='30T', datetime_col="datetime",
+                          logger_col='sensorid'):
+    """
+    Resample logs at the given frequency
+    Bucket numbers are computed with integer arithmetic on the datetimes and
+    all loggers are averaged at once with np.bincount. As with a pandas
+    resample, each logger gets every bucket from its first to its last
+    reading, empty buckets are NaN and buckets start from midnight of the
+    day of its first reading.
+    return a new dataframe
+    """
+    LOG.debug("Resampling readings at frequency %s", resample_freq)
+    assert isinstance(logger_col, str)
+    value_cols = [col for col in logs.columns
+                  if col not in (logger_col, datetime_col)
+                  and pd.api.types.is_numeric_dtype(logs[col])]
+    if logs.empty:
+        return pd.DataFrame(columns=[logger_col, datetime_col] + value_cols)
+    step = pd.tseries.frequencies.to_offset(resample_freq).nanos
+    day = 24 * 3600 * 10**9
+    logger_index, loggers = pd.factorize(logs[logger_col], sort=True)
+    times = pd.to_datetime(logs[datetime_col]).to_numpy().view("int64")
+    readings = np.bincount(logger_index, minlength=len(loggers))
+    order = np.argsort(logger_index, kind="stable")
+    logger_starts = np.concatenate([[0], np.cumsum(readings)[:-1]])
+    first = np.minimum.reduceat(times[order], logger_starts)
+    last = np.maximum.reduceat(times[order], logger_starts)
+    origin = first // day * day
+    first_bucket = (first - origin) // step
+    n_buckets = (last - origin) // step + 1 - first_bucket
+    offset = np.concatenate([[0], np.cumsum(n_buckets)[:-1]])
+    bucket_id = (times - origin[logger_index]) // step\
+        + (offset - first_bucket)[logger_index]
+    n_total = int(n_buckets.sum())
+
+    source = pd.DataFrame({
+        logger_col: np.repeat(np.asarray(loggers), n_buckets),
+    })
+    position = np.arange(n_total) - np.repeat(offset, n_buckets)
+    starts = np.repeat(origin + first_bucket * step, n_buckets)
+    source[datetime_col] = pd.to_datetime(starts + position * step)
+    row_counts = np.bincount(bucket_id, minlength=n_total)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for col in value_cols:
+            values = logs[col].to_numpy(dtype=float)
+            present = ~np.isnan(values)
+            if present.all():
+                counts = row_counts
+            else:
+                values = np.where(present, values, 0)
+                counts = np.bincount(bucket_id, weights=present,
+                                     minlength=n_total)
+            sums = np.bincount(bucket_id, weights=values, minlength=n_total)
+            source[col] = sums / counts
+    return source
+
+
+def freq_to_seconds(resample_freq):
+    """
+    Convert a pandas frequency string, e.g. '30T', to a number of seconds
+    """
+    return pd.tseries.frequencies.to_offset(resample_freq).nanos // 10**9
+
+
+def bucket_expression(time_col, seconds, dialect_name):
+    """
+    Return an SQL expression for the start of the time bucket of length
+    seconds containing time_col, in seconds since the epoch
+    """
+    if dialect_name == "postgresql":
+        epoch = func.extract("epoch", time_col)
+        return func.floor(epoch / seconds) * seconds
+    # integer division in SQLite rounds down for times after the epoch
+    epoch = cast(func.strftime("%s", time_col), Integer)
+    return epoch / seconds * seconds
+
+
+def get_bucketed_measurements(since_datetime, resample_freq='30T',
+                              session=SESSION(), table=Measurement,
+                              datetime_col="datetime", aggregates=("avg",),
+                              sensorids=None):
+    """
+    Retrieve measurements since since_datetime averaged into time buckets of
+    length resample_freq by the database
+    aggregates may also include "min" and "max", which add columns with the
+    suffixes _min and _max for each reading
+    If sensorids is given, only those sensors are included
+    Return as a dataframe with one row per sensor and bucket, or None if
+    there are no measurements
+    """
+    LOG.debug("Querying readings since %s in buckets of %s",
+              since_datetime, resample_freq)
+    dialect_name = session.bind.dialect.name
+    if dialect_name not in ("postgresql", "sqlite"):
+        LOG.debug("No bucketing query for %s, resampling in pandas",
+                  dialect_name)
+        logs = get_measurements_since(since_datetime, session, table,
+                                      datetime_col)
+        if logs is None:
+            return None
+        return resample_measurements(logs, resample_freq, datetime_col)
+    time_col = getattr(table, datetime_col)
+    bucket = bucket_expression(time_col, freq_to_seconds(resample_freq),
+                               dialect_name).label("bucket")
+    value_cols = [col for col in inspect(table).columns
+                  if col.name not in ("sensorid", datetime_col)]
+    aggregated = []
+    for col in value_cols:
+        value = cast(col, Float)
+        aggregated.append(func.avg(value).label(col.name))
+        if "min" in aggregates:
+            aggregated.append(func.min(value).label(f"{col.name}_min"))
+        if "max" in aggregates:
+            aggregated.append(func.max(value).label(f"{col.name}_max"))
+    query = session.query(table.sensorid, bucket, *aggregated)\
+                   .filter(time_col >= since_datetime)
+    if sensorids is not None:
+        query = query.filter(table.sensorid.in_(sensorids))
+    query = query.group_by(table.sensorid, bucket)\
+                 .order_by(table.sensorid, bucket)
+    output_cols = ["sensorid", "bucket"] + [col.name for col in aggregated]
+    logs = pd.DataFrame(query.all(), columns=output_cols)
+    if logs.empty:
+        return None
+    logs.insert(1, datetime_col,
+                pd.to_datetime(logs.pop("bucket").astype("int64"), unit="s"))
+    return logs
+
+
 def get_last_measurement_for_sensor(sensorid, session=SESSION()):
     """
     Get the time of the most recent reading for a given sensorid pi
@@ -396,15 +901,210 @@ def get_last_measurement_for_sensor(sensorid, session=SESSION()):
         return None
 
 
+def copy_insert(frame, table, connection):
+    """
+    Bulk load a dataframe into a PostgreSQL table using COPY into a
+    temporary staging table, followed by an INSERT that skips rows already
+    in the table
+    Returns the number of rows inserted
+    """
+    columns = ", ".join(frame.columns)
+    conflict_cols = ", ".join(col.name for col in table.primary_key)
+    staging = f"{table.name}_staging"
+    frame = frame.copy()
+    for col in frame.columns:
+        if isinstance(table.c[col].type, Integer):
+            frame[col] = frame[col].astype("Int64")
+    buffer = io.StringIO()
+    frame.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.execute(f"CREATE TEMP TABLE {staging} "
+                   f"(LIKE {table.name} INCLUDING DEFAULTS) ON COMMIT DROP")
+    cursor.copy_expert(f"COPY {staging} ({columns}) FROM STDIN "
+                       "WITH (FORMAT csv)", buffer)
+    cursor.execute(f"INSERT INTO {table.name} ({columns}) "
+                   f"SELECT {columns} FROM {staging} "
+                   f"ON CONFLICT ({conflict_cols}) DO NOTHING")
+    return cursor.rowcount
+
+
+def executemany_insert(frame, table, connection):
+    """
+    Insert a dataframe into a table with a single executemany, skipping rows
+    already in the table. Used for databases other than PostgreSQL.
+    Returns the number of rows inserted
+    """
+    columns = ", ".join(frame.columns)
+    values = ", ".join(f":{col}" for col in frame.columns)
+    conflict_cols = ", ".join(col.name for col in table.primary_key)
+    statement = text(f"INSERT INTO {table.name} ({columns}) "
+                     f"VALUES ({values}) "
+                     f"ON CONFLICT ({conflict_cols}) DO NOTHING")
+    statement = statement.bindparams(
+        *[bindparam(col, type_=table.c[col].type) for col in frame.columns]
+    )
+    records = frame.astype(object).where(frame.notnull(), None)\
+                   .to_dict("records")
+    result = connection.execute(statement, records)
+    return result.rowcount
+
+
+def update_latest_measurements(frame, connection):
+    """
+    Store the newest row for each sensor in a dataframe of readings in the
+    latest_measurements table, unless a newer reading is already there
+    """
+    table = LatestMeasurement.__table__
+    newest = frame.sort_values("datetime")\
+                  .drop_duplicates(subset="sensorid", keep="last")
+    columns = [col for col in newest.columns if col in table.c]
+    newest = newest[columns]
+    updates = ", ".join(f"{col} = excluded.{col}" for col in columns
+                        if col != "sensorid")
+    statement = text(
+        f"INSERT INTO {table.name} ({', '.join(columns)}) "
+        f"VALUES ({', '.join(f':{col}' for col in columns)}) "
+        f"ON CONFLICT (sensorid) DO UPDATE SET {updates} "
+        f"WHERE {table.name}.datetime < excluded.datetime"
+    ).bindparams(*[bindparam(col, type_=table.c[col].type)
+                   for col in columns])
+    records = newest.astype(object).where(newest.notnull(), None)\
+                    .to_dict("records")
+    LOG.debug("Updating latest readings for %s sensors", len(records))
+    connection.execute(statement, records)
+
+
+def upsert_measurements(recent_data, table_name="measurements",
+                        engine=ENGINE):
+    """
+    Insert a pandas DataFrame of readings into the db in a single
+    transaction, skipping rows whose primary key is already present
+    engine may also be a connection, to insert within its transaction
+    Returns an InsertCounts tuple of rows inserted and skipped
+    """
+    LOG.debug("Bulk inserting %s rows into table %s",
+              len(recent_data), table_name)
+    table = BASE.metadata.tables[table_name]
+    columns = [col.name for col in table.columns
+               if col.name in recent_data.columns]
+    frame = recent_data[columns]
+    with engine.connect() as connection, connection.begin():
+        if engine.dialect.name == "postgresql":
+            inserted = copy_insert(frame, table, connection)
+        else:
+            inserted = executemany_insert(frame, table, connection)
+        if table_name == Measurement.__tablename__ and inserted:
+            update_latest_measurements(frame, connection)
+    counts = InsertCounts(inserted, len(frame) - inserted)
+    LOG.debug("Rows inserted into %s: %s", table_name, counts)
+    return counts
+
+
+def get_latest_measurements(session=SESSION(), current_only=False):
+    """
+    Get the most recent reading for every sensor, together with the sensor
+    location and pi name, in a single query
+    If current_only set to True, return only readings from active sensors
+    Returns a list of dictionaries in the format of Measurement.get_row
+    """
+    LOG.debug("Querying for last reading from all sensors")
+    # driving the query from sensors makes both the max and the join into
+    # measurements a primary key lookup per sensor
+    newer = aliased(Measurement)
+    last_time = session.query(func.max(newer.datetime))\
+                       .filter(newer.sensorid == Sensor.id)\
+                       .correlate(Sensor).as_scalar()
+    query = session.query(Measurement, Sensor.location, RaspberryPi.name)\
+                   .select_from(Sensor).join(RaspberryPi)\
+                   .join(Measurement, and_(Measurement.sensorid == Sensor.id,
+                                           Measurement.datetime == last_time))
+    if current_only:
+        query = query.filter(Sensor.current.is_(True))
+    result = [measurement.get_row(location, piname)
+              for measurement, location, piname in query.all()]
+    LOG.debug("Last readings found for %s sensors", len(result))
+    return result
+
+
+def get_latest_readings(session=SESSION(), current_only=False):
+    """
+    Read the most recent reading for every sensor from the
+    latest_measurements table, falling back to searching the measurements
+    table if it has not been populated yet
+    If current_only set to True, return only readings from active sensors
+    Returns a list of dictionaries in the format of Measurement.get_row
+    """
+    LOG.debug("Reading latest readings table")
+    query = session.query(LatestMeasurement, Sensor.location,
+                          RaspberryPi.name)\
+                   .join(Sensor, LatestMeasurement.sensorid == Sensor.id)\
+                   .join(RaspberryPi)
+    if current_only:
+        query = query.filter(Sensor.current.is_(True))
+    result = [measurement.get_row(location, piname)
+              for measurement, location, piname in query.all()]
+    if not result:
+        LOG.debug("Latest readings table is empty, querying measurements")
+        result = get_latest_measurements(session, current_only)
+    return result
+
+
+def get_data_watermark(session=SESSION()):
+    """
+    Get the time of the most recent reading from any sensor, read from the
+    small latest_measurements table where possible
+    Returns a datetime, or None if there are no readings
+    """
+    LOG.debug("Querying time of most recent reading")
+    watermark = session.query(func.max(LatestMeasurement.datetime)).scalar()
+    if watermark is None:
+        watermark = session.query(func.max(Measurement.datetime)).scalar()
+    return watermark
+
+
+def rebuild_latest_measurements(session=SESSION(), engine=ENGINE):
+    """
+    Fill the latest_measurements table from the measurements table, e.g.
+    after creating it in an existing database
+    """
+    LOG.debug("Rebuilding latest readings table")
+    latest = pd.DataFrame(get_latest_measurements(session))
+    if latest.empty:
+        return
+    with engine.begin() as connection:
+        update_latest_measurements(latest, connection)
+
+
+def ensure_latest_measurements(engine=ENGINE):
+    """
+    Rebuild the latest_measurements table if it is empty while the
+    measurements table is not, as it is after being added to an existing db.
+    Otherwise sensors without new readings since would be missing from it.
+    """
+    with engine.connect() as connection:
+        has_latest = connection.execute(
+            select([LatestMeasurement.sensorid]).limit(1)).first()
+        has_readings = connection.execute(
+            select([Measurement.sensorid]).limit(1)).first()
+    if has_latest is None and has_readings is not None:
+        LOG.info("Filling latest_measurements from measurements")
+        session = sessionmaker(bind=engine)()
+        try:
+            rebuild_latest_measurements(session, engine)
+        finally:
+            session.close()
+
+
 def save_recent_data(recent_data, table_name="measurements", engine=ENGINE):
     """
     send a pandas DataFrame of readings pulled from the pi_logger api to SQL
+    Readings that are already in the table are skipped
     """
     LOG.debug("Attempting to save data to table %s", table_name)
     LOG.debug("Data to save is %s", recent_data)
     try:
-        recent_data.to_sql(table_name, engine, index=False,
-                           if_exists="append")
+        upsert_measurements(recent_data, table_name, engine)
         LOG.debug("No exceptions raised by SQLalchemy on saving data")
         return True
     except sqlalchemy.exc.IntegrityError as exception:
@@ -414,3 +1114,4 @@ def save_recent_data(recent_data, table_name="measurements", engine=ENGINE):
 
 if __name__ == "__main__":
     create_tables(ENGINE)
+    migrate_measurements(ENGINE)
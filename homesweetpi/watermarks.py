@@ -0,0 +1,92 @@
+"""
+Module for keeping track of the most recent reading saved for each pi.
+
+The high-water marks are loaded once with a single grouped query (or from a
+json file if one has been configured) and then updated in memory after each
+successful save, so a retrieval round does not need to search the
+measurements table to know where each pi left off. Readings a pi pushes to
+the api server do not move its watermark: polling picks up from the last
+reading it pulled itself, so it fetches anything a failed push left out,
+and readings that were pushed are skipped as duplicates. Configure a json
+file to keep these pull watermarks across restarts, as the db only knows
+the latest reading saved by either route.
+"""
+import os
+import json
+import logging
+import threading
+import pandas as pd
+from homesweetpi.sql_tables import get_last_times, get_last_time, SESSION
+
+LOG = logging.getLogger("homesweetpi.watermarks")
+
+WATERMARK_FILE = os.getenv("HSP_WATERMARK_FILE")
+
+
+class WatermarkCache():
+    """
+    Per-pi record of the time of the most recent reading in the db
+    """
+    def __init__(self, path=WATERMARK_FILE):
+        self.path = path
+        self.watermarks = None
+        self.lock = threading.Lock()
+
+    def load(self, session=SESSION()):
+        """
+        Load the watermarks from file if it exists, otherwise from the db
+        """
+        if self.path is not None and os.path.exists(self.path):
+            LOG.debug("Loading watermarks from %s", self.path)
+            with open(self.path) as watermark_file:
+                stored = json.load(watermark_file)
+            self.watermarks = {piid: pd.Timestamp(last_time).to_pydatetime()
+                               for piid, last_time in stored.items()}
+        else:
+            LOG.debug("Loading watermarks from db")
+            self.watermarks = get_last_times(session=session)
+        LOG.debug("Watermarks: %s", self.watermarks)
+
+    def get(self, piid, session=SESSION()):
+        """
+        Return the time of the most recent reading saved for a pi
+        Pis not yet seen are looked up individually once and then cached
+        """
+        with self.lock:
+            if self.watermarks is None:
+                self.load(session)
+            if piid not in self.watermarks:
+                self.watermarks[piid] = get_last_time(piid, session=session)
+            return self.watermarks[piid]
+
+    def update(self, piid, last_time):
+        """
+        Advance the watermark for a pi after new readings have been saved
+        """
+        if hasattr(last_time, "to_pydatetime"):
+            last_time = last_time.to_pydatetime()
+        with self.lock:
+            if self.watermarks is None:
+                self.watermarks = {}
+            current = self.watermarks.get(piid)
+            if current is not None and current >= last_time:
+                return
+            LOG.debug("Watermark for pi %s advanced to %s", piid, last_time)
+            self.watermarks[piid] = last_time
+            self.save()
+
+    def save(self):
+        """
+        Write the watermarks to file, if a path has been configured
+        """
+        if self.path is None:
+            return
+        stored = {piid: last_time.isoformat()
+                  for piid, last_time in self.watermarks.items()}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as watermark_file:
+            json.dump(stored, watermark_file)
+        os.replace(tmp_path, self.path)
+
+
+WATERMARKS = WatermarkCache()
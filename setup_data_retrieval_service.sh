@@ -1,44 +1,48 @@
 #!/bin/bash
 
+service_name=data_retrieval
+unit_file=$service_name.service
+timer_file=$service_name.timer
+service_path=/etc/systemd/system/
+# remove the timer that used to start a retrieval round every 5 minutes,
+# also on installs that were set up before the service became long-running
+if [ -e $service_path$timer_file ]
+then
+  echo "removing $timer_file from $service_path"
+  systemctl stop $timer_file
+  systemctl disable $timer_file
+  rm $service_path$timer_file
+  systemctl daemon-reload
+fi
+
 # check to see if this has been done already
-flag=data_retrieval_service_set_up_complete
+flag=data_retrieval_daemon_set_up_complete
 if [ ! -e $flag ]
 then
-  service_name=data_retrieval
-  unit_file=$service_name.service
-  timer_file=$service_name.timer
-  service_path=/etc/systemd/system/
-  # set up logging as a service
+  # run data retrieval as a long-running service
   echo "creating $unit_file in $service_path"
   cat > $service_path$unit_file << EOF
 [Unit]
 Description=Retrieve data from pis and add to postgres db
-After=multi-user.target
+Wants=network-online.target
+After=network-online.target
 
 [Service]
 WorkingDirectory=$PWD
 User=$USER
-ExecStart=$PWD/env/bin/python3 homesweetpi/retrieve_data.py
-
-[Install]
-WantedBy=multi-user.target
-EOF
-  echo "Creating $timer_file in $service_path"
-  cat > $service_path$timer_file << EOF
-[Unit]
-Description=Schedule retrieval of data from pis
-
-[Timer]
-OnCalendar=*-*-* *:01/5:00
-Unit=$unit_file
+ExecStart=$PWD/env/bin/python3 -m homesweetpi.cli daemon
+KillSignal=SIGTERM
+TimeoutStopSec=120
+Restart=on-failure
+RestartSec=30
 
 [Install]
 WantedBy=multi-user.target
 EOF
   echo "reloading systemd daemon and enabling service"
   systemctl daemon-reload
-  systemctl start $timer_file
-  systemctl enable $timer_file
+  systemctl enable $unit_file
+  systemctl restart $unit_file
   echo "creating file '$flag'' as flag"
   touch $flag
 fi
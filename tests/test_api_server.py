@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""
+Tests for homesweetpi's api_server module.
+Only routes that do not need the PostGres db are exercised here, apart from
+ingestion which is pointed at an SQLite db.
+"""
+
+import io
+import gzip
+import threading
+from functools import partial
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from homesweetpi import api_server
+from homesweetpi.api_server import app
+from homesweetpi.payloads import COMPACT_MEDIA_TYPE, encode_compact
+from homesweetpi.retrieve_data import ingest_payload
+from homesweetpi.sql_tables import create_tables, load_sensor_and_pi_info
+
+INGEST_HEADERS = {"Authorization": "Bearer secret"}
+
+
+def test_chart_page_points_at_spec_route():
+    """Check chart pages load their spec from the chart_spec route"""
+    client = app.test_client()
+    response = client.get('/air_charts?n_days=3')
+    assert response.status_code == 200
+    assert b'"/chart_spec/air?n_days=3"' in response.data
+
+
+def test_unknown_chart_view_not_found():
+    """Check requesting the spec of an unknown view returns 404"""
+    client = app.test_client()
+    assert client.get('/chart_spec/kitchen').status_code == 404
+
+
+def test_cache_stats_route():
+    """Check the cache statistics debug route reports every cache"""
+    client = app.test_client()
+    stats = client.get('/debug/cache_stats').get_json()
+    assert set(stats) == {"chart_cache", "chart_artifacts", "sensor_cache",
+                          "ingest_buffer"}
+
+
+def test_chart_spec_loads_data_from_url():
+    """
+    Check the chart spec holds no data and points at the chart_data route
+    """
+    client = app.test_client()
+    response = client.get('/chart_spec/plant?n_days=3')
+    spec = response.get_json()
+    assert response.status_code == 200
+    assert spec["spec"]["data"]["url"] == "/chart_data/plant?n_days=3"
+    assert "datasets" not in spec
+    etag = response.headers["ETag"]
+    revalidated = client.get('/chart_spec/plant?n_days=3',
+                             headers={"If-None-Match": etag})
+    assert revalidated.status_code == 304
+
+
+def test_chart_data_validators_follow_served_artifact(monkeypatch):
+    """
+    Check the ETag and Last-Modified of chart data describe the artifact
+    served, so a client holding an older artifact gets the fresh one once
+    it has been written
+    """
+    older, newer = pd.Timestamp("2020-03-20 12:00"), pd.Timestamp(
+        "2020-03-20 12:05")
+    served = {"watermark": older.to_pydatetime()}
+    monkeypatch.setattr(api_server, "chart_data_watermark",
+                        lambda *args, **kwargs: served["watermark"])
+    monkeypatch.setattr(api_server, "get_chart_data",
+                        lambda *args, **kwargs: repr(
+                            kwargs["watermark"]).encode())
+    client = app.test_client()
+    response = client.get('/chart_data/air')
+    assert response.last_modified == older.to_pydatetime()
+    etag = response.headers["ETag"]
+    assert client.get('/chart_data/air', headers={"If-None-Match": etag})\
+        .status_code == 304
+    served["watermark"] = newer.to_pydatetime()
+    refreshed = client.get('/chart_data/air', headers={"If-None-Match": etag})
+    assert refreshed.status_code == 200
+    assert refreshed.data == repr(newer.to_pydatetime()).encode()
+    assert refreshed.headers["ETag"] != etag
+
+
+def test_ingest_rejects_missing_or_wrong_token(monkeypatch):
+    """
+    Check ingestion is refused while no token is configured and without
+    the configured token
+    """
+    client = app.test_client()
+    assert client.post('/ingest', data=b"{}").status_code == 401
+    monkeypatch.setattr(api_server, "INGEST_TOKEN", "secret")
+    assert client.post('/ingest', data=b"{}").status_code == 401
+    response = client.post('/ingest', data=b"{}",
+                           headers={"Authorization": "Bearer wrong"})
+    assert response.status_code == 401
+    assert response.headers["WWW-Authenticate"] == "Bearer"
+
+
+def test_ingest_backpressure(monkeypatch):
+    """
+    Check ingestion asks pis to retry later while every slot is taken and
+    rejects batches over the size limit
+    """
+    client = app.test_client()
+    monkeypatch.setattr(api_server, "INGEST_TOKEN", "secret")
+    slots = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(api_server, "INGEST_SLOTS", slots)
+    slots.acquire()
+    response = client.post('/ingest', data=b"{}", headers=INGEST_HEADERS)
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) > 0
+    slots.release()
+    monkeypatch.setattr(api_server, "INGEST_MAX_BYTES", 1)
+    response = client.post('/ingest', data=b"{}", headers=INGEST_HEADERS)
+    assert response.status_code == 413
+
+
+def test_ingest_limits_chunked_and_decompressed_size(monkeypatch):
+    """
+    Check the size limits also apply to bodies sent without a
+    Content-Length and to the decompressed size of gzipped bodies
+    """
+    client = app.test_client()
+    monkeypatch.setattr(api_server, "INGEST_TOKEN", "secret")
+    monkeypatch.setattr(api_server, "INGEST_MAX_BYTES", 1000)
+    chunked = dict(INGEST_HEADERS, **{"Transfer-Encoding": "chunked"})
+    response = client.post('/ingest', input_stream=io.BytesIO(b"x" * 2000),
+                           headers=chunked, environ_overrides={
+                               "wsgi.input_terminated": True})
+    assert response.status_code == 413
+    monkeypatch.setattr(api_server, "INGEST_MAX_DECOMPRESSED_BYTES", 10000)
+    bomb = gzip.compress(b" " * 100000)
+    gzipped = dict(INGEST_HEADERS, **{"Content-Encoding": "gzip"})
+    response = client.post('/ingest', data=bomb, headers=gzipped)
+    assert response.status_code == 413
+
+
+def test_ingest_saves_compact_batch(monkeypatch, tmp_path):
+    """
+    Check a gzipped compact batch is saved to an SQLite db once, and a
+    malformed batch is rejected
+    """
+    engine = create_engine(f"sqlite:///{tmp_path / 'ingest.db'}")
+    create_tables(engine)
+    load_sensor_and_pi_info("pi_ip.csv", "logger_config.csv", engine=engine)
+    monkeypatch.setattr(api_server, "INGEST_TOKEN", "secret")
+    monkeypatch.setattr(api_server, "ingest_payload",
+                        partial(ingest_payload,
+                                session_factory=sessionmaker(bind=engine),
+                                engine=engine))
+    readings = pd.DataFrame({
+        "datetime": pd.date_range("2020-03-20", periods=10, freq="10S"),
+        "location": "bay",
+        "piname": "catflap",
+        "piid": "100000003d12f229",
+        "temp": None,
+        "mcdvalue": np.arange(10),
+    })
+    headers = dict(INGEST_HEADERS, **{"Content-Type": COMPACT_MEDIA_TYPE})
+    client = app.test_client()
+    body = encode_compact(readings)
+    saved = client.post('/ingest', data=body, headers=headers).get_json()
+    assert saved == dict(rows=10, inserted=10, skipped=0)
+    resent = client.post('/ingest', data=body, headers=headers).get_json()
+    assert resent == dict(rows=10, inserted=0, skipped=10)
+    response = client.post('/ingest', data=b"not json",
+                           headers=INGEST_HEADERS)
+    assert response.status_code == 400
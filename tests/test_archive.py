@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+Tests for homesweetpi's archive and maintenance modules.
+Creates an SQLite db instead of the usual PostGres
+"""
+
+import os
+import logging
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from homesweetpi.sql_tables import create_tables, load_sensor_and_pi_info,\
+                                   upsert_measurements, Measurement,\
+                                   get_measurements_since, get_last_times,\
+                                   get_last_time
+from homesweetpi.archive import MeasurementArchive
+from homesweetpi.maintenance import archive_closed_months, closed_months
+from homesweetpi.rollups import get_chart_measurements
+
+LOG = logging.getLogger("homesweetpi.test_archive")
+
+TEST_TIME = datetime.now()
+TEST_DB_PATH = os.getcwd()
+TEST_DB_FILENAME = "test_archive_{}.db".format(
+    TEST_TIME.strftime("%Y%m%d_%H%M%S"))
+TEST_DB_FILEPATH = os.path.join(TEST_DB_PATH, TEST_DB_FILENAME)
+CONN_STRING = f'sqlite:///{TEST_DB_FILEPATH}'
+ENGINE = create_engine(CONN_STRING, echo=False)
+SESSION = sessionmaker(bind=ENGINE)
+
+PI_FILE = "pi_ip.csv"
+SENSOR_FILE = "logger_config.csv"
+START = pd.Timestamp(TEST_TIME).floor("1D") - pd.DateOffset(months=3)
+
+
+def make_hourly_readings(start, end, sensorids=(0, 1)):
+    """
+    Return a dataframe of one reading per hour per sensor from start to end
+    """
+    times = pd.date_range(start, end, freq="1H")
+    frames = []
+    for sensorid in sensorids:
+        frames.append(pd.DataFrame({
+            "datetime": times,
+            "sensorid": sensorid,
+            "temp": np.linspace(15, 25, len(times)) + sensorid,
+            "humidity": np.linspace(40, 60, len(times)),
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def test_set_up_db():
+    """Create the tables, sensor info and readings in the SQLite db"""
+    create_tables(ENGINE)
+    load_sensor_and_pi_info(PI_FILE, SENSOR_FILE, engine=ENGINE)
+    readings = make_hourly_readings(START, TEST_TIME)
+    assert upsert_measurements(readings, engine=ENGINE).inserted
+
+
+def test_archive_round_trip(tmp_path):
+    """Check an archived month reads back sorted by time with its columns"""
+    archive = MeasurementArchive(str(tmp_path))
+    readings = make_hourly_readings("2020-01-01", "2020-01-31 23:00")
+    assert archive.write_month("2020-01-15", readings) == len(readings)
+    assert archive.months() == [pd.Timestamp("2020-01-01")]
+    assert archive.archived_until() == pd.Timestamp("2020-02-01")
+    columns = ["sensorid", "datetime", "temp", "humidity"]
+    logs = archive.read_month("2020-01", since_datetime="2020-01-10",
+                              columns=columns)
+    expected = readings[readings["datetime"] >= "2020-01-10"]\
+        .sort_values("datetime", kind="mergesort")\
+        .reset_index(drop=True)[columns]
+    pd.testing.assert_frame_equal(logs, expected, check_dtype=False)
+
+
+def test_archive_closed_months(tmp_path):
+    """
+    Check closed months move from the db to the archive and queries return
+    the same readings as before
+    """
+    archive = MeasurementArchive(str(tmp_path))
+    since = START.to_pydatetime()
+    before = get_measurements_since(since, session=SESSION(), archive=None)
+    chart_before = get_chart_measurements(100, "1H", SESSION(),
+                                          archive=archive)
+    last_times = get_last_times(session=SESSION())
+    months = closed_months(session=SESSION(), now=TEST_TIME)
+    assert len(months) == 2
+    archived = archive_closed_months(session=SESSION(), engine=ENGINE,
+                                     archive=archive, now=TEST_TIME)
+    assert sum(archived.values()) == (before["datetime"]
+                                      < archive.archived_until()).sum()
+    first_live = SESSION().query(Measurement.datetime)\
+                          .order_by(Measurement.datetime).first()[0]
+    assert first_live >= archive.archived_until()
+    after = get_measurements_since(since, session=SESSION(), archive=archive)
+    pd.testing.assert_frame_equal(after, before)
+    chart_after = get_chart_measurements(100, "1H", SESSION(),
+                                         archive=archive)
+    pd.testing.assert_frame_equal(chart_after, chart_before,
+                                  check_dtype=False)
+    assert get_last_times(session=SESSION()) == last_times
+    assert get_last_time("unknown", session=SESSION())\
+        == datetime(1970, 1, 1)
+    assert not archive_closed_months(session=SESSION(), engine=ENGINE,
+                                     archive=archive, now=TEST_TIME)
+
+
+def test_late_readings_merged_into_archived_month(tmp_path):
+    """
+    Check readings that arrive for a month after it was archived are moved
+    into the archive on the next run
+    """
+    archive = MeasurementArchive(str(tmp_path))
+    month = START.to_period("M").to_timestamp()
+    archive.write_month(month, make_hourly_readings(
+        month, month + pd.offsets.MonthBegin() - pd.Timedelta("1H")))
+    late = make_hourly_readings(month + pd.Timedelta("30T"),
+                                month + pd.Timedelta("150T"), sensorids=(0,))
+    assert upsert_measurements(late, engine=ENGINE).inserted == len(late)
+    archived = archive_closed_months(session=SESSION(), engine=ENGINE,
+                                     archive=archive, now=TEST_TIME)
+    assert archived == {f"{month:%Y-%m}": len(late)}
+    logs = get_measurements_since(month.to_pydatetime(), session=SESSION(),
+                                  archive=archive)
+    assert len(logs) > len(late)
+    assert set(late["datetime"]) <= set(logs["datetime"])
+    assert not logs.duplicated(subset=["sensorid", "datetime"]).any()
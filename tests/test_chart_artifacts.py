@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+"""
+Tests for homesweetpi's chart_artifacts module.
+"""
+
+from datetime import datetime
+from homesweetpi.chart_artifacts import ChartArtifactStore, artifact_name
+
+
+def test_artifact_name_includes_watermark():
+    """Check artifacts of different data have different names"""
+    old = artifact_name("air", 7, "30T", "csv", True, datetime(2020, 1, 1))
+    new = artifact_name("air", 7, "30T", "csv", True, datetime(2020, 1, 2))
+    assert old != new
+    assert new.endswith(".csv.gz")
+    assert artifact_name("air", 7, "30T", "csv", False, None).endswith("csv")
+
+
+def test_write_read_and_prune(tmp_path):
+    """Check artifacts round trip and stale ones are pruned"""
+    store = ChartArtifactStore(str(tmp_path))
+    store.write("old.csv", b"a,b\n")
+    store.write("new.csv", b"a,b\n1,2\n")
+    assert store.read("new.csv") == b"a,b\n1,2\n"
+    store.prune({"new.csv"})
+    assert store.read("old.csv") is None
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["new.csv"]
+    assert store.stats()["hits"] == 1
+    assert store.stats()["misses"] == 1
+
+
+def test_disabled_store():
+    """Check a store without a directory never writes or hits"""
+    store = ChartArtifactStore(None)
+    store.write("x.csv", b"x")
+    assert store.read("x.csv") is None
+
+
+def test_latest_artifact(tmp_path):
+    """Check the newest artifact of a view, range and format is found"""
+    store = ChartArtifactStore(str(tmp_path))
+    for day in (1, 3, 2):
+        store.write(artifact_name("air", 7, "30T", "csv", True,
+                                  datetime(2020, 1, day)), bytes([day]))
+    store.write(artifact_name("air", 7, "30T", "csv", False,
+                              datetime(2020, 1, 4)), b"plain")
+    store.write(artifact_name("all", 7, "30T", "csv", True,
+                              datetime(2020, 1, 5)), b"all")
+    name, watermark = store.latest("air", 7, "30T", "csv", True)
+    assert watermark == datetime(2020, 1, 3)
+    assert store.read(name) == bytes([3])
+    assert store.latest("air", 7, "30T", "csv", False)[1] \
+        == datetime(2020, 1, 4)
+    assert store.latest("plant", 7, "30T", "csv", True) == (None, None)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+"""
+Tests for homesweetpi's chart_cache module.
+"""
+
+from homesweetpi.chart_cache import ChartCache
+
+
+def test_cache_hit_and_miss():
+    """Check a cached chart is returned and counted as a hit"""
+    cache = ChartCache(max_entries=2, max_bytes=100)
+    assert cache.get("a") is None
+    cache.put("a", "{}")
+    assert cache.get("a") == "{}"
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_least_recently_used_evicted_first():
+    """Check the entry limit evicts the least recently used chart"""
+    cache = ChartCache(max_entries=2, max_bytes=100)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    cache.get("a")
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+
+
+def test_size_limit_respected():
+    """Check the total size of cached charts stays within max_bytes"""
+    cache = ChartCache(max_entries=10, max_bytes=10)
+    for key in "abcd":
+        cache.put(key, "x" * 4)
+    assert cache.stats()["bytes"] <= 10
+    assert cache.stats()["entries"] == 2
+    cache.put("big", "x" * 11)
+    assert cache.get("big") is None
@@ -0,0 +1,30 @@
+"""
+Tests for the homesweetpi console script
+"""
+import logging
+from homesweetpi import log_to_console
+from homesweetpi.cli import main
+
+
+def test_log_level_filters_package_records(capsys):
+    """
+    Check the console only shows the records of homesweetpi at the chosen
+    level or above, although the package logger itself is at DEBUG
+    """
+    root = logging.getLogger()
+    level, handlers = root.level, list(root.handlers)
+    try:
+        assert main(["--log-level", "warning"]) == 0
+        log = logging.getLogger("homesweetpi.cli")
+        log.info("not shown")
+        log.warning("shown")
+        err = capsys.readouterr().err
+        assert "shown" in err
+        assert "not shown" not in err
+        handler = log_to_console(logging.DEBUG)
+        log.debug("now shown")
+        assert "now shown" in capsys.readouterr().err
+        assert handler in root.handlers
+    finally:
+        root.handlers = handlers
+        root.setLevel(level)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+Tests for homesweetpi's daemon module.
+Polls are recorded instead of being sent to pis.
+"""
+
+import threading
+import time
+from concurrent.futures import Future
+from sqlalchemy.exc import OperationalError
+from homesweetpi.daemon import RetrievalDaemon, next_due, PI_RETRY_SECONDS
+from homesweetpi.retrieve_data import PollResult
+
+
+class FakeClock():
+    """Clock that only moves when told to"""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ImmediateExecutor():
+    """Executor running each task as soon as it is submitted"""
+    def submit(self, function, *args):
+        """Run function and return its finished future"""
+        future = Future()
+        future.set_result(function(*args))
+        return future
+
+    def shutdown(self, wait=True):
+        """Nothing to shut down"""
+
+
+class FakeSession():
+    """Stand-in for a db session"""
+    def close(self):
+        """Nothing to close"""
+
+
+class FakeClient():
+    """Stand-in for PiHttpClient"""
+    def __init__(self):
+        self.closed = False
+
+    def log_connection_stats(self):
+        """Nothing to log"""
+
+    def close(self):
+        """Record that the client was closed"""
+        self.closed = True
+
+
+def make_daemon(clock, pis, polls, **kwargs):
+    """
+    Return a daemon polling the pis listed in pis, recording the time of
+    each poll in polls
+    """
+    def poll(piid, **_):
+        polls.append((piid, clock()))
+        return PollResult(piid, "no data", 0, 0, 0.0)
+
+    return RetrievalDaemon(session_factory=FakeSession, client=FakeClient(),
+                           poll=poll, list_pis=lambda session: list(pis),
+                           clock=clock, seed=1, **kwargs)
+
+
+def test_next_due_skips_missed_periods():
+    """Check the schedule stays on its fixed rate when polls overrun"""
+    assert next_due(100, 60, 100) == 160
+    assert next_due(100, 60, 159) == 160
+    assert next_due(100, 60, 230) == 280
+
+
+def test_polls_each_pi_at_fixed_rate():
+    """
+    Check each pi is polled once per period without drifting, pis are
+    spread over the period, and the pi list is refreshed
+    """
+    clock, pis, polls = FakeClock(), ["a", "b", "c"], []
+    daemon = make_daemon(clock, pis, polls, freq=60, jitter=0,
+                         refresh_seconds=300)
+    daemon.executor = ImmediateExecutor()
+    daemon.next_refresh, daemon.next_charts = 0.0, 60.0
+    while clock.now < 600:
+        if clock.now == 290:
+            pis.remove("c")
+            pis.append("d")
+        daemon.step()
+        clock.now += 1
+    times = {piid: [at for polled, at in polls if polled == piid]
+             for piid in "abcd"}
+    for piid in "ab":
+        assert len(times[piid]) == 10
+        assert {later - earlier for earlier, later
+                in zip(times[piid], times[piid][1:])} == {60}
+    assert len({times[piid][0] for piid in "abc"}) == 3
+    assert max(times["c"]) < 300
+    assert min(times["d"]) >= 300
+
+
+def test_stop_waits_for_polls_and_closes_client():
+    """Check stopping the daemon shuts it down cleanly"""
+    polls = []
+    daemon = make_daemon(lambda: 0.0, ["a"], polls, freq=0.01, jitter=0)
+    daemon.clock = time.monotonic
+    runner = threading.Thread(target=daemon.run)
+    runner.start()
+    daemon.stopping.wait(0.2)
+    daemon.stop()
+    runner.join(5)
+    assert not runner.is_alive()
+    assert polls
+    assert daemon.client.closed
+
+
+def test_failed_first_pi_load_retried_quickly():
+    """
+    Check a db error on the first load of the pi list is retried soon
+    rather than after the full refresh interval
+    """
+    clock, polls, attempts = FakeClock(), [], []
+
+    def list_pis(session):
+        attempts.append(clock())
+        if len(attempts) == 1:
+            raise OperationalError("SELECT", {}, Exception("db down"))
+        return ["a"]
+
+    daemon = make_daemon(clock, [], polls, freq=60, jitter=0,
+                         refresh_seconds=3600)
+    daemon.list_pis = list_pis
+    daemon.executor = ImmediateExecutor()
+    daemon.next_refresh, daemon.next_charts = 0.0, 60.0
+    while clock.now < 120:
+        daemon.step()
+        clock.now += 1
+    assert attempts == [0, PI_RETRY_SECONDS]
+    assert polls
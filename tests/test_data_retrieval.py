@@ -5,11 +5,17 @@ Tests for homesweetpi's data_retrieval module.
 """
 
 import os
+import json
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from homesweetpi.retrieve_data import fetch_recent_data
+from homesweetpi.retrieve_data import fetch_recent_data, retrieve_data,\
+                                      iter_recent_pages, parse_payload
+from homesweetpi.payloads import decode_payload
+from homesweetpi.watermarks import WatermarkCache
 
 LOG = logging.getLogger("homesweetpi.test_sql_tables")
 TEST_DB_PATH = os.getcwd()
@@ -20,6 +26,41 @@ ENGINE = create_engine(CONN_STRING, echo=False)
 SESSION = sessionmaker(bind=ENGINE)
 
 
+def epoch_ms(datetime_):
+    """Milliseconds since the epoch for a naive UTC datetime"""
+    return round((datetime_ - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+class PagingPiClient():
+    """
+    Stand-in for PiHttpClient serving readings the way a pi_logger api that
+    supports the limit parameter would
+    """
+    def __init__(self, times):
+        self.times = times
+        self.requests = 0
+
+    def get(self, url, timeout=None, params=None, headers=None):
+        """Return the readings since the time in the url, up to limit"""
+        self.requests += 1
+        since = datetime.strptime(url.rsplit("/", 1)[-1], '%Y%m%d%H%M%S')
+        rows = [t for t in self.times if t >= since][:params["limit"]]
+        return PagingResponse({
+            "datetime": {str(i): epoch_ms(t) for i, t in enumerate(rows)},
+            "piid": {str(i): "0000abcd" for i, _ in enumerate(rows)},
+        })
+
+
+class PagingResponse():
+    """Minimal response object holding a decoded json"""
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self):
+        """Return the payload"""
+        return self.payload
+
+
 def test_connection_handling():
     """
     Check the programs ability to handle connection problems gracefully
@@ -32,3 +73,62 @@ def test_connection_handling():
     data = fetch_recent_data(pi_id=piid, query_time=qtime, session=SESSION(),
                              port=9999)
     assert data is None
+
+
+def test_retrieve_data_reports_unreachable_pis():
+    """
+    Check a concurrent retrieval round reports the outcome for each pi rather
+    than raising when a pi cannot be reached
+    """
+    piids = ['0000abcd', '0000abcd']
+    results = retrieve_data(piids, max_workers=2, session_factory=SESSION,
+                            engine=ENGINE, port=9999, timeout=(0.5, 0.5),
+                            watermarks=WatermarkCache(path=None))
+    assert [result.piid for result in results] == piids
+    assert all(result.outcome == "unreachable" for result in results)
+    assert all(result.latency >= 0 for result in results)
+
+
+def test_iter_recent_pages_walks_whole_backlog():
+    """
+    Check a backlog larger than the page size is fetched in several pages
+    that between them cover every reading
+    """
+    start = datetime(2020, 3, 20, 12)
+    times = [start + timedelta(seconds=i) for i in range(5)]
+    client = PagingPiClient(times)
+    pages = list(iter_recent_pages("0.0.0.0", start, client=client,
+                                   page_size=2))
+    fetched = set()
+    for page in pages:
+        assert len(page["datetime"]) <= 2
+        fetched.update(page["datetime"].values())
+    assert len(pages) > 1
+    assert fetched == {epoch_ms(t) for t in times}
+
+
+def test_parse_payload_maps_sensors_and_types():
+    """
+    Check a payload is parsed into typed columns labelled with sensor ids,
+    dropping readings from unknown sensors and duplicates
+    """
+    sensors = pd.DataFrame({"sensorid": [7, 8], "location": ["bay", "allo"],
+                            "piname": ["catflap", "catflap"]})
+    start = epoch_ms(datetime(2020, 3, 20, 12))
+    payload = json.dumps(json.dumps({
+        "id": {"0": 1, "1": 2, "2": 3, "3": 4},
+        "datetime": {"0": start, "1": start, "2": start, "3": start},
+        "location": {"0": "bay", "1": "allo", "2": "attic", "3": "bay"},
+        "piname": {"0": "catflap", "1": "catflap", "2": "catflap",
+                   "3": "catflap"},
+        "piid": {"0": "abcd", "1": "abcd", "2": "abcd", "3": "abcd"},
+        "temp": {"1": 20.5, "0": None, "2": 1.0, "3": None},
+        "mcdvalue": {"0": 512, "1": 480, "2": 1, "3": 512},
+    }))
+    parsed = parse_payload(decode_payload(payload.encode()), sensors)
+    assert parsed["sensorid"].tolist() == [7, 8]
+    assert parsed["datetime"].tolist() == [datetime(2020, 3, 20, 12)] * 2
+    assert np.isnan(parsed["temp"][0]) and parsed["temp"][1] == 20.5
+    assert parsed["mcdvalue"].dtype == "int64"
+    assert set(parsed.columns) == {"datetime", "temp", "mcdvalue",
+                                   "sensorid"}
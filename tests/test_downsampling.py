@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+Tests for homesweetpi's downsampling module.
+"""
+
+import numpy as np
+import pandas as pd
+from homesweetpi.downsampling import minmax_downsample, points_for_width,\
+                                     expand_extremes
+
+
+def make_series(periods, sensorids=(0, 1)):
+    """
+    Return a dataframe of one reading per minute per sensor
+    """
+    times = pd.date_range("2020-01-01", periods=periods, freq="1T")
+    frames = [pd.DataFrame({"datetime": times, "sensorid": sensorid,
+                            "humidity": np.full(periods, 50.0) + sensorid,
+                            "temp": np.linspace(15, 25, periods)})
+              for sensorid in sensorids]
+    return pd.concat(frames, ignore_index=True)
+
+
+def test_short_series_unchanged():
+    """Check series within the point budget are returned as they are"""
+    source = make_series(10)
+    pd.testing.assert_frame_equal(minmax_downsample(source, 20), source)
+
+
+def test_spikes_kept_and_points_bounded():
+    """
+    Check a one-reading humidity spike survives downsampling and each series
+    is reduced to at most max_points in time order
+    """
+    source = make_series(10000)
+    source.loc[1234, "humidity"] = 95.0
+    source.loc[10000 + 4321, "humidity"] = 5.0
+    envelope = minmax_downsample(source, 100)
+    counts = envelope.groupby("sensorid").size()
+    assert (counts <= 100).all()
+    assert envelope["humidity"].max() == 95.0
+    assert envelope["humidity"].min() == 5.0
+    for _, series in envelope.groupby("sensorid"):
+        assert series["datetime"].is_monotonic_increasing
+    assert envelope["temp"].min() == 15.0
+    assert envelope["temp"].max() == 25.0
+
+
+def test_min_max_order_follows_readings():
+    """Check a falling bucket puts its maximum before its minimum"""
+    source = pd.DataFrame({
+        "datetime": pd.date_range("2020-01-01", periods=8, freq="1T"),
+        "sensorid": 0,
+        "temp": [8.0, 7.0, 6.0, 5.0, 1.0, 2.0, 3.0, 4.0],
+    })
+    envelope = minmax_downsample(source, 4)
+    assert envelope["temp"].tolist() == [8.0, 5.0, 1.0, 4.0]
+
+
+def test_expand_extremes_replaces_averaged_buckets():
+    """
+    Check buckets with raw extremes become a min and a max row, while
+    buckets without them keep their averages
+    """
+    source = pd.DataFrame({
+        "sensorid": 0,
+        "datetime": pd.date_range("2020-01-01", periods=2, freq="30T"),
+        "temp": [20.0, 21.0],
+    })
+    extremes = pd.DataFrame({
+        "sensorid": [0], "datetime": [pd.Timestamp("2020-01-01")],
+        "temp_min": [18.0], "temp_max": [35.0],
+    })
+    expanded = expand_extremes(source, extremes, "30T")
+    assert expanded["temp"].tolist() == [18.0, 35.0, 21.0]
+    assert expanded["datetime"].tolist() == [
+        pd.Timestamp("2020-01-01 00:00"), pd.Timestamp("2020-01-01 00:15"),
+        pd.Timestamp("2020-01-01 00:30")]
+    assert list(expanded.columns) == list(source.columns)
+
+
+def test_points_for_width():
+    """Check the point budget scales with the chart width"""
+    assert points_for_width(600) == 1200
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""
+Tests for homesweetpi's http_client module.
+Runs a local keep-alive http server in place of a pi_logger api
+"""
+
+import time
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import pytest
+import requests
+from homesweetpi.http_client import PiHttpClient
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """
+    Minimal HTTP/1.1 handler that keeps connections open
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):  # pylint: disable=C0103
+        """Respond with an empty json object"""
+        body = b'{}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=W0221
+        """Silence request logging"""
+
+
+@pytest.fixture
+def server_url():
+    """Serve KeepAliveHandler on a free local port"""
+    server = HTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/get_recent/0"
+    server.shutdown()
+    server.server_close()
+
+
+def test_connection_stats_start_at_zero():
+    """Check a fresh client reports no requests"""
+    stats = PiHttpClient().connection_stats()
+    assert stats["requests"] == 0
+    assert stats["new_connections"] == 0
+
+
+def test_connections_are_reused(server_url):
+    """Check repeated requests to the same pi reuse one connection"""
+    client = PiHttpClient(timeout=(1, 1))
+    for _ in range(3):
+        assert client.get(server_url).json() == {}
+    stats = client.connection_stats()
+    client.close()
+    assert stats["requests"] == 3
+    assert stats["new_connections"] == 1
+    assert stats["reused_connections"] == 2
+
+
+class SlowHandler(KeepAliveHandler):
+    """
+    Handler that counts requests and answers after the client has given up
+    """
+    requests = 0
+
+    def do_GET(self):  # pylint: disable=C0103
+        """Respond after a delay"""
+        SlowHandler.requests += 1
+        time.sleep(0.5)
+        super().do_GET()
+
+
+def test_read_timeouts_are_not_retried():
+    """Check a hung pi costs one read timeout rather than one per retry"""
+    server = HTTPServer(("127.0.0.1", 0), SlowHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    client = PiHttpClient(timeout=(1, 0.1), retries=2)
+    try:
+        with pytest.raises(requests.exceptions.ConnectionError):
+            client.get(f"http://127.0.0.1:{server.server_port}/get_recent/0")
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+    assert SlowHandler.requests == 1
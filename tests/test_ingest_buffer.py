@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""
+Tests for homesweetpi's ingest_buffer module.
+Readings are saved to a list instead of the db.
+"""
+
+import threading
+import pandas as pd
+from homesweetpi.ingest_buffer import IngestBuffer
+from homesweetpi.sql_tables import InsertCounts
+
+
+class RecordingSave():
+    """Stand-in for ingest_measurements recording each flushed dataframe"""
+    def __init__(self, fail=False):
+        self.saved = []
+        self.fail = fail
+
+    def __call__(self, readings):
+        if self.fail:
+            raise ValueError("db unavailable")
+        self.saved.append(readings)
+        return InsertCounts(len(readings), 0)
+
+
+def make_readings(sensorid, n_rows, start="2020-03-20"):
+    """Return a dataframe of n_rows readings from one sensor"""
+    return pd.DataFrame({
+        "datetime": pd.date_range(start, periods=n_rows, freq="10S"),
+        "sensorid": sensorid,
+        "temp": 20.0,
+    })
+
+
+def test_flushes_by_size_across_producers():
+    """
+    Check readings from several pis are saved together once enough rows
+    are queued, and each producer is told they were committed
+    """
+    save = RecordingSave()
+    buffer = IngestBuffer(save, max_rows=100, max_delay=60)
+    flushed = []
+    for sensorid in range(4):
+        assert buffer.put(make_readings(sensorid, 30),
+                          on_flushed=flushed.append)
+    assert len(save.saved) == 1
+    assert len(save.saved[0]) == 120
+    assert flushed == [None] * 4
+    assert buffer.metrics()["queued_rows"] == 0
+
+
+def test_flushes_by_time_and_on_close():
+    """
+    Check the flush thread saves readings that have waited for max_delay,
+    and closing the buffer saves whatever is left
+    """
+    save = RecordingSave()
+    buffer = IngestBuffer(save, max_rows=1000, max_delay=0.05)
+    buffer.start()
+    committed = threading.Event()
+    buffer.put(make_readings(0, 10), on_flushed=lambda error: committed.set())
+    assert committed.wait(5)
+    buffer.close()
+    buffer.put(make_readings(1, 10))
+    assert buffer.close() == InsertCounts(10, 0)
+    metrics = buffer.metrics()
+    assert metrics["flushes"] == 2
+    assert metrics["inserted"] == 20
+    assert metrics["max_flush_seconds"] >= 0
+
+
+def test_bounded_buffer_turns_producers_away():
+    """
+    Check a full buffer rejects readings after the timeout and duplicate
+    readings are only saved once
+    """
+    save = RecordingSave()
+    buffer = IngestBuffer(save, max_rows=50, max_delay=60, capacity=50)
+    buffer.running = True  # as if a flush thread had stalled
+    assert buffer.put(make_readings(0, 40))
+    assert not buffer.put(make_readings(1, 20), timeout=0.01)
+    assert buffer.put(make_readings(0, 10))
+    buffer.running = False
+    assert buffer.flush() == InsertCounts(40, 0)
+    assert buffer.metrics()["rejected"] == 1
+
+
+def test_failed_flush_reports_error():
+    """Check producers are told when their readings could not be saved"""
+    buffer = IngestBuffer(RecordingSave(fail=True), max_rows=10)
+    errors = []
+    buffer.put(make_readings(0, 10), on_flushed=errors.append)
+    assert isinstance(errors[0], ValueError)
+    assert buffer.metrics()["failures"] == 1
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+Tests for the retention jobs in homesweetpi's maintenance module.
+Creates an SQLite db instead of the usual PostGres
+"""
+
+import os
+import logging
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+from homesweetpi.sql_tables import create_tables, load_sensor_and_pi_info,\
+                                   upsert_measurements, Measurement
+from homesweetpi.rollups import update_rollups
+from homesweetpi.archive import MeasurementArchive
+from homesweetpi.maintenance import apply_retention, thinned_keys
+
+LOG = logging.getLogger("homesweetpi.test_maintenance")
+
+TEST_TIME = datetime.now()
+TEST_DB_PATH = os.getcwd()
+TEST_DB_FILENAME = "test_maintenance_{}.db".format(
+    TEST_TIME.strftime("%Y%m%d_%H%M%S"))
+TEST_DB_FILEPATH = os.path.join(TEST_DB_PATH, TEST_DB_FILENAME)
+CONN_STRING = f'sqlite:///{TEST_DB_FILEPATH}'
+ENGINE = create_engine(CONN_STRING, echo=False)
+SESSION = sessionmaker(bind=ENGINE)
+
+PI_FILE = "pi_ip.csv"
+SENSOR_FILE = "logger_config.csv"
+READINGS = pd.concat([pd.DataFrame({
+    "datetime": pd.date_range(pd.Timestamp(TEST_TIME).floor("1H")
+                              - timedelta(days=3), TEST_TIME, freq="1T"),
+    "sensorid": sensorid,
+}) for sensorid in (0, 1)], ignore_index=True)
+READINGS["temp"] = np.linspace(15, 25, len(READINGS))
+
+
+def count_older_than(days):
+    """Return the number of raw readings older than days days"""
+    cutoff = TEST_TIME - timedelta(days=days)
+    return SESSION().query(func.count(Measurement.datetime))\
+                    .filter(Measurement.datetime < cutoff).scalar()
+
+
+def test_set_up_db():
+    """Create the tables, sensor info and readings in the SQLite db"""
+    create_tables(ENGINE)
+    load_sensor_and_pi_info(PI_FILE, SENSOR_FILE, engine=ENGINE)
+    assert upsert_measurements(READINGS, engine=ENGINE).inserted
+
+
+def test_nothing_removed_without_rollups_or_archive(tmp_path):
+    """Check raw readings are kept until they are rolled up or archived"""
+    report = apply_retention(1, session=SESSION(), engine=ENGINE,
+                             archive=MeasurementArchive(str(tmp_path)),
+                             pause=0, now=TEST_TIME)
+    assert report["removed"] == 0
+    assert report["before"]["rows"] == report["after"]["rows"]
+
+
+def test_thin_keeps_one_reading_per_interval(tmp_path):
+    """
+    Check thinning keeps the first reading per sensor in each interval and
+    leaves recent readings alone
+    """
+    update_rollups(READINGS, session=SESSION(), engine=ENGINE)
+    recent = count_older_than(0) - count_older_than(1)
+    report = apply_retention(1, "thin", "5T", session=SESSION(),
+                             engine=ENGINE,
+                             archive=MeasurementArchive(str(tmp_path)),
+                             window=timedelta(hours=6), pause=0,
+                             now=TEST_TIME)
+    assert report["batches"] > 1
+    assert report["after"]["rows"] == report["before"]["rows"] \
+        - report["removed"]
+    assert count_older_than(0) - count_older_than(1) == recent
+    old = READINGS[READINGS["datetime"] < TEST_TIME - timedelta(days=1)]
+    expected = old.groupby(["sensorid", old["datetime"].dt.floor("5T")])\
+                  .ngroups
+    assert count_older_than(1) == expected
+
+
+def test_delete_removes_old_readings(tmp_path):
+    """Check deleting removes every raw reading older than the period"""
+    report = apply_retention(2, "delete", session=SESSION(), engine=ENGINE,
+                             archive=MeasurementArchive(str(tmp_path)),
+                             pause=0, now=TEST_TIME)
+    assert report["removed"]
+    assert count_older_than(2) == 0
+    assert count_older_than(1)
+
+
+def test_thinned_keys():
+    """Check only the later readings in each interval are selected"""
+    keys = pd.DataFrame({
+        "sensorid": [0, 0, 0, 1],
+        "datetime": pd.to_datetime(["2020-01-01 00:00", "2020-01-01 00:01",
+                                    "2020-01-01 00:05", "2020-01-01 00:01"]),
+    })
+    doomed = thinned_keys(keys, "5T")
+    assert doomed["datetime"].tolist() == [pd.Timestamp("2020-01-01 00:01")]
+    assert doomed["sensorid"].tolist() == [0]
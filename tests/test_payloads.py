@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""
+Tests for homesweetpi's payloads module.
+"""
+
+import json
+import pytest
+import numpy as np
+import pandas as pd
+from homesweetpi.payloads import encode_compact, decode_compact,\
+                                 decode_response, payload_columns,\
+                                 COMPACT_MEDIA_TYPE
+
+
+def make_readings(n_rows=1000):
+    """
+    Return a dataframe of readings as the pi_logger api holds them
+    """
+    return pd.DataFrame({
+        "id": np.arange(n_rows),
+        "datetime": pd.date_range("2020-03-20", periods=n_rows, freq="10S"),
+        "location": np.where(np.arange(n_rows) % 2, "bay", "allo"),
+        "sensortype": "MCP",
+        "piname": "catflap",
+        "piid": "100000003d12f229",
+        "temp": None,
+        "mcdvalue": np.arange(n_rows) % 1024,
+        "mcdvoltage": np.linspace(0, 3.3, n_rows),
+    })
+
+
+class FakeResponse():
+    """Minimal response object with a content type and body"""
+    def __init__(self, content, content_type):
+        self.content = content
+        self.headers = {"Content-Type": content_type}
+
+    def json(self):
+        """Decode the body as json"""
+        return json.loads(self.content)
+
+
+def test_compact_matches_json_payload():
+    """
+    Check the compact payload decodes to the same columns as the json one
+    and is much smaller
+    """
+    readings = make_readings()
+    as_json = readings.to_json(orient="columns").encode()
+    compact = encode_compact(readings)
+    from_json = payload_columns(decode_response(
+        FakeResponse(as_json, "application/json")))
+    from_compact = decode_response(FakeResponse(compact, COMPACT_MEDIA_TYPE))
+    assert set(from_compact) == set(from_json)
+    for col, values in from_json.items():
+        assert from_compact[col] == pytest.approx(values), col
+    assert len(compact) * 10 < len(as_json)
+
+
+def test_uncompressed_compact_payload():
+    """Check a compact payload that is not gzip-compressed is decoded"""
+    readings = make_readings(3)
+    decoded = decode_compact(encode_compact(readings, compress=False))
+    assert decoded["location"] == ["allo", "bay", "allo"]
+    assert decoded["temp"] == [None] * 3
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+"""
+Tests for homesweetpi's rollups module.
+Creates an SQLite db instead of the usual PostGres
+"""
+
+import os
+import json
+import gzip
+import logging
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+from homesweetpi import retrieve_data
+from homesweetpi.sql_tables import create_tables, load_sensor_and_pi_info,\
+                                   upsert_measurements,\
+                                   get_bucketed_measurements,\
+                                   Measurement, Rollup5Min, RollupHourly,\
+                                   RollupDaily, LatestMeasurement,\
+                                   migrate_measurements
+from homesweetpi.rollups import update_rollups, choose_table,\
+                                get_chart_measurements, rollup_starts
+from homesweetpi.chart_cache import ChartCache
+from homesweetpi.chart_artifacts import ChartArtifactStore
+from homesweetpi.data_preparation import get_chart_data, precompute_charts,\
+                                         get_chart_source, CHART_VIEWS,\
+                                         chart_data_watermark
+
+LOG = logging.getLogger("homesweetpi.test_rollups")
+
+TEST_TIME = datetime.now()
+TEST_DB_PATH = os.getcwd()
+TEST_DB_FILENAME = "test_rollups_{}.db".format(
+    TEST_TIME.strftime("%Y%m%d_%H%M%S"))
+TEST_DB_FILEPATH = os.path.join(TEST_DB_PATH, TEST_DB_FILENAME)
+CONN_STRING = f'sqlite:///{TEST_DB_FILEPATH}'
+ENGINE = create_engine(CONN_STRING, echo=False)
+SESSION = sessionmaker(bind=ENGINE)
+
+PI_FILE = "pi_ip.csv"
+SENSOR_FILE = "logger_config.csv"
+
+
+def make_readings(start, periods, sensorids=(0, 1)):
+    """
+    Return a dataframe of one reading per minute per sensor from start
+    """
+    times = pd.date_range(start, periods=periods, freq="1T")
+    frames = []
+    for sensorid in sensorids:
+        frames.append(pd.DataFrame({
+            "datetime": times,
+            "sensorid": sensorid,
+            "temp": np.linspace(15, 25, periods) + sensorid,
+            "humidity": np.linspace(40, 60, periods),
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def test_set_up_db():
+    """Create the tables and sensor info in the SQLite db"""
+    create_tables(ENGINE)
+    load_sensor_and_pi_info(PI_FILE, SENSOR_FILE, engine=ENGINE)
+
+
+def test_no_rollup_chosen_before_rollups_exist():
+    """Check charts are drawn from raw readings until rollups are built"""
+    since = TEST_TIME - timedelta(days=1)
+    assert choose_table(since, '30T', session=SESSION()) is Measurement
+
+
+def test_update_rollups_matches_raw_buckets():
+    """
+    Check rollups built incrementally from two batches give the same
+    hourly averages as bucketing the raw readings
+    """
+    start = pd.Timestamp(TEST_TIME - timedelta(hours=5)).floor("1H")
+    first = make_readings(start, 150)
+    second = make_readings(start + timedelta(minutes=150), 150)
+    for batch in (first, second):
+        upsert_measurements(batch, engine=ENGINE)
+        update_rollups(batch, session=SESSION(), engine=ENGINE)
+    raw = get_bucketed_measurements(start, '1H', session=SESSION())
+    rolled = get_bucketed_measurements(start, '1H', session=SESSION(),
+                                       table=Rollup5Min)
+    pd.testing.assert_frame_equal(rolled[raw.columns], raw,
+                                  check_dtype=False)
+    assert SESSION().query(RollupHourly).count() == len(raw)
+
+
+def test_router_picks_coarsest_covering_rollup():
+    """Check the router uses the coarsest rollup that fits the frequency"""
+    since = pd.Timestamp(TEST_TIME - timedelta(hours=5)).floor("1D")
+    since = since.to_pydatetime()
+    assert choose_table(since, '30T', session=SESSION()) is Rollup5Min
+    assert choose_table(since, '2H', session=SESSION()) is RollupHourly
+    assert choose_table(since, '1D', session=SESSION()) is RollupDaily
+    assert choose_table(since, '90S', session=SESSION()) is Measurement
+
+
+def test_migration_rebuilds_empty_rollups():
+    """
+    Check migrating a db whose rollup tables were added after readings were
+    saved fills them from the raw readings
+    """
+    tables = (Rollup5Min, RollupHourly, RollupDaily)
+    expected = [SESSION().query(table).count() for table in tables]
+    with ENGINE.begin() as connection:
+        for table in tables:
+            connection.execute(table.__table__.delete())
+    migrate_measurements(ENGINE)
+    assert [SESSION().query(table).count() for table in tables] == expected
+
+
+def test_failed_rollup_update_rolls_back_readings(monkeypatch):
+    """
+    Check readings are not saved if their rollups cannot be updated, so the
+    next poll fetches them again
+    """
+    def fail(*args, **kwargs):
+        raise ValueError("rollup update failed")
+
+    monkeypatch.setattr(retrieve_data, "update_rollups", fail)
+    readings = make_readings(TEST_TIME + timedelta(days=1), 5)
+    with pytest.raises(ValueError):
+        retrieve_data.ingest_measurements(readings, engine=ENGINE)
+    since = readings["datetime"].min().to_pydatetime()
+    assert not SESSION().query(Measurement)\
+                        .filter(Measurement.datetime >= since).count()
+    assert SESSION().query(func.max(LatestMeasurement.datetime)).scalar()\
+        < since
+
+
+def test_get_chart_measurements_returns_df():
+    """Check chart data can be read through the router"""
+    logs = get_chart_measurements(1, '30T', session=SESSION())
+    assert isinstance(logs, pd.DataFrame)
+    assert logs.size
+
+
+def test_chart_source_keeps_short_spikes():
+    """
+    Check a one-minute spike shows in the chart data although it barely
+    moves the 30 minute average of its bucket
+    """
+    start = pd.Timestamp(TEST_TIME - timedelta(days=3)).floor("1D")
+    readings = make_readings(start, 30, sensorids=(0,))
+    readings["temp"] = 20.0
+    readings.loc[10, "temp"] = 99.0
+    upsert_measurements(readings, engine=ENGINE)
+    source = get_chart_source(5, '30T', session=SESSION())
+    assert source["Temperature (°C)"].max() == 99.0
+    means = get_chart_measurements(5, '30T', session=SESSION())
+    assert means["temp"].max() < 99.0
+
+
+def test_chart_data_cached_until_new_data():
+    """
+    Check chart data is reused until a new reading changes the watermark
+    """
+    cache = ChartCache()
+    rows = ("Temperature (°C)", "Relative Humidity (%)")
+    payload = get_chart_data(rows, 1, '30T', "json", session=SESSION(),
+                             cache=cache)
+    columns = json.loads(payload)
+    assert set(columns) == {"Time", "Location"} | set(rows)
+    assert get_chart_data(rows, 1, '30T', "json", session=SESSION(),
+                          cache=cache) == payload
+    assert cache.stats()["hits"] == 1
+    upsert_measurements(make_readings(TEST_TIME, 1), engine=ENGINE)
+    get_chart_data(rows, 1, '30T', "json", session=SESSION(), cache=cache)
+    assert cache.stats()["misses"] == 2
+
+
+def test_chart_data_csv_is_compact():
+    """
+    Check the csv chart data has a header row and survives gzip
+    """
+    rows = ("Temperature (°C)", "Relative Humidity (%)")
+    csv = get_chart_data(rows, 1, '30T', "csv", session=SESSION(),
+                         cache=ChartCache())
+    compressed = get_chart_data(rows, 1, '30T', "csv", compress=True,
+                                session=SESSION(), cache=ChartCache())
+    assert gzip.decompress(compressed) == csv
+    assert csv.decode().splitlines()[0] == "Time,Location," + ",".join(rows)
+
+
+def test_precomputed_charts_served_from_store(tmp_path):
+    """
+    Check precomputed chart data is read from the store and matches the data
+    built on request
+    """
+    store = ChartArtifactStore(str(tmp_path))
+    names = precompute_charts((1,), '30T', session=SESSION(), store=store)
+    assert len(names) == len(CHART_VIEWS) * 2
+    rows = CHART_VIEWS["air"]
+    served = get_chart_data(rows, 1, '30T', compress=True, session=SESSION(),
+                            cache=ChartCache(), store=store, view="air")
+    assert store.stats()["hits"] == 1
+    built = get_chart_data(rows, 1, '30T', compress=True, session=SESSION(),
+                           cache=ChartCache())
+    assert gzip.decompress(served) == gzip.decompress(built)
+    upsert_measurements(make_readings(TEST_TIME + timedelta(minutes=1), 1),
+                        engine=ENGINE)
+    precomputed_at = chart_data_watermark("air", 1, '30T', compress=True,
+                                          watermark=TEST_TIME,
+                                          session=SESSION(), store=store)
+    watermark = chart_data_watermark("air", 1, '30T', compress=True,
+                                     session=SESSION(), store=store)
+    assert watermark == precomputed_at
+    lagging = get_chart_data(rows, 1, '30T', compress=True,
+                             session=SESSION(), cache=ChartCache(),
+                             watermark=watermark, store=store, view="air")
+    assert lagging == served
+    assert store.stats()["hits"] == 2
+    ahead = TEST_TIME + timedelta(days=1)
+    assert chart_data_watermark("air", 1, '30T', compress=True,
+                                watermark=ahead, session=SESSION(),
+                                store=store) == ahead
+    precompute_charts((1,), '30T', session=SESSION(), store=store)
+    assert len(list(tmp_path.iterdir())) == len(names)
+
+
+def test_rollup_starts_skip_saved_readings():
+    """
+    Check the rollups are recomputed from the first new reading of a batch
+    rather than from readings that were already saved
+    """
+    start = pd.Timestamp(TEST_TIME - timedelta(days=10)).floor("1D")
+    history = make_readings(start, 180, sensorids=(2, 3))
+    retrieve_data.ingest_measurements(history, engine=ENGINE)
+    later = make_readings(start + timedelta(hours=3), 60, sensorids=(2, 3))
+    with ENGINE.connect() as connection:
+        starts = rollup_starts(pd.concat([history, later]), connection)
+    first_new = (start + timedelta(hours=3)).to_pydatetime()
+    assert starts == {2: first_new, 3: first_new}
+
+
+def test_resent_history_keeps_rollups_of_removed_readings(monkeypatch):
+    """
+    Check a pi re-sending readings that retention has removed does not wipe
+    the rollup buckets that now hold them
+    """
+    start = pd.Timestamp(TEST_TIME - timedelta(days=10)).floor("1D")
+    cutoff = start + timedelta(hours=2)
+
+    def rollup_rows(table):
+        return SESSION().query(table.sensorid, table.datetime, table.temp)\
+                        .filter(table.datetime >= start)\
+                        .filter(table.datetime < start + timedelta(days=1))\
+                        .order_by(table.sensorid, table.datetime).all()
+
+    before = [rollup_rows(table) for table in (RollupHourly, RollupDaily)]
+    assert len(before[0]) == 6
+    with ENGINE.begin() as connection:
+        connection.execute(Measurement.__table__.delete()
+                           .where(Measurement.datetime >= start)
+                           .where(Measurement.datetime < cutoff))
+    monkeypatch.setattr(retrieve_data, "retention_cutoff",
+                        lambda: cutoff.to_pydatetime())
+    resent = make_readings(start, 60, sensorids=(2, 3))
+    counts = retrieve_data.ingest_measurements(resent, engine=ENGINE)
+    assert counts.inserted == len(resent)
+    assert [rollup_rows(table) for table in (RollupHourly, RollupDaily)]\
+        == before
@@ -11,14 +11,29 @@ import logging
 from datetime import datetime, timedelta
 import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, Table, MetaData
+from sqlalchemy.schema import CreateTable, CreateIndex
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import OperationalError
 from homesweetpi.sql_tables import create_tables, load_sensor_and_pi_info,\
                                    get_pi_names, get_sensor_locations,\
                                    get_last_time, save_recent_data,\
                                    one_or_more_results, Measurement,\
-                                   get_measurements_since, get_last_n_days
+                                   get_measurements_since, get_last_n_days,\
+                                   get_last_times, upsert_measurements,\
+                                   get_sensors_on_pi, SENSOR_CACHE,\
+                                   get_latest_measurements,\
+                                   get_last_measurement_for_sensor,\
+                                   get_latest_readings, LatestMeasurement,\
+                                   get_bucketed_measurements,\
+                                   resample_measurements,\
+                                   resample_measurements_pandas,\
+                                   measurement_table_args,\
+                                   migrate_measurements,\
+                                   create_month_partition,\
+                                   iter_measurements_since
+from homesweetpi.sensor_cache import SensorMetadataCache
 from homesweetpi.retrieve_data import process_fetched_data
 
 LOG = logging.getLogger("homesweetpi.test_sql_tables")
@@ -57,6 +72,75 @@ def test_create_db():
     assert os.path.exists(TEST_DB_FILEPATH)
 
 
+def test_datetime_index_created_and_migrated():
+    """
+    Check create_tables indexes measurements by datetime and the migration
+    restores the index in a db created without it
+    """
+    def index_names():
+        return {index["name"] for index in
+                inspect(ENGINE).get_indexes("measurements")}
+    assert "ix_measurements_datetime" in index_names()
+    ENGINE.execute("DROP INDEX ix_measurements_datetime")
+    migrate_measurements(ENGINE)
+    assert "ix_measurements_datetime" in index_names()
+
+
+def test_partitioned_measurements_ddl():
+    """
+    Check the partitioned measurements table is range partitioned by
+    datetime with a BRIN index on PostGres
+    """
+    columns = [col.copy() for col in Measurement.__table__.columns
+               if not col.foreign_keys]
+    *indexes, options = measurement_table_args(partitioned=True)
+    table = Table("measurements", MetaData(), *columns, *indexes, **options)
+    dialect = postgresql.dialect()
+    assert "PARTITION BY RANGE (datetime)" in str(
+        CreateTable(table).compile(dialect=dialect))
+    index, = table.indexes
+    assert "USING brin (datetime)" in str(
+        CreateIndex(index).compile(dialect=dialect))
+
+
+class RecordingConnection():
+    """
+    Stand-in for a PostGres connection recording the statements executed,
+    where the default partition exists and holds readings
+    """
+    dialect = postgresql.dialect()
+
+    def __init__(self, existing):
+        self.existing = existing
+        self.statements = []
+
+    def execute(self, statement, **params):
+        """Record the statement and answer existence checks"""
+        self.statements.append(str(statement))
+        exists = params.get("name") in self.existing
+        return type("Result", (), {"scalar": lambda _: exists or None,
+                                   "rowcount": 3})()
+
+
+def test_partition_created_around_readings_in_default():
+    """
+    Check readings already in the default partition are moved into a new
+    month partition, which is attached instead of created in place
+    """
+    connection = RecordingConnection({"measurements_default"})
+    create_month_partition(pd.Timestamp("2026-11-01"), connection)
+    created, moved, deleted, attached = connection.statements[2:]
+    assert created.startswith("CREATE TABLE measurements_2026_11 (LIKE")
+    assert "FROM measurements_default WHERE" in moved
+    assert deleted.startswith("DELETE FROM measurements_default")
+    assert attached == ("ALTER TABLE measurements ATTACH PARTITION "
+                        "measurements_2026_11 FOR VALUES "
+                        "FROM ('2026-11-01') TO ('2026-12-01')")
+    connection = RecordingConnection({"measurements_2026_11"})
+    create_month_partition(pd.Timestamp("2026-11-01"), connection)
+    assert len(connection.statements) == 1
+
+
 def test_db_connection_failure():
     """Check an error is raised if connection to db fails"""
     host = 'localhost'  # invalid ip address
@@ -202,6 +286,25 @@ def test_some_results():
     assert logs.size
 
 
+def test_iter_measurements_since_in_chunks():
+    """
+    Check readings are streamed in ordered chunks with typed columns that
+    together match the single dataframe
+    """
+    valid_datetime = TEST_TIME - timedelta(1)
+    chunks = list(iter_measurements_since(valid_datetime, session=SESSION(),
+                                          chunk_size=2))
+    logs = get_measurements_since(valid_datetime, session=SESSION())
+    assert len(chunks) == -(-len(logs) // 2)
+    assert all(len(chunk) <= 2 for chunk in chunks)
+    streamed = pd.concat(chunks, ignore_index=True)
+    pd.testing.assert_frame_equal(streamed, logs)
+    assert logs["datetime"].is_monotonic_increasing
+    assert logs["datetime"].dtype == "datetime64[ns]"
+    assert logs["sensorid"].dtype == "int64"
+    assert logs["mcdvalue"].dtype == "float64"
+
+
 def test_get_last_time():
     """
     Check get_last_time returns a valid datetime
@@ -209,3 +312,192 @@ def test_get_last_time():
     piid = PI_INFO.loc[0, 'id']
     last_time = get_last_time(piid, session=SESSION())
     assert isinstance(last_time, datetime)
+
+
+def test_get_last_times_matches_get_last_time():
+    """
+    Check the grouped watermark query agrees with the per-pi query
+    """
+    last_times = get_last_times(session=SESSION())
+    assert last_times
+    for piid, last_time in last_times.items():
+        assert last_time == get_last_time(piid, session=SESSION())
+
+
+def test_upsert_skips_existing_rows():
+    """
+    Check saving a batch that is already in the db skips every row instead
+    of failing the whole batch
+    """
+    data_df = process_fetched_data(SAMPLE_JSON, session=SESSION())
+    counts = upsert_measurements(data_df, engine=ENGINE)
+    assert counts.inserted == 0
+    assert counts.skipped == len(data_df)
+
+
+def test_upsert_inserts_only_new_rows():
+    """
+    Check a batch mixing new and existing readings inserts just the new ones
+    """
+    data_df = process_fetched_data(SAMPLE_JSON, session=SESSION())
+    new_rows = data_df.copy()
+    new_rows['datetime'] = new_rows['datetime'] + timedelta(seconds=1)
+    batch = pd.concat([data_df, new_rows])
+    counts = upsert_measurements(batch, engine=ENGINE)
+    assert counts.inserted == len(new_rows)
+    assert counts.skipped == len(data_df)
+
+
+def test_sensor_cache_matches_query():
+    """
+    Check the cached sensors on a pi match those queried from the db
+    """
+    piid = PI_INFO.loc[0, 'id']
+    cached = SENSOR_CACHE.sensors_on_pi(piid, session=SESSION())
+    queried = get_sensors_on_pi(piid, session=SESSION())
+    cached = cached.sort_values("sensorid").reset_index(drop=True)
+    queried = queried.sort_values("sensorid").reset_index(drop=True)
+    pd.testing.assert_frame_equal(cached, queried[cached.columns],
+                                  check_dtype=False)
+
+
+def test_sensor_cache_counts_hits_and_misses():
+    """
+    Check the cache is reloaded once after invalidation and then hit
+    """
+    SENSOR_CACHE.invalidate()
+    before = SENSOR_CACHE.stats()
+    SENSOR_CACHE.sensors_and_pis(session=SESSION())
+    SENSOR_CACHE.sensors_and_pis(session=SESSION())
+    after = SENSOR_CACHE.stats()
+    assert after["misses"] == before["misses"] + 1
+    assert after["hits"] == before["hits"] + 1
+
+
+def test_sensor_cache_reloads_for_new_sensor_on_known_pi():
+    """
+    Check a sensor added to a pi that is already cached triggers a reload
+    instead of being treated as unknown until the cache expires
+    """
+    sensors = [("bay", "catflap")]
+
+    def loader(session):
+        return pd.DataFrame([(sensorid, location, piname, "pi")
+                             for sensorid, (location, piname)
+                             in enumerate(sensors)],
+                            columns=["sensorid", "location", "piname",
+                                     "piid"])
+
+    cache = SensorMetadataCache(loader)
+    assert len(cache.sensors_on_pi("pi", None, {("bay", "catflap")})) == 1
+    sensors.append(("allo", "catflap"))
+    on_pi = cache.sensors_on_pi("pi", None, {("allo", "catflap")})
+    assert list(on_pi["location"]) == ["bay", "allo"]
+    assert cache.stats()["misses"] == 2
+
+
+def test_latest_measurements_match_per_sensor_query():
+    """
+    Check the single latest-readings query returns the same row for each
+    sensor as querying the sensors one at a time
+    """
+    latest = get_latest_measurements(session=SESSION())
+    assert latest
+    assert len({row["sensorid"] for row in latest}) == len(latest)
+    for row in latest:
+        expected = get_last_measurement_for_sensor(row["sensorid"],
+                                                   session=SESSION())
+        assert row == expected
+
+
+def test_latest_readings_table_kept_up_to_date():
+    """
+    Check the latest_measurements table maintained at ingest agrees with
+    searching the measurements table
+    """
+    session = SESSION()
+    assert session.query(LatestMeasurement).count()
+    from_table = sorted(get_latest_readings(session=session),
+                        key=lambda row: row["sensorid"])
+    from_search = sorted(get_latest_measurements(session=session),
+                         key=lambda row: row["sensorid"])
+    assert from_table == from_search
+
+
+def test_latest_readings_not_replaced_by_older_rows():
+    """
+    Check a backfill of older readings does not overwrite the latest ones
+    """
+    before = get_latest_readings(session=SESSION())
+    data_df = process_fetched_data(SAMPLE_JSON, session=SESSION())
+    data_df['datetime'] = data_df['datetime'] - timedelta(days=1)
+    assert upsert_measurements(data_df, engine=ENGINE).inserted
+    assert get_latest_readings(session=SESSION()) == before
+
+
+def test_migration_fills_empty_latest_readings_table():
+    """
+    Check migrating a db whose latest_measurements table was added after
+    readings were saved fills it for every sensor
+    """
+    session = SESSION()
+    expected = sorted(get_latest_readings(session=session),
+                      key=lambda row: row["sensorid"])
+    with ENGINE.begin() as connection:
+        connection.execute(LatestMeasurement.__table__.delete())
+    migrate_measurements(ENGINE)
+    rebuilt = sorted(get_latest_readings(session=SESSION()),
+                     key=lambda row: row["sensorid"])
+    assert rebuilt == expected
+
+
+def test_bucketed_measurements_match_pandas_resample():
+    """
+    Check averaging into time buckets in the db agrees with resampling the
+    raw readings in pandas
+    """
+    since = TEST_TIME - timedelta(days=2)
+    bucketed = get_bucketed_measurements(since, '30T', session=SESSION())
+    logs = get_measurements_since(since, session=SESSION())
+    logs['datetime'] = pd.to_datetime(logs['datetime'])
+    resampled = resample_measurements(logs, '30T')
+    values = ["mcdvalue", "mcdvoltage"]
+    resampled = resampled.dropna(subset=values).reset_index(drop=True)
+    pd.testing.assert_frame_equal(bucketed[resampled.columns], resampled,
+                                  check_dtype=False)
+
+
+def test_bucketed_measurements_min_max():
+    """
+    Check min and max columns bracket the bucket averages
+    """
+    since = TEST_TIME - timedelta(days=2)
+    bucketed = get_bucketed_measurements(since, '1D', session=SESSION(),
+                                         aggregates=("avg", "min", "max"))
+    assert (bucketed["mcdvalue_min"] <= bucketed["mcdvalue"]).all()
+    assert (bucketed["mcdvalue"] <= bucketed["mcdvalue_max"]).all()
+
+
+def test_resample_matches_pandas_groupby():
+    """
+    Check the bincount resampling agrees with a pandas groupby resample,
+    including empty buckets, missing values and sensors with different
+    time ranges
+    """
+    rng = np.random.default_rng(0)
+    n_rows = 5000
+    offsets = pd.to_timedelta(rng.integers(0, 10**6, n_rows), unit="s")
+    logs = pd.DataFrame({
+        "sensorid": rng.integers(0, 4, n_rows),
+        "datetime": pd.Timestamp("2020-01-01 03:17") + offsets,
+        "temp": rng.normal(20, 2, n_rows),
+        "mcdvalue": rng.integers(0, 1024, n_rows),
+    })
+    logs.loc[rng.random(n_rows) < 0.1, "temp"] = np.nan
+    logs = logs[(logs["sensorid"] != 2)
+                | (logs["datetime"] < "2020-01-05")]
+    for resample_freq in ("30T", "7T", "1D"):
+        pd.testing.assert_frame_equal(
+            resample_measurements(logs, resample_freq),
+            resample_measurements_pandas(logs, resample_freq),
+            check_dtype=False)
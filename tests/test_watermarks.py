@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+"""
+Tests for homesweetpi's watermarks module.
+"""
+
+from datetime import datetime
+import pandas as pd
+from homesweetpi import watermarks
+from homesweetpi.watermarks import WatermarkCache
+
+
+def test_watermarks_persist_to_file(tmp_path):
+    """Check watermarks written by one cache are loaded by the next"""
+    path = str(tmp_path / "watermarks.json")
+    cache = WatermarkCache(path=path)
+    cache.update("100000003d12f229", pd.Timestamp("2020-03-20 12:00:01"))
+    reloaded = WatermarkCache(path=path)
+    reloaded.load()
+    assert reloaded.get("100000003d12f229") == datetime(2020, 3, 20, 12, 0, 1)
+
+
+def test_watermarks_only_move_forward(tmp_path):
+    """Check an older save does not move a watermark backwards"""
+    cache = WatermarkCache(path=str(tmp_path / "watermarks.json"))
+    cache.update("piid", datetime(2020, 3, 20, 12))
+    cache.update("piid", datetime(2020, 3, 19, 12))
+    assert cache.get("piid") == datetime(2020, 3, 20, 12)
+
+
+def test_pushed_readings_do_not_move_watermark(tmp_path, monkeypatch):
+    """
+    Check a pi's watermark stays at the last reading pulled even if newer
+    readings pushed by the pi are in the db, so gaps between failed and
+    successful pushes are still fetched
+    """
+    cache = WatermarkCache(path=str(tmp_path / "watermarks.json"))
+    cache.update("piid", datetime(2020, 3, 20, 12))
+    monkeypatch.setattr(watermarks, "get_last_time",
+                        lambda piid, session: datetime(2020, 3, 20, 13))
+    assert cache.get("piid", session=None) == datetime(2020, 3, 20, 12)